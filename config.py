@@ -31,3 +31,60 @@ def read_env(name: str, default_value: str) -> str:
 IS_DEBUG = bool(int(read_env('LIMBO_IS_DEBUG', '0')))
 
 DISABLE_STORAGE = bool(int(read_env('LIMBO_DISABLE_STORAGE', '0')))
+
+# Number of chunks buffered between upload stages (network reading,
+# multipart parsing and disk writing). 0 processes uploads in one thread.
+UPLOAD_QUEUE_DEPTH = int(read_env('LIMBO_UPLOAD_QUEUE_DEPTH', '16'))
+
+# Store files with the same content as hardlinks to a single copy
+DEDUPLICATE_FILES = bool(int(read_env('LIMBO_DEDUPLICATE_FILES', '0')))
+
+# Size of thread pool of asyncio web server (LIMBO_WEB_SERVER=asyncio).
+# It runs blocking work only; network I/O is done by the event loop.
+ASYNC_MAX_WORKERS = int(read_env('LIMBO_ASYNC_MAX_WORKERS', '32'))
+
+# Level of on-the-fly gzip compression of text previews and JSON replies (1-9).
+# 0 disables it. Static files are compressed once at startup anyway.
+GZIP_LEVEL = int(read_env('LIMBO_GZIP_LEVEL', '6'))
+
+# Max number of responses compressed at the same time (per process).
+# Other responses are sent uncompressed meanwhile.
+GZIP_MAX_STREAMS = int(read_env('LIMBO_GZIP_MAX_STREAMS', '4'))
+
+# Number of web server processes (pre-fork mode; POSIX only).
+# 1 serves requests in the main process.
+WORKERS = int(read_env('LIMBO_WORKERS', '1'))
+
+# Limits of stored files: total size in bytes and number of files; 0 means no limit.
+# Uploads which don't fit are rejected before their data is read:
+# with 413 when the file is bigger than the size limit, with 507 otherwise.
+MAX_STORAGE_BYTES = int(read_env('LIMBO_MAX_STORAGE_BYTES', '0'))
+MAX_STORAGE_FILES = int(read_env('LIMBO_MAX_STORAGE_FILES', '0'))
+
+# Free disk space which uploads never take
+MIN_FREE_DISK_BYTES = int(read_env('LIMBO_MIN_FREE_DISK_BYTES', '0'))
+
+# Remove the oldest files before their time when an upload doesn't fit
+EVICT_OLDEST_FILES = bool(int(read_env('LIMBO_EVICT_OLDEST_FILES', '0')))
+
+# Layout of stored files: 'flat' keeps all files in STORAGE_DIRECTORY itself;
+# 'sharded' spreads new files over 256 subdirectories (for 100k+ files),
+# files stored flat before are still served; 'migrate' is 'sharded' which
+# moves flat files to subdirectories at startup; 'buckets' stores files
+# in subdirectories by upload time which are removed as a whole.
+STORAGE_LAYOUT = read_env('LIMBO_STORAGE_LAYOUT', 'flat')
+
+# Upload time interval of a bucket directory (LIMBO_STORAGE_LAYOUT=buckets).
+# Files may be kept up to that much longer than MAX_STORAGE_SECONDS.
+STORAGE_BUCKET_SECONDS = int(read_env('LIMBO_STORAGE_BUCKET_SECONDS', '3600'))
+
+# Files of at least that size don't stay in page cache after upload or download,
+# so huge transfers don't push small hot files out of it; their downloads get
+# readahead hints. 0 disables it.
+DROP_CACHE_MIN_BYTES = int(read_env('LIMBO_DROP_CACHE_MIN_BYTES', str(64 * 1024 * 1024)))
+
+# Durability of completed uploads: 'none' leaves syncing to the OS (a crash may
+# leave recently uploaded files empty); 'commit' syncs every file and its directory
+# before the upload is acknowledged; 'periodic' syncs directories once per batch
+# of concurrently completed uploads (group commit).
+DURABILITY = read_env('LIMBO_DURABILITY', 'none')
@@ -0,0 +1,395 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import asyncio
+import logging
+import sys
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Pattern, Sequence, Tuple
+
+import bottle
+
+from lib_web_servers import FileRange, FileWrapper
+
+
+LOGGER = logging.getLogger('aio')
+
+# Request line and headers must fit in this size:
+MAX_HEADERS_SIZE = 64 * 1024
+# Size of read buffer of a connection:
+READ_BUFFER_SIZE = 1024 * 1024
+# Keep-alive connection is closed when the next request does not come in time:
+KEEP_ALIVE_TIMEOUT_SECONDS = 75
+# Connection is closed when a client does not send or receive any data for this time:
+IO_TIMEOUT_SECONDS = 300
+# Request body bigger than this is not drained for keep-alive when the handler did not read it:
+MAX_DRAIN_SIZE = 64 * 1024
+
+RunBlocking = Callable[..., 'asyncio.Future[Any]']
+AsyncHandler = Callable[..., Awaitable[bottle.HTTPResponse]]
+AsyncRoute = Tuple[str, Pattern[str], AsyncHandler]
+
+
+# ==========================================
+# HTTP/1.1 server based on asyncio.
+#
+# Connections are served by the event loop: idle and slow clients don't
+# hold threads. The bottle app is called through WSGI in a bounded
+# thread pool. Its response is sent by the event loop: files are sent
+# with loop.sendfile(), iterators are advanced in the thread pool.
+#
+# WSGI app reads request body in a blocking way, so "native" routes are
+# handled by coroutines instead. They read request body by the event loop
+# and run blocking work in the thread pool. Such a coroutine gets
+# AsyncRequest, RunBlocking function and the groups of route regex.
+#
+# Unexpected exception of a handler is answered by 500 when the response
+# is not started yet; the connection is closed anyway.
+# ==========================================
+
+
+class BadRequest(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class AsyncBodyReader:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: bottle.HeaderDict):
+        self._reader = reader
+        self._writer = writer
+        self._chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        try:
+            # Size of the rest of current chunk (or the whole body when not chunked):
+            self._remaining: Optional[int] = None if self._chunked else int(headers.get('Content-Length') or 0)
+        except ValueError as exc:
+            raise BadRequest(400, 'Bad Content-Length') from exc
+        self._expect_continue = headers.get('Expect', '').lower() == '100-continue'
+        self.finished = self._remaining == 0
+
+    async def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            parts: List[bytes] = []
+            while True:
+                data = await self.read(1024 * 1024)
+                if not data:
+                    return b''.join(parts)
+                parts.append(data)
+        if self._expect_continue and not self.finished:
+            self._expect_continue = False
+            self._writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        while not self.finished:
+            if not self._remaining:
+                self._remaining = await self._read_chunk_header()
+                continue
+            data = await asyncio.wait_for(self._reader.read(min(size, self._remaining)), IO_TIMEOUT_SECONDS)
+            if not data:
+                raise EOFError('Request body is truncated')
+            self._remaining -= len(data)
+            if not self._remaining:
+                if self._chunked:
+                    await self._readline()  # CRLF after chunk data
+                else:
+                    self.finished = True
+            return data
+        return b''
+
+    # Reads the rest of small body, so the connection may be used for the next request
+    async def drain(self) -> bool:
+        if self._expect_continue:
+            return False  # client may not send the body at all
+        drained = 0
+        while not self.finished and drained <= MAX_DRAIN_SIZE:
+            drained += len(await self.read(MAX_DRAIN_SIZE))
+        return self.finished
+
+    async def _readline(self) -> bytes:
+        try:
+            return await asyncio.wait_for(self._reader.readuntil(b'\n'), IO_TIMEOUT_SECONDS)
+        except asyncio.IncompleteReadError as exc:
+            raise EOFError('Request body is truncated') from exc
+
+    async def _read_chunk_header(self) -> int:
+        line = await self._readline()
+        try:
+            chunk_size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError as exc:
+            raise EOFError('Bad chunk header in request body') from exc
+        if chunk_size == 0:
+            # Skip trailer fields up to the empty line:
+            while (await self._readline()).strip():
+                pass
+            self.finished = True
+        return chunk_size
+
+
+class BlockingBodyReader:
+    # wsgi.input for the app running in the thread pool
+    def __init__(self, body: AsyncBodyReader, loop: asyncio.AbstractEventLoop):
+        self._body = body
+        self._loop = loop
+
+    def read(self, size: int = -1) -> bytes:
+        return asyncio.run_coroutine_threadsafe(self._body.read(size), self._loop).result()
+
+
+class AsyncRequest:
+    def __init__(self, method: str, target: str, version: str, headers: bottle.HeaderDict, body: AsyncBodyReader):
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.response_started = False  # response head is written
+        raw_path, _, self.query_string = target.partition('?')
+        # WSGI passes path as latin-1 decoded bytes:
+        self.path_info = urllib.parse.unquote_to_bytes(raw_path).decode('latin-1')
+        self.path = self.path_info.encode('latin-1').decode('utf-8', 'replace')
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get('Connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+
+class AsyncServer:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, app: Callable[..., Iterable[bytes]], host: str, port: int,
+                 native_routes: Sequence[AsyncRoute] = (), max_workers: int = 32, reuse_port: bool = False):
+        self._app = app
+        self._host = host
+        self._port = port
+        self._reuse_port = reuse_port
+        self._native_routes = native_routes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async-worker')
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def run(self) -> None:
+        asyncio.run(self._serve())
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle_connection, self._host, self._port,
+                                            limit=READ_BUFFER_SIZE, reuse_port=self._reuse_port or None)
+        LOGGER.info('Async server is listening on %s:%d', self._host, self._port)
+        async with server:
+            await server.serve_forever()
+
+    def _run_blocking(self, func: Callable[..., Any], *args: Any) -> 'asyncio.Future[Any]':
+        assert self._loop is not None
+        return self._loop.run_in_executor(self._executor, func, *args)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await self._read_request(reader, writer)
+                if request is None:
+                    break
+                keep_alive = await self._handle_request(request, writer)
+                if not keep_alive or not await request.body.drain():
+                    break
+        except BadRequest as exc:
+            self._write_head(writer, 'HTTP/1.1', f'{exc.status} {exc}', [('Content-Length', '0')], False)
+        except (asyncio.TimeoutError, ConnectionError, EOFError) as exc:
+            LOGGER.debug('Connection is dropped: %s', repr(exc))
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.exception('Async server got exception: %s', repr(exc))
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[AsyncRequest]:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT_SECONDS)
+        except asyncio.IncompleteReadError:
+            return None  # connection is closed by client
+        except asyncio.LimitOverrunError as exc:
+            raise BadRequest(431, 'Request Header Fields Too Large') from exc
+        if len(head) > MAX_HEADERS_SIZE:
+            raise BadRequest(431, 'Request Header Fields Too Large')
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            raise BadRequest(400, 'Bad Request')
+        method, target, version = parts
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise BadRequest(505, 'HTTP Version Not Supported')
+        headers = bottle.HeaderDict()
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, colon, value = line.partition(':')
+            if not colon:
+                raise BadRequest(400, 'Bad Request')
+            headers.append(name.strip(), value.strip())
+        return AsyncRequest(method, target, version, headers, AsyncBodyReader(reader, writer, headers))
+
+    # Returns whether the connection may be kept alive
+    async def _handle_request(self, request: AsyncRequest, writer: asyncio.StreamWriter) -> bool:
+        try:
+            for method, regex, handler in self._native_routes:
+                match = regex.match(request.path)
+                if match and request.method == method:
+                    try:
+                        response = await handler(request, self._run_blocking, *match.groups())
+                    except bottle.HTTPResponse as exc:
+                        response = exc
+                    return await self._send_native_response(request, writer, response)
+            return await self._call_wsgi_app(request, writer)
+        except (asyncio.TimeoutError, ConnectionError):
+            raise
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.exception('Failed to handle request %s %s: %s', request.method, request.path, repr(exc))
+            if not request.response_started:
+                request.response_started = True
+                self._write_head(writer, request.version, '500 Internal Server Error',
+                                 [('Content-Length', '0')], False)
+                await asyncio.wait_for(writer.drain(), IO_TIMEOUT_SECONDS)
+            return False
+
+    async def _send_native_response(self, request: AsyncRequest, writer: asyncio.StreamWriter,
+                                    response: bottle.HTTPResponse) -> bool:
+        body = response.body
+        if isinstance(body, str):
+            body = body.encode(response.charset)
+        headers = [item for item in response.headerlist if item[0].lower() != 'content-length']
+        headers.append(('Content-Length', str(len(body))))
+        keep_alive = request.keep_alive
+        request.response_started = True
+        self._write_head(writer, request.version, response.status_line, headers, keep_alive)
+        if request.method != 'HEAD':
+            writer.write(body)
+        await asyncio.wait_for(writer.drain(), IO_TIMEOUT_SECONDS)
+        return keep_alive
+
+    def _make_environ(self, request: AsyncRequest, writer: asyncio.StreamWriter) -> Dict[str, Any]:
+        assert self._loop is not None
+        peer = writer.get_extra_info('peername') or ('', 0)
+        environ: Dict[str, Any] = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path_info,
+            'QUERY_STRING': request.query_string,
+            'SERVER_NAME': self._host,
+            'SERVER_PORT': str(self._port),
+            'SERVER_PROTOCOL': request.version,
+            'REMOTE_ADDR': str(peer[0]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BlockingBodyReader(request.body, self._loop),
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+        for name in request.headers:
+            value = ', '.join(request.headers.getall(name))
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[key] = value
+            else:
+                environ[f'HTTP_{key}'] = value
+        return environ
+
+    async def _call_wsgi_app(self, request: AsyncRequest, writer: asyncio.StreamWriter) -> bool:
+        started: List[Any] = []
+        # Data passed to write() callable precedes the returned iterable:
+        written: List[bytes] = []
+
+        def start_response(status: str, headers: List[Tuple[str, str]],
+                           exc_info: Any = None) -> Callable[[bytes], None]:
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+            return written.append
+
+        environ = self._make_environ(request, writer)
+        result = await self._run_blocking(self._app, environ, start_response)
+        try:
+            if not started:
+                raise RuntimeError('WSGI app did not call start_response()')
+            status, headers = started
+            return await self._send_wsgi_response(request, writer, status, headers, written, result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def _send_wsgi_response(self, request: AsyncRequest, writer: asyncio.StreamWriter,
+                                  status: str, headers: List[Tuple[str, str]], written: List[bytes],
+                                  result: Iterable[bytes]) -> bool:
+        assert self._loop is not None
+        content_length: Optional[int] = None
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                content_length = int(value)
+        has_body = request.method != 'HEAD' and not status.startswith(('1', '204', '304'))
+        chunked = has_body and content_length is None and request.version == 'HTTP/1.1'
+        keep_alive = request.keep_alive and (chunked or content_length is not None or not has_body)
+        if chunked:
+            headers = headers + [('Transfer-Encoding', 'chunked')]
+        request.response_started = True
+        self._write_head(writer, request.version, status, headers, keep_alive)
+        if has_body:
+            for written_data in written:
+                await self._write_body(writer, written_data, chunked)
+
+        if isinstance(result, FileWrapper) and content_length is not None and has_body:
+            filelike = result.filelike
+            if isinstance(filelike, FileRange):
+                file, offset = filelike.file, filelike.offset
+            else:
+                file, offset = filelike, filelike.tell()
+            await asyncio.wait_for(writer.drain(), IO_TIMEOUT_SECONDS)
+            count = content_length - sum(len(written_data) for written_data in written)
+            sent = await self._loop.sendfile(writer.transport, file, offset, count)
+            return keep_alive and sent == count
+
+        iterator = iter(result)
+        while True:
+            if isinstance(result, (list, tuple)):
+                data = next(iterator, None)  # no need to bother thread pool
+            else:
+                data = await self._run_blocking(next, iterator, None)
+            if data is None:
+                break
+            if data and has_body:
+                await self._write_body(writer, data, chunked)
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        await asyncio.wait_for(writer.drain(), IO_TIMEOUT_SECONDS)
+        return keep_alive
+
+    @staticmethod
+    async def _write_body(writer: asyncio.StreamWriter, data: bytes, chunked: bool) -> None:
+        if not data:
+            return
+        if chunked:
+            writer.write(b'%x\r\n' % len(data))
+            writer.write(data)
+            writer.write(b'\r\n')
+        else:
+            writer.write(data)
+        await asyncio.wait_for(writer.drain(), IO_TIMEOUT_SECONDS)
+
+    @staticmethod
+    def _write_head(writer: asyncio.StreamWriter, version: str, status: str,
+                    headers: List[Tuple[str, str]], keep_alive: bool) -> None:
+        lines = [f'{version} {status}']
+        lines.extend(f'{name}: {value}' for name, value in headers)
+        lines.append(f'Date: {formatdate(usegmt=True)}')
+        if not keep_alive:
+            lines.append('Connection: close')
+        elif version == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+
+class AsyncioServer(bottle.ServerAdapter):  # type: ignore
+    def run(self, handler: Any) -> None:
+        server = AsyncServer(handler, self.host, self.port, **self.options)
+        server.run()
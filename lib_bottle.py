@@ -2,6 +2,7 @@
 # Copyright 2018-2022 Sergey Kolomenkin
 # Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
 #
+from time import perf_counter
 from typing import Any, Callable, Union
 
 import bottle
@@ -25,3 +26,33 @@ def bottle_get(url_path: str) -> Callable[[AnyFunction], AnyFunction]:
 
 def bottle_post(url_path: str) -> Callable[[AnyFunction], AnyFunction]:
     return bottle.post(url_path)  # type: ignore
+
+
+def bottle_put(url_path: str) -> Callable[[AnyFunction], AnyFunction]:
+    return bottle.put(url_path)  # type: ignore
+
+
+def bottle_delete(url_path: str) -> Callable[[AnyFunction], AnyFunction]:
+    return bottle.delete(url_path)  # type: ignore
+
+
+# Measures time spent in route callbacks: observe(method, rule, seconds).
+# Streamed response bodies are sent after that.
+class RouteTimingPlugin:
+    name = 'route_timing'
+    api = 2
+
+    def __init__(self, observe: Callable[[str, str, float], None]):
+        self._observe = observe
+
+    def apply(self, callback: AnyFunction, route: bottle.Route) -> AnyFunction:
+        method: str = route.method
+        rule: str = route.rule
+
+        def timed_callback(*args: Any, **kwargs: Any) -> Any:
+            time1 = perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                self._observe(method, rule, perf_counter() - time1)
+        return timed_callback
@@ -0,0 +1,63 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import logging
+import os
+
+
+LOGGER = logging.getLogger('cch')
+
+# Written data of large files is dropped from page cache by such steps:
+DROP_STEP = 8 * 1024 * 1024
+# Large downloads ask the kernel to read that much ahead at once:
+READAHEAD_SIZE = 8 * 1024 * 1024
+
+
+# ==========================================
+# Page cache policy for large files.
+# A few huge uploads or downloads would push everything else out of page
+# cache: small shared files and static assets get cold for all other users.
+# Files of at least large_file_size bytes don't stay in cache:
+# - written data is dropped while the file is written and after it is closed
+#   (POSIX_FADV_DONTNEED starts writeback of dirty pages, so every drop also
+#   covers the previous step which is clean by then);
+# - downloads get readahead hints and their data is dropped after sending.
+# Smaller files are cached as usual. Hints are ignored where posix_fadvise()
+# is not available.
+# ==========================================
+
+
+def _fadvise(fd: int, offset: int, length: int, advice: int) -> None:
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError as exc:
+        LOGGER.debug('posix_fadvise(%d, %d, %d, %d) failed: %s', fd, offset, length, advice, repr(exc))
+
+
+class CachePolicy:
+    # large_file_size 0 disables the policy
+    def __init__(self, large_file_size: int):
+        self._large_file_size = large_file_size if hasattr(os, 'posix_fadvise') else 0
+
+    def is_large(self, size: int) -> bool:
+        return 0 < self._large_file_size <= size
+
+    # Called while a file is written; returns offset up to which data is dropped
+    def drop_written(self, fd: int, dropped: int, written: int) -> int:
+        if not self.is_large(written) or written - dropped < DROP_STEP:
+            return dropped
+        start = max(0, dropped - DROP_STEP)
+        _fadvise(fd, start, written - start, os.POSIX_FADV_DONTNEED)
+        return written
+
+    def advise_read(self, fd: int, offset: int, count: int) -> None:
+        if not self.is_large(count):
+            return
+        _fadvise(fd, offset, count, os.POSIX_FADV_SEQUENTIAL)
+        _fadvise(fd, offset, min(count, READAHEAD_SIZE), os.POSIX_FADV_WILLNEED)
+
+    # Called when a large file is written or sent completely (or partly)
+    def drop(self, fd: int, offset: int, count: int, file_size: int) -> None:
+        if self.is_large(file_size) and count > 0:
+            _fadvise(fd, offset, count, os.POSIX_FADV_DONTNEED)
@@ -7,3 +7,11 @@
 
 def get_file_modified_unixtime(pathname: Path) -> float:
     return pathname.stat().st_mtime
+
+
+# Path.unlink(missing_ok=True) requires Python 3.8
+def unlink_if_exists(pathname: Path) -> None:
+    try:
+        pathname.unlink()
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,132 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+
+LOGGER = logging.getLogger('dur')
+
+DURABILITY_MODES = ('none', 'commit', 'periodic')
+
+
+# ==========================================
+# Durability of completed files.
+# Completed file is renamed from the temp directory into storage. Without
+# syncs a crash may leave the new name pointing to a file with no data.
+# - 'none': rename only; data reaches the disk whenever the OS decides;
+# - 'commit': data of the file is synced before rename and the storage
+#   directory after it; upload is acknowledged only then;
+# - 'periodic': group commit. Every upload syncs data of its file itself
+#   (concurrent syncs share journal commits) and queues the rename; a flusher
+#   thread renames all queued files at once and syncs every touched directory
+#   once per batch. Uploads completed while a batch is synced make the next
+#   batch: a lone upload doesn't wait for others, while concurrent uploads
+#   share directory syncs. Every upload is acknowledged after its batch.
+# Flusher thread runs only while there are queued files.
+# ==========================================
+
+
+def _sync_file(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Directories can't be synced on every OS (e.g. Windows); the file is stored anyway
+def _sync_directory(directory: Path) -> None:
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError as exc:
+        LOGGER.debug('Durability: Failed to open directory "%s": %s', directory, repr(exc))
+        return
+    try:
+        os.fsync(fd)
+    except OSError as exc:
+        LOGGER.warning('Durability: Failed to sync directory "%s": %s', directory, repr(exc))
+    finally:
+        os.close(fd)
+
+
+class _QueuedRename:
+    def __init__(self, temp_filename: Path, final_filename: Path):
+        self.temp_filename = temp_filename
+        self.final_filename = final_filename
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class Durability:
+    def __init__(self, mode: str):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f'Unknown durability mode: {mode}')
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._queue: List[_QueuedRename] = []
+        self._flushing = False  # flusher thread is running
+        if mode == 'periodic' and hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    # Moves completely written (and closed) file into storage; returns when it is durable
+    def commit(self, temp_filename: Path, final_filename: Path) -> None:
+        if self.mode == 'none':
+            temp_filename.rename(final_filename)
+        elif self.mode == 'commit':
+            _sync_file(temp_filename)
+            temp_filename.rename(final_filename)
+            _sync_directory(final_filename.parent)
+        else:
+            self._commit_in_group(temp_filename, final_filename)
+
+    def _commit_in_group(self, temp_filename: Path, final_filename: Path) -> None:
+        _sync_file(temp_filename)
+        item = _QueuedRename(temp_filename, final_filename)
+        with self._lock:
+            self._queue.append(item)
+            start_flusher = not self._flushing
+            self._flushing = True
+        if start_flusher:
+            threading.Thread(target=self._flusher_thread_procedure, name='durability', daemon=True).start()
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+
+    def _flusher_thread_procedure(self) -> None:
+        while True:
+            with self._lock:
+                batch = self._queue
+                self._queue = []
+                if not batch:
+                    self._flushing = False
+                    return
+            self._flush(batch)
+
+    @staticmethod
+    def _flush(batch: List[_QueuedRename]) -> None:
+        try:
+            for item in batch:
+                try:
+                    item.temp_filename.rename(item.final_filename)
+                except Exception as exc:  # pylint: disable=broad-except
+                    item.error = exc
+            for directory in {item.final_filename.parent for item in batch if item.error is None}:
+                _sync_directory(directory)
+            LOGGER.debug('Durability: Committed %d files', len(batch))
+        finally:
+            for item in batch:
+                item.done.set()
+
+    # Flusher thread of the parent process doesn't exist in a forked one
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._queue = []
+        self._flushing = False
@@ -2,20 +2,62 @@
 # Copyright 2018-2022 Sergey Kolomenkin
 # Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
 #
+import errno
+import hashlib
+import heapq
 import logging
+import multiprocessing
+import os
 import re
+import shutil
+import sys
 import threading
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from time import sleep, time
-from typing import Any, List, Optional, Sequence
+from time import perf_counter, sleep, time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 from uuid import uuid4
 
-from lib_common import get_file_modified_unixtime
+from lib_cache_policy import CachePolicy
+from lib_common import get_file_modified_unixtime, unlink_if_exists
+from lib_durability import Durability
+from lib_metrics import REGISTRY
+from lib_quota import SpaceAccount, SpaceReservation, StorageLimits
+from lib_storage_journal import StorageJournal
 
 
 LOGGER = logging.getLogger('dat')
 
+# Incomplete uploads which were not written for this time are removed:
+TEMP_FILE_MAX_IDLE_SECONDS = 15 * 60
+
+# How often retention owner looks for changes made by other processes:
+SHARED_INDEX_POLL_SECONDS = 1.0
+
+# Service directories (incomplete uploads, content store, shards, buckets)
+# are kept here, apart from names of uploaded files:
+INTERNAL_DIRECTORY = '.limbo'
+SHARDS_SUBDIRECTORY = f'{INTERNAL_DIRECTORY}/shards'
+BUCKETS_SUBDIRECTORY = f'{INTERNAL_DIRECTORY}/buckets'
+
+# Layouts of stored files (see FileStorage):
+STORAGE_LAYOUTS = ('flat', 'sharded', 'migrate', 'buckets')
+# Name length of shard subdirectories (hex digits of hash): 256 subdirectories
+SHARD_NAME_LENGTH = 2
+# Upload time interval of a bucket directory (buckets layout):
+DEFAULT_BUCKET_SECONDS = 3600
+# Bucket is never removed earlier than this after the end of its interval
+# (file chosen the bucket just before the end may still be committed):
+BUCKET_GRACE_SECONDS = 60
+
+RETENTION_DELETED_FILES = REGISTRY.counter(
+    'limbo_retention_deleted_files_total', 'Files removed by retention', ['kind'])
+RETENTION_DELETED_BYTES = REGISTRY.counter(
+    'limbo_retention_deleted_bytes_total', 'Size of files removed by retention', ['kind'])
+RETENTION_CHECK_SECONDS = REGISTRY.histogram(
+    'limbo_retention_check_seconds', 'Duration of retention checks which found expired files').labels()
+
 
 # ==========================================
 # There are 4 types of file names:
@@ -26,6 +68,14 @@
 # ==========================================
 
 
+def get_file_sha256(pathname: Path) -> str:
+    sha256 = hashlib.sha256()
+    with pathname.open('rb') as file:
+        for data in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
 def clean_filename(filename: str) -> str:
     result = filename
     # https://en.wikipedia.org/wiki/Filename#Reserved_characters_and_words
@@ -38,33 +88,151 @@ def clean_filename(filename: str) -> str:
     # Deny special file names:
     # This is important not to make string longer here!
     result = re.sub(r'^(CON|PRN|AUX|NUL|COM\d|LPT\d)($|\..*)', r'DEV\2', result, flags=re.IGNORECASE)
+    # Deny name of the internal directory:
+    result = re.sub(r'^\.(limbo)$', r'_\1', result, flags=re.IGNORECASE)
     result = 'EMPTY' if result == '' else result
     return result
 
 
+# Reserves disk space of a file at once: it fails early (ENOSPC) when the disk
+# is full and keeps the file less fragmented. Returns False where it is not supported.
+def preallocate(fd: int, size: int) -> bool:
+    if not hasattr(os, 'posix_fallocate') or size <= 0:
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as exc:
+        if exc.errno == errno.ENOSPC:
+            raise
+        return False  # file system does not support it; never mind
+    return True
+
+
 class AtomicFile:
-    def __init__(self, temp_filename: Path, final_filename: Path):
-        if final_filename.is_file():
-            raise Exception('Destination file already exists')
+    # final_filename may be a function which chooses the path when the file is committed
+    def __init__(self, temp_filename: Path, final_filename: Union[Path, Callable[[], Path]],
+                 on_commit: Optional[Callable[[Path, Optional[str]], None]] = None,
+                 size_hint: Optional[int] = None, hash_content: bool = False,
+                 reservation: Optional[SpaceReservation] = None, cache_policy: Optional[CachePolicy] = None,
+                 durability: Optional[Durability] = None):
+        if isinstance(final_filename, Path) and final_filename.is_file():
+            raise FileExistsError(f'Destination file already exists: {final_filename}')
         self._temp_filename: Path = temp_filename
-        self._final_filename: Path = final_filename
+        self._final_filename = final_filename
+        self._on_commit = on_commit
+        # Space in storage is released when the file is closed:
+        self._reservation = reservation
+        self._written = 0
+        self._allocated = 0  # preallocated size; the file is truncated to the written size on commit
+        self._cache_policy = cache_policy
+        self._cache_dropped = 0  # written data up to this offset is dropped from page cache
+        self._durability = durability
+        # Data is hashed on the way to disk, so it is never read back:
+        self._hash = hashlib.sha256() if hash_content else None
         self._fd = self._temp_filename.open('wb')  # pylint: disable=consider-using-with
+        if size_hint:
+            self._preallocate(size_hint)
 
-    def write(self, data: bytes) -> None:
+    # Size hint may be an upper bound of the file size (e.g. size of multipart request body)
+    def _preallocate(self, size: int) -> None:
+        try:
+            if preallocate(self._fd.fileno(), size):
+                self._allocated = size
+        except OSError:
+            self.abort()
+            raise
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        self._written += len(data)
+        if self._reservation is not None:
+            self._reservation.ensure(self._written)
         self._fd.write(data)
+        if self._hash is not None:
+            self._hash.update(data)
+        if self._cache_policy is not None:
+            self._cache_dropped = self._cache_policy.drop_written(self._fd.fileno(), self._cache_dropped, self._written)
+
+    @property
+    def content_digest(self) -> Optional[str]:
+        return None if self._hash is None else self._hash.hexdigest()
 
     def close(self) -> None:
+        self._finish_writing()
+        self._fd.close()
+        self._release()
+        self._commit()
+
+    def abort(self) -> None:
+        # Incomplete file is useless; don't wait for retention to remove it
         self._fd.close()
-        self._temp_filename.rename(self._final_filename)
+        self._release()
+        unlink_if_exists(self._temp_filename)
+
+    def _finish_writing(self) -> None:
+        if self._allocated > self._written:
+            self._fd.truncate(self._written)
+        if self._cache_policy is not None:
+            self._fd.flush()
+            self._cache_policy.drop(self._fd.fileno(), 0, self._written, self._written)
+
+    def _release(self) -> None:
+        if self._reservation is not None:
+            self._reservation.release()
+
+    def _commit(self) -> None:
+        if isinstance(self._final_filename, Path):
+            final_filename = self._final_filename
+        else:
+            try:
+                final_filename = self._final_filename()
+            except BaseException:
+                unlink_if_exists(self._temp_filename)
+                raise
+        if self._durability is not None:
+            self._durability.commit(self._temp_filename, final_filename)
+        else:
+            self._temp_filename.rename(final_filename)
+        if self._on_commit is not None:
+            self._on_commit(final_filename, self.content_digest)
 
     def __enter__(self) -> 'AtomicFile':
         return self
 
     def __exit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        if exc_tb is None:
+            self._finish_writing()
         self._fd.close()
+        self._release()
         if exc_tb is None:
             # No exception, so rename
-            self._temp_filename.rename(self._final_filename)
+            self._commit()
+
+
+# ==========================================
+# Storage shared by several processes (optional).
+# Every process keeps its own index. Every change of the storage is
+# appended to the shared journal (see lib_storage_journal) and advances
+# the shared generation counter; a process which finds the counter changed
+# by somebody else applies new journal records to its index before using it.
+# Storage directory is scanned again only when a process has missed
+# journal records (see lib_storage_journal).
+# Only one process (retention owner) removes outdated files; temp files
+# of other processes are passed to it by the journal too.
+# ==========================================
+
+
+class StorageGeneration:
+    # Must be created before worker processes are forked
+    def __init__(self) -> None:
+        self._value: Any = multiprocessing.Value('Q', 0)
+
+    def get(self) -> int:
+        return int(self._value.value)
+
+    def advance(self) -> int:
+        with self._value.get_lock():
+            self._value.value += 1
+            return int(self._value.value)
 
 
 @dataclass
@@ -72,27 +240,137 @@ class DisplayFileItem:
     full_disk_filename: Path
     url_filename: str
     display_filename: str
+    size: int
+    modified_unixtime: float
+
+
+@dataclass
+class IndexedFile:
+    size: int
+    modified_unixtime: float
+    content_digest: Optional[str] = None  # name in content store if the file is linked there
+    subdirectory: str = ''  # directory of the file relative to storage directory ('' in flat layout)
+
+
+@dataclass(order=True)
+class RetentionEntry:
+    due_unixtime: float
+    kind: str  # 'file', 'temp' or 'bucket'
+    name: str  # disk file name; subdirectory for bucket
+
+
+@dataclass
+class StorageUsage:
+    files: int
+    size: int
+    incomplete_files: int  # uploads in progress and abandoned ones
+    incomplete_size: int
 
 
 @dataclass
 class StorageFileItem:
-    storage_directory: Path
+    storage_directory: Path  # directory which holds the file (subdirectory in sharded and buckets layouts)
     disk_filename: str
     display_filename: str
+    size: int
+    modified_unixtime: float
+
+
+# ==========================================
+# Storage layouts.
+# flat: files are kept in the storage directory itself.
+# sharded: files are spread over subdirectories of 'shards' directory by hash
+#   of disk file name, so no directory gets huge with 100k+ files. Files stored
+#   in flat layout before are still served in place until they expire.
+# migrate: as sharded; files of flat layout are moved to shards at startup.
+# buckets: files are stored in subdirectories of 'buckets' directory by upload
+#   time (one per hour by default). Retention has a single entry per bucket:
+#   it is due when the newest file of the bucket expires (but not before the end
+#   of bucket interval), and the whole bucket is removed at once. Files of closed
+#   buckets may outlive max store time by up to one bucket interval. Bucket of
+#   a file is chosen when its upload is complete, so long uploads never write
+#   into buckets which may be removed already.
+# Files of all layouts are indexed in any mode, so the layout of an existing
+# storage may be changed at any restart.
+# ==========================================
+
+
+def get_shard_name(disk_filename: str) -> str:
+    return hashlib.sha256(disk_filename.encode('utf-8')).hexdigest()[:SHARD_NAME_LENGTH]
+
+
+def get_bucket_start_unixtime(bucket_subdirectory: str) -> int:
+    return int(bucket_subdirectory.rsplit('/', 1)[1])
+
+
+# ==========================================
+# Deduplication (optional).
+# Content of uploaded files is hashed while it is written.
+# Content store directory has a hardlink named by SHA-256 digest for every
+# distinct content. Stored file with the same content becomes one more hardlink
+# to that inode instead of a new copy. Content store entry is removed when
+# it is the only link left.
+# Hardlinks share modification time: it is updated on every new link,
+# so older names may live longer after service restart.
+# ==========================================
 
 
 class FileStorage:
-    def __init__(self, storage_directory: Path, max_store_time_seconds: int):
-        LOGGER.info('FileStorage: create("%s", max %d sec)', storage_directory, max_store_time_seconds)
+    def __init__(self, storage_directory: Path, max_store_time_seconds: int, deduplicate: bool = False,
+                 limits: Optional[StorageLimits] = None, layout: str = 'flat',
+                 bucket_seconds: int = DEFAULT_BUCKET_SECONDS, cache_policy: Optional[CachePolicy] = None,
+                 durability: Optional[Durability] = None):
+        LOGGER.info('FileStorage: create("%s", max %d sec, %s layout)', storage_directory, max_store_time_seconds,
+                    layout)
+        if layout not in STORAGE_LAYOUTS:
+            raise ValueError(f'Unknown storage layout: {layout}')
         self._storage_directory: Path = storage_directory.absolute()
-        self._temp_directory: Path = self._storage_directory / 'incomplete'
+        self._internal_directory: Path = self._storage_directory / INTERNAL_DIRECTORY
+        self._temp_directory: Path = self._internal_directory / 'incomplete'
+        self._content_directory: Path = self._internal_directory / 'content'
+        self._times_directory: Path = self._internal_directory / 'times'
+        self._shards_directory: Path = self._storage_directory / SHARDS_SUBDIRECTORY
+        self._buckets_directory: Path = self._storage_directory / BUCKETS_SUBDIRECTORY
+        self._layout = layout
+        self._bucket_seconds = max(1, bucket_seconds)
         self._max_store_time_seconds = max_store_time_seconds
+        self._deduplicate = deduplicate
+        self._cache_policy = cache_policy
+        self._durability = durability or Durability('none')
+        # Serializes linking and unlinking of content store entries:
+        self._protect_content = threading.Lock()
         self._retention_thread: Optional[threading.Thread] = None
         self._protect_stop = threading.Lock()
         self._condition_stop = threading.Condition(self._protect_stop)
         self._stopping = False
+        # In-memory metadata of completed files: disk file name -> size and mtime.
+        # It is filled once here and then kept current by every storage change,
+        # so listings never need to touch the file system.
+        self._protect_index = threading.Lock()
+        self._index: Dict[str, IndexedFile] = {}
+        self._index_size = 0  # total size of indexed files
+        # Min-heap of expiry times (protected by the index lock).
+        # Entries are never removed from the middle: an entry is checked
+        # against the index (or the temp file) when it becomes due.
+        self._retention_heap: List[RetentionEntry] = []
+        # Counter of index changes (protected by the index lock):
+        self._index_generation = 0
+        # Bucket subdirectory -> modification time of its newest file (protected by the index lock):
+        self._buckets: Dict[str, float] = {}
+        self._owns_retention = True
+        # Storage changes made by other processes:
+        self._generation: Optional[StorageGeneration] = None
+        self._journal: Optional[StorageJournal] = None
+        self._known_generation = 0
+        self._protect_refresh = threading.Lock()
+        self._space = SpaceAccount(self._storage_directory, limits or StorageLimits(),
+                                   self._get_stored_totals, self._evict_oldest_files)
 
+        self._migrate_internal_directories()
         self._create_dirs()
+        if layout == 'migrate':
+            self._migrate_flat_files()
+        self._load_index()
 
     def start(self) -> None:
         LOGGER.info('FileStorage: start')
@@ -107,61 +385,203 @@ def stop(self) -> None:
         if self._retention_thread is not None:
             self._retention_thread.join()
 
+    def share_between_processes(self, generation: StorageGeneration) -> None:
+        with self._protect_refresh:
+            self._generation = generation
+            self._journal = StorageJournal(self._internal_directory / 'journal')
+            self._known_generation = generation.get()
+
+    # Called in a forked worker process: retention is left to the parent process
+    def detach_retention(self) -> None:
+        # Locks could be held by parent's threads at the moment of fork:
+        self._protect_content = threading.Lock()
+        self._protect_stop = threading.Lock()
+        self._condition_stop = threading.Condition(self._protect_stop)
+        self._protect_index = threading.Lock()
+        self._protect_refresh = threading.Lock()
+        if self._journal is not None:
+            self._journal.after_fork()
+        self._space = SpaceAccount(self._storage_directory, self._space.limits,
+                                   self._get_stored_totals, self._evict_oldest_files)
+        self._retention_thread = None
+        self._owns_retention = False
+        self._retention_heap = []
+
     def enumerate_files(self) -> Sequence[DisplayFileItem]:
-        if not self._storage_directory.is_dir():
-            return []
+        self._refresh_index()
+        with self._protect_index:
+            index_items = list(self._index.items())
         files: List[DisplayFileItem] = []
-        for disk_filename in self._storage_directory.iterdir():
-            if disk_filename.is_file():
-                url_filename = self._fname_disk_to_url(disk_filename.name)
-                display_filename = self._fname_disk_to_display(disk_filename.name)
-                files.append(DisplayFileItem(
-                    full_disk_filename=disk_filename,
-                    url_filename=url_filename,
-                    display_filename=display_filename,
-                ))
+        for disk_filename, indexed in index_items:
+            files.append(DisplayFileItem(
+                full_disk_filename=self._get_file_path(disk_filename, indexed.subdirectory),
+                url_filename=self._fname_disk_to_url(disk_filename),
+                display_filename=self._fname_disk_to_display(disk_filename),
+                size=indexed.size,
+                modified_unixtime=indexed.modified_unixtime,
+            ))
         return files
 
-    def open_file_writer(self, original_filename: str) -> AtomicFile:
+    # Changes whenever the list of files may change; allows to cache what is built from the list
+    def get_generation(self) -> int:
+        self._refresh_index()
+        with self._protect_index:
+            return self._index_generation
+
+    def get_usage(self) -> StorageUsage:
+        self._refresh_index()
+        with self._protect_index:
+            sizes = [indexed.size for indexed in self._index.values()]
+        incomplete_sizes: List[int] = []
+        for file in self._temp_directory.iterdir():
+            try:
+                incomplete_sizes.append(file.stat().st_size)
+            except FileNotFoundError:
+                pass  # upload is completed right now
+        return StorageUsage(files=len(sizes), size=sum(sizes),
+                            incomplete_files=len(incomplete_sizes), incomplete_size=sum(incomplete_sizes))
+
+    def open_file_writer(self, original_filename: str, size_hint: Optional[int] = None) -> AtomicFile:
         self._create_dirs()
         disk_filename = self._fname_original_to_disk(original_filename)
         temp_disk_filename = f'{uuid4().hex}.{disk_filename}'
         temp_fullname = self._temp_directory / temp_disk_filename
-        fullname = self._storage_directory / disk_filename
+        self._check_new_file(disk_filename)
+        fullname: Union[Path, Callable[[], Path]] = self._storage_directory / disk_filename
+        if self._layout != 'flat':
+            fullname = partial(self._get_new_file_path, disk_filename)
         LOGGER.info('FileStorage: Upload file: %s', disk_filename)
-        return AtomicFile(temp_fullname, fullname)
+        reservation = self._space.reserve(size_hint or 0)
+        try:
+            writer = AtomicFile(temp_fullname, fullname, on_commit=self._on_file_committed,
+                                size_hint=size_hint, hash_content=self._deduplicate, reservation=reservation,
+                                cache_policy=self._cache_policy, durability=self._durability)
+        except BaseException:
+            reservation.release()
+            raise
+        self._schedule_retention(RetentionEntry(time() + TEMP_FILE_MAX_IDLE_SECONDS, 'temp', temp_disk_filename))
+        return writer
+
+    def is_file_stored(self, original_filename: str) -> bool:
+        disk_filename = self._fname_original_to_disk(original_filename)
+        self._refresh_index()
+        with self._protect_index:
+            return disk_filename in self._index
+
+    def get_url_filename(self, original_filename: str) -> str:
+        return self._fname_disk_to_url(self._fname_original_to_disk(original_filename))
+
+    # Raises UploadTooLargeError or StorageFullError when a file of that size can't be stored now
+    def check_space(self, size: int) -> None:
+        self.reserve_space(size).release()
+
+    # Reservation is held until it is released; raises UploadTooLargeError or StorageFullError
+    def reserve_space(self, size: int) -> SpaceReservation:
+        return self._space.reserve(size)
+
+    def get_temp_file_path(self, temp_disk_filename: str) -> Path:
+        return self._temp_directory / temp_disk_filename
+
+    # Creates a preallocated (or sparse) temp file which is removed by retention
+    # when it is not written for a while. Raises OSError(ENOSPC) when the disk is full.
+    def create_temp_file(self, temp_disk_filename: str, size: int) -> Path:
+        self._create_dirs()
+        temp_fullname = self.get_temp_file_path(temp_disk_filename)
+        with temp_fullname.open('xb') as file:
+            try:
+                if not preallocate(file.fileno(), size):
+                    file.truncate(size)
+            except OSError:
+                file.close()
+                temp_fullname.unlink()
+                raise
+        self._schedule_retention(RetentionEntry(time() + TEMP_FILE_MAX_IDLE_SECONDS, 'temp', temp_disk_filename))
+        return temp_fullname
+
+    # Moves a completely written temp file to storage; returns its URL file name
+    def commit_temp_file(self, temp_fullname: Path, original_filename: str) -> str:
+        disk_filename = self._fname_original_to_disk(original_filename)
+        fullname = self._get_new_file_path(disk_filename)
+        # The file is written in random order, so it can't be hashed on the fly:
+        content_digest = get_file_sha256(temp_fullname) if self._deduplicate else None
+        LOGGER.info('FileStorage: Commit file: %s', disk_filename)
+        self._durability.commit(temp_fullname, fullname)
+        self._on_file_committed(fullname, content_digest)
+        return self._fname_disk_to_url(disk_filename)
 
     def get_file_info_to_read(self, url_filename: str) -> StorageFileItem:
         disk_filename = self._fname_url_to_disk(url_filename)
         display_filename = self._fname_disk_to_display(disk_filename)
+        self._refresh_index()
+        with self._protect_index:
+            indexed = self._index.get(disk_filename)
+        if indexed is None:
+            raise FileNotFoundError(f'File is not found in storage: {disk_filename}')
         return StorageFileItem(
-            storage_directory=self._storage_directory,
+            storage_directory=self._get_file_path(disk_filename, indexed.subdirectory).parent,
             disk_filename=disk_filename,
             display_filename=display_filename,
+            size=indexed.size,
+            modified_unixtime=indexed.modified_unixtime,
         )
 
     def remove_file(self, url_filename: str) -> None:
         disk_filename = self._fname_url_to_disk(url_filename)
-        fullname = self._storage_directory / disk_filename
-        file_size = fullname.stat().st_size
-        LOGGER.info('FileStorage: Remove file: "%s"; size: %d', disk_filename, file_size)
-        fullname.unlink()
+        self._refresh_index()
+        with self._protect_index:
+            indexed = self._index.get(disk_filename)
+        if indexed is None:
+            raise FileNotFoundError(f'File is not found in storage: {disk_filename}')
+        LOGGER.info('FileStorage: Remove file: "%s"; size: %d', disk_filename, indexed.size)
+        self._index_remove(disk_filename)
+        self._get_file_path(disk_filename, indexed.subdirectory).unlink()
+        self._remove_upload_time(disk_filename, indexed)
+        self._notify_changed({'op': 'remove', 'name': disk_filename})
+        self._release_content(indexed.content_digest)
 
     def remove_all_files(self) -> None:
-        if not self._storage_directory.is_dir():
-            return
-        for disk_filename in self._storage_directory.iterdir():
-            if disk_filename.is_file():
-                file_size = disk_filename.stat().st_size
-                LOGGER.info('FileStorage: Remove file: "%s"; size: %d', disk_filename.name, file_size)
-                disk_filename.unlink()
+        self._refresh_index()
+        with self._protect_index:
+            index_items = list(self._index.items())
+        for disk_filename, indexed in index_items:
+            LOGGER.info('FileStorage: Remove file: "%s"; size: %d', disk_filename, indexed.size)
+            self._remove_stored_file(disk_filename, indexed)
         if not self._temp_directory.is_dir():
             return
-        for disk_filename in self._temp_directory.iterdir():
-            if disk_filename.is_file():
-                file_size = disk_filename.stat().st_size
-                LOGGER.info('FileStorage: Remove temp file: "%s"; size: %d', disk_filename.name, file_size)
-                disk_filename.unlink()
+        for temp_filename in self._temp_directory.iterdir():
+            if temp_filename.is_file():
+                file_size = temp_filename.stat().st_size
+                LOGGER.info('FileStorage: Remove temp file: "%s"; size: %d', temp_filename.name, file_size)
+                temp_filename.unlink()
+
+    def _remove_stored_file(self, disk_filename: str, indexed: IndexedFile) -> None:
+        self._index_remove(disk_filename)
+        unlink_if_exists(self._get_file_path(disk_filename, indexed.subdirectory))
+        self._remove_upload_time(disk_filename, indexed)
+        self._notify_changed({'op': 'remove', 'name': disk_filename})
+        self._release_content(indexed.content_digest)
+
+    def _get_stored_totals(self) -> Tuple[int, int]:
+        self._refresh_index()
+        with self._protect_index:
+            return len(self._index), self._index_size
+
+    # Frees space for new uploads before files expire
+    def _evict_oldest_files(self, size: int, files: int) -> None:
+        self._refresh_index()
+        with self._protect_index:
+            index_items = sorted(self._index.items(), key=lambda item: item[1].modified_unixtime)
+        freed_size = 0
+        freed_files = 0
+        for disk_filename, indexed in index_items:
+            if freed_size >= size and freed_files >= files:
+                break
+            LOGGER.warning('FileStorage: Evict file: "%s"; size: %d', disk_filename, indexed.size)
+            self._remove_stored_file(disk_filename, indexed)
+            RETENTION_DELETED_FILES.labels('evicted').inc()
+            RETENTION_DELETED_BYTES.labels('evicted').inc(indexed.size)
+            freed_size += indexed.size
+            freed_files += 1
 
     @classmethod
     def _fname_original_to_disk(cls, original_filename: str) -> str:
@@ -186,29 +606,379 @@ def _canonize_file(filename: str) -> str:
             raise Exception('clean_filename failed to canonize file name', filename)
         return canonized
 
+    def _get_file_path(self, disk_filename: str, subdirectory: str) -> Path:
+        return self._storage_directory / subdirectory / disk_filename
+
+    def _get_subdirectory(self, fullname: Path) -> str:
+        if fullname.parent == self._storage_directory:
+            return ''
+        # Index keeps a lot of equal strings:
+        return sys.intern(fullname.parent.relative_to(self._storage_directory).as_posix())
+
+    # Raises FileExistsError when the file is stored already (possibly in the other layout)
+    def _check_new_file(self, disk_filename: str) -> None:
+        self._refresh_index()
+        with self._protect_index:
+            is_stored = disk_filename in self._index
+        if is_stored:
+            raise FileExistsError(f'File already exists in storage: {disk_filename}')
+
+    # Path for a new file in the current layout (the bucket is chosen by current time)
+    def _get_new_file_path(self, disk_filename: str) -> Path:
+        self._check_new_file(disk_filename)
+        if self._layout == 'buckets':
+            bucket_start = int(time()) // self._bucket_seconds * self._bucket_seconds
+            subdirectory = f'{BUCKETS_SUBDIRECTORY}/{bucket_start}'
+            self._add_bucket(subdirectory, bucket_start)
+        elif self._layout != 'flat':
+            subdirectory = f'{SHARDS_SUBDIRECTORY}/{get_shard_name(disk_filename)}'
+        else:
+            return self._storage_directory / disk_filename
+        fullname = self._get_file_path(disk_filename, subdirectory)
+        fullname.parent.mkdir(mode=0o755, exist_ok=True)
+        return fullname
+
     def _create_dirs(self) -> None:
         if not self._storage_directory.is_dir():
             self._storage_directory.mkdir(mode=0o755)
 
+        if not self._internal_directory.is_dir():
+            self._internal_directory.mkdir(mode=0o755)
+
+        if self._layout in ('sharded', 'migrate') and not self._shards_directory.is_dir():
+            self._shards_directory.mkdir(mode=0o755)
+
+        if self._layout == 'buckets' and not self._buckets_directory.is_dir():
+            self._buckets_directory.mkdir(mode=0o755)
+
         if not self._temp_directory.is_dir():
             self._temp_directory.mkdir(mode=0o755)
 
+        if self._deduplicate and not self._content_directory.is_dir():
+            self._content_directory.mkdir(mode=0o755)
+
+        if self._deduplicate and not self._times_directory.is_dir():
+            self._times_directory.mkdir(mode=0o755)
+
+    # Service directories were kept among stored files before
+    def _migrate_internal_directories(self) -> None:
+        for name in ('incomplete', 'content', 'shards', 'buckets'):
+            directory = self._storage_directory / name
+            # Stored files are never directories:
+            if not directory.is_dir() or (self._internal_directory / name).exists():
+                continue
+            self._internal_directory.mkdir(mode=0o755, exist_ok=True)
+            LOGGER.info('FileStorage: Move directory "%s" to %s', name, INTERNAL_DIRECTORY)
+            directory.rename(self._internal_directory / name)
+
+    def _load_index(self) -> None:
+        index: Dict[str, IndexedFile] = {}
+        buckets = {subdirectory: float(get_bucket_start_unixtime(subdirectory))
+                   for subdirectory in self._iter_bucket_subdirectories()}
+        retention_heap: List[RetentionEntry] = []
+        content_digests = self._load_content_digests()
+        upload_times = self._load_upload_times()
+        for file, subdirectory in self._iter_stored_files(buckets):
+            stat = file.stat()
+            content_digest = content_digests.get(stat.st_ino)
+            # Hardlinks share modification time; other names of the content keep their own times:
+            modified_unixtime = stat.st_mtime
+            if content_digest is not None:
+                modified_unixtime = upload_times.pop(file.name, modified_unixtime)
+            index[file.name] = IndexedFile(
+                size=stat.st_size, modified_unixtime=modified_unixtime,
+                content_digest=content_digest, subdirectory=subdirectory)
+            if subdirectory in buckets:
+                buckets[subdirectory] = max(buckets[subdirectory], modified_unixtime)
+            else:
+                retention_heap.append(
+                    RetentionEntry(modified_unixtime + self._max_store_time_seconds, 'file', file.name))
+        for disk_filename in upload_times:
+            unlink_if_exists(self._times_directory / disk_filename)  # file is removed
+        for subdirectory, newest_unixtime in buckets.items():
+            retention_heap.append(
+                RetentionEntry(self._get_bucket_due_unixtime(subdirectory, newest_unixtime), 'bucket', subdirectory))
+        for file in self._temp_directory.iterdir():
+            if file.is_file():
+                modified_unixtime = get_file_modified_unixtime(file)
+                retention_heap.append(
+                    RetentionEntry(modified_unixtime + TEMP_FILE_MAX_IDLE_SECONDS, 'temp', file.name))
+        heapq.heapify(retention_heap)
+        with self._protect_index:
+            self._index = index
+            self._index_size = sum(indexed.size for indexed in index.values())
+            self._index_generation += 1
+            self._buckets = buckets
+            self._retention_heap = retention_heap
+        LOGGER.info('FileStorage: Indexed %d files', len(index))
+
+    # Files of all layouts with their subdirectories
+    def _iter_stored_files(self, bucket_subdirectories: Iterable[str]) -> Iterator[Tuple[Path, str]]:
+        for file in self._storage_directory.iterdir():
+            if file.is_file():
+                yield file, ''
+        subdirectories = list(bucket_subdirectories)
+        if self._shards_directory.is_dir():
+            subdirectories += [f'{SHARDS_SUBDIRECTORY}/{shard.name}'
+                               for shard in self._shards_directory.iterdir() if shard.is_dir()]
+        for subdirectory in subdirectories:
+            subdirectory = sys.intern(subdirectory)
+            for file in (self._storage_directory / subdirectory).iterdir():
+                if file.is_file():
+                    yield file, subdirectory
+
+    def _iter_bucket_subdirectories(self) -> Iterator[str]:
+        if not self._buckets_directory.is_dir():
+            return
+        for bucket in self._buckets_directory.iterdir():
+            if bucket.is_dir() and bucket.name.isdigit():
+                yield f'{BUCKETS_SUBDIRECTORY}/{bucket.name}'
+
+    def _migrate_flat_files(self) -> None:
+        moved = 0
+        for file in self._storage_directory.iterdir():
+            if not file.is_file():
+                continue
+            fullname = self._get_file_path(file.name, f'{SHARDS_SUBDIRECTORY}/{get_shard_name(file.name)}')
+            fullname.parent.mkdir(mode=0o755, exist_ok=True)
+            if fullname.exists():
+                LOGGER.warning('FileStorage: File is in both layouts, flat one is kept: "%s"', file.name)
+                continue
+            file.rename(fullname)
+            moved += 1
+        LOGGER.info('FileStorage: Moved %d files to shards', moved)
+
+    # Applies changes made by other processes
+    def _refresh_index(self) -> None:
+        if self._generation is None or self._generation.get() == self._known_generation:
+            return
+        with self._protect_refresh:
+            generation = self._generation.get()
+            if generation == self._known_generation:
+                return  # refreshed by another thread
+            assert self._journal is not None
+            changes = self._journal.read()
+            if changes is None:
+                self._load_index()
+            else:
+                self._apply_changes(changes)
+            self._known_generation = generation
+
+    # Change is a journal record: 'add', 'remove', 'remove_bucket' or 'temp' (file of upload in progress)
+    def _notify_changed(self, change: Dict[str, Any]) -> None:
+        if self._generation is None:
+            return
+        with self._protect_refresh:
+            assert self._journal is not None
+            self._journal.append(change)
+            generation = self._generation.advance()
+            # Index stays current unless another process made changes too:
+            if generation == self._known_generation + 1:
+                self._known_generation = generation
+
+    # Only the index is changed: files were changed by the process which made the change
+    def _apply_changes(self, changes: List[Dict[str, Any]]) -> None:
+        if not changes:
+            return
+        retention_entries: List[RetentionEntry] = []
+        with self._protect_index:
+            for change in changes:
+                operation = change['op']
+                if operation == 'add':
+                    entry = self._apply_added_file(change)
+                    if entry is not None:
+                        retention_entries.append(entry)
+                elif operation == 'remove':
+                    removed = self._index.pop(change['name'], None)
+                    if removed is not None:
+                        self._index_size -= removed.size
+                elif operation == 'remove_bucket':
+                    self._buckets.pop(change['subdirectory'], None)
+                    for disk_filename, indexed in list(self._index.items()):
+                        if indexed.subdirectory == change['subdirectory']:
+                            del self._index[disk_filename]
+                            self._index_size -= indexed.size
+                elif operation == 'temp' and self._owns_retention:
+                    retention_entries.append(
+                        RetentionEntry(time() + TEMP_FILE_MAX_IDLE_SECONDS, 'temp', change['name']))
+            self._index_generation += 1
+        for entry in retention_entries:
+            self._schedule_retention(entry)
+
+    # Must be called with the index lock held; returns retention entry of a new file or bucket
+    def _apply_added_file(self, change: Dict[str, Any]) -> Optional[RetentionEntry]:
+        subdirectory = sys.intern(change['subdirectory'])
+        modified_unixtime = change['mtime']
+        replaced = self._index.get(change['name'])
+        if replaced is not None:
+            self._index_size -= replaced.size
+        self._index[change['name']] = IndexedFile(
+            size=change['size'], modified_unixtime=modified_unixtime, content_digest=change['digest'],
+            subdirectory=subdirectory)
+        self._index_size += change['size']
+        if not subdirectory.startswith(f'{BUCKETS_SUBDIRECTORY}/'):
+            return RetentionEntry(modified_unixtime + self._max_store_time_seconds, 'file', change['name'])
+        newest_unixtime = self._buckets.get(subdirectory)
+        self._buckets[subdirectory] = max(newest_unixtime or 0.0, modified_unixtime)
+        if newest_unixtime is not None:
+            return None  # bucket has its entry already
+        return RetentionEntry(self._get_bucket_due_unixtime(subdirectory, modified_unixtime), 'bucket', subdirectory)
+
+    # Returns content store entries by inode number. Unused entries are removed by retention owner
+    # (another process may be linking a new entry right now).
+    def _load_content_digests(self) -> Dict[int, str]:
+        content_digests: Dict[int, str] = {}
+        if not self._content_directory.is_dir():
+            return content_digests
+        for file in self._content_directory.iterdir():
+            stat = file.stat()
+            if stat.st_nlink <= 1:
+                if not self._owns_retention:
+                    continue
+                LOGGER.info('FileStorage: Remove unused content: "%s"; size: %d', file.name, stat.st_size)
+                file.unlink()
+            else:
+                content_digests[stat.st_ino] = file.name
+        return content_digests
+
+    # Returns upload times of names which are links to earlier uploaded content
+    def _load_upload_times(self) -> Dict[str, float]:
+        if not self._times_directory.is_dir():
+            return {}
+        return {file.name: get_file_modified_unixtime(file) for file in self._times_directory.iterdir()}
+
+    def _remove_upload_time(self, disk_filename: str, indexed: IndexedFile) -> None:
+        if indexed.content_digest is not None:
+            unlink_if_exists(self._times_directory / disk_filename)
+
+    def _on_file_committed(self, fullname: Path, content_digest: Optional[str]) -> None:
+        upload_unixtime: Optional[float] = None
+        if content_digest is not None:
+            try:
+                upload_unixtime = self._link_content(fullname, content_digest)
+            except OSError as exc:
+                # File is stored already; it is just not deduplicated
+                LOGGER.warning('FileStorage: Failed to deduplicate "%s": %s', fullname.name, repr(exc))
+                content_digest = None
+        self._refresh_index()
+        with self._protect_index:
+            replaced = self._index.get(fullname.name)
+        self._index_add(fullname, content_digest, upload_unixtime)
+        if replaced is not None:
+            if replaced.subdirectory != self._get_subdirectory(fullname):
+                # Both copies would be found after restart
+                unlink_if_exists(self._get_file_path(fullname.name, replaced.subdirectory))
+            self._release_content(replaced.content_digest)
+
+    # Returns upload time of the name when it is linked to earlier uploaded content.
+    # Modification time of shared inode is left alone: it is upload time of another name.
+    def _link_content(self, fullname: Path, content_digest: str) -> Optional[float]:
+        content_file = self._content_directory / content_digest
+        upload_time_file = self._times_directory / fullname.name
+        with self._protect_content:
+            if not content_file.is_file():
+                os.link(fullname, content_file)
+                unlink_if_exists(upload_time_file)  # left from a replaced file
+                return None
+            # Replace the new copy with a link to the same content:
+            link_filename = self._temp_directory / f'{uuid4().hex}.link'
+            os.link(content_file, link_filename)
+            os.replace(link_filename, fullname)
+            upload_time_file.touch()
+        LOGGER.info('FileStorage: Deduplicated file: "%s"; content: %s', fullname.name, content_digest)
+        return get_file_modified_unixtime(upload_time_file)
+
+    def _release_content(self, content_digest: Optional[str]) -> None:
+        if content_digest is None:
+            return
+        content_file = self._content_directory / content_digest
+        with self._protect_content:
+            try:
+                if content_file.stat().st_nlink <= 1:
+                    content_file.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _index_add(self, fullname: Path, content_digest: Optional[str] = None,
+                   modified_unixtime: Optional[float] = None) -> None:
+        stat = fullname.stat()
+        if modified_unixtime is None:
+            modified_unixtime = stat.st_mtime
+        subdirectory = self._get_subdirectory(fullname)
+        with self._protect_index:
+            replaced = self._index.get(fullname.name)
+            if replaced is not None:
+                self._index_size -= replaced.size
+            self._index[fullname.name] = IndexedFile(
+                size=stat.st_size, modified_unixtime=modified_unixtime, content_digest=content_digest,
+                subdirectory=subdirectory)
+            self._index_size += stat.st_size
+            self._index_generation += 1
+            newest_unixtime = self._buckets.get(subdirectory)
+            if newest_unixtime is not None:
+                self._buckets[subdirectory] = max(newest_unixtime, modified_unixtime)
+        self._notify_changed({'op': 'add', 'name': fullname.name, 'subdirectory': subdirectory, 'size': stat.st_size,
+                              'mtime': modified_unixtime, 'digest': content_digest})
+        if newest_unixtime is None:
+            self._schedule_retention(
+                RetentionEntry(modified_unixtime + self._max_store_time_seconds, 'file', fullname.name))
+
+    # Bucket gets its retention entry when its directory is created
+    def _add_bucket(self, subdirectory: str, bucket_start: int) -> None:
+        with self._protect_index:
+            if subdirectory in self._buckets:
+                return
+            self._buckets[subdirectory] = float(bucket_start)
+        self._schedule_retention(
+            RetentionEntry(self._get_bucket_due_unixtime(subdirectory, bucket_start), 'bucket', subdirectory))
+
+    def _get_bucket_due_unixtime(self, subdirectory: str, newest_unixtime: float) -> float:
+        bucket_end = get_bucket_start_unixtime(subdirectory) + self._bucket_seconds
+        return max(bucket_end + BUCKET_GRACE_SECONDS, newest_unixtime + self._max_store_time_seconds)
+
+    def _index_remove(self, disk_filename: str) -> None:
+        with self._protect_index:
+            removed = self._index.pop(disk_filename, None)
+            if removed is not None:
+                self._index_size -= removed.size
+            self._index_generation += 1
+
+    def _schedule_retention(self, entry: RetentionEntry) -> None:
+        if not self._owns_retention:
+            if entry.kind == 'temp':
+                self._notify_changed({'op': 'temp', 'name': entry.name})
+            return
+        with self._protect_index:
+            heapq.heappush(self._retention_heap, entry)
+            is_first = self._retention_heap[0] is entry
+        if is_first:
+            # Retention thread may sleep longer than needed now:
+            with self._condition_stop:
+                self._condition_stop.notify()
+
+    def _get_retention_wait_seconds(self) -> float:
+        # Files added by other processes are noticed on the next refresh:
+        max_wait = 60.0 if self._generation is None else SHARED_INDEX_POLL_SECONDS
+        with self._protect_index:
+            if not self._retention_heap:
+                return max_wait
+            # Limit the wait to survive system clock adjustments:
+            return min(max_wait, max(0.0, self._retention_heap[0].due_unixtime - time()))
+
     def _retention_thread_procedure(self) -> None:
         LOGGER.info('FileStorage: Retention thread started')
-        previous_check_time: float = 0
         while True:
             try:
-                now = time()
-                if now - previous_check_time > 10 * 60:  # every 10 minutes
-                    LOGGER.info('FileStorage: Check for outdated files')
-                    previous_check_time = time()
-                    self._check_retention()
+                self._refresh_index()
+                if self._journal is not None:
+                    self._journal.rotate()
+                self._check_retention()
 
-                # Wait for 60 seconds with a possibility
+                # Wait until the next file expires with a possibility
                 # to be interrupted through stop() call:
                 with self._condition_stop:
                     if not self._stopping:
-                        self._condition_stop.wait(60)
+                        self._condition_stop.wait(self._get_retention_wait_seconds())
                     if self._stopping:
                         LOGGER.info('Retention thread found stop signal')
                         break
@@ -216,24 +986,100 @@ def _retention_thread_procedure(self) -> None:
                 logging.exception('FileStorage: Retention thread got exception: %s', repr(exc))
                 sleep(60)  # prevent from flooding
 
+    def _pop_due_retention_entry(self, now: float) -> Optional[RetentionEntry]:
+        with self._protect_index:
+            if not self._retention_heap or self._retention_heap[0].due_unixtime > now:
+                return None
+            return heapq.heappop(self._retention_heap)
+
     def _check_retention(self) -> None:
         now = time()
-        if not self._storage_directory.is_dir():
+        time1 = perf_counter()
+        checked = 0
+        while True:
+            entry = self._pop_due_retention_entry(now)
+            if entry is None:
+                break
+            checked += 1
+            if entry.kind == 'temp':
+                self._check_temp_file_retention(entry, now)
+            elif entry.kind == 'bucket':
+                self._check_bucket_retention(entry, now)
+            else:
+                self._check_file_retention(entry, now)
+        if checked:
+            RETENTION_CHECK_SECONDS.observe(perf_counter() - time1)
+
+    def _check_file_retention(self, entry: RetentionEntry, now: float) -> None:
+        with self._protect_index:
+            indexed = self._index.get(entry.name)
+            if indexed is None:
+                return  # removed already
+            if now - indexed.modified_unixtime < self._max_store_time_seconds:
+                return  # file was uploaded again; it has another entry
+            del self._index[entry.name]
+            self._index_size -= indexed.size
+            self._index_generation += 1
+        file = self._get_file_path(entry.name, indexed.subdirectory)
+        LOGGER.info('FileStorage: Remove outdated file: "%s"; size: %d', file, indexed.size)
+        unlink_if_exists(file)
+        self._remove_upload_time(entry.name, indexed)
+        self._notify_changed({'op': 'remove', 'name': entry.name})
+        self._release_content(indexed.content_digest)
+        RETENTION_DELETED_FILES.labels('file').inc()
+        RETENTION_DELETED_BYTES.labels('file').inc(indexed.size)
+
+    # Files of live buckets are never checked one by one
+    def _check_bucket_retention(self, entry: RetentionEntry, now: float) -> None:
+        with self._protect_index:
+            newest_unixtime = self._buckets.get(entry.name)
+            if newest_unixtime is None:
+                return  # removed already
+            due_unixtime = self._get_bucket_due_unixtime(entry.name, newest_unixtime)
+            if due_unixtime <= now:
+                del self._buckets[entry.name]
+        if due_unixtime > now:
+            # Files were added to the bucket after the entry was scheduled
+            self._schedule_retention(RetentionEntry(due_unixtime, 'bucket', entry.name))
             return
-        for file in self._storage_directory.iterdir():
-            if file.is_file():
-                modified_unixtime = get_file_modified_unixtime(file)
-                if now - modified_unixtime > self._max_store_time_seconds:
-                    file_size = file.stat().st_size
-                    LOGGER.info('FileStorage: Remove outdated file: "%s"; size: %d', file, file_size)
-                    file.unlink()
 
-        if not self._temp_directory.is_dir():
+        directory = self._storage_directory / entry.name
+        try:
+            filenames = os.listdir(directory)
+        except FileNotFoundError:
             return
-        for file in self._temp_directory.iterdir():
-            if file.is_file():
-                modified_unixtime = get_file_modified_unixtime(file)
-                if now - modified_unixtime > 15 * 60:  # every 15 minutes
-                    file_size = file.stat().st_size
-                    LOGGER.info('FileStorage: Remove outdated temp file: "%s"; size: %d', file, file_size)
-                    file.unlink()
+        removed: List[Tuple[str, IndexedFile]] = []
+        with self._protect_index:
+            for disk_filename in filenames:
+                indexed = self._index.get(disk_filename)
+                if indexed is not None and indexed.subdirectory == entry.name:
+                    del self._index[disk_filename]
+                    self._index_size -= indexed.size
+                    removed.append((disk_filename, indexed))
+            self._index_generation += 1
+        removed_size = sum(indexed.size for _, indexed in removed)
+        LOGGER.info('FileStorage: Remove outdated bucket: "%s"; files: %d; size: %d',
+                    directory, len(removed), removed_size)
+        shutil.rmtree(directory, ignore_errors=True)
+        self._notify_changed({'op': 'remove_bucket', 'subdirectory': entry.name})
+        for disk_filename, indexed in removed:
+            self._remove_upload_time(disk_filename, indexed)
+            self._release_content(indexed.content_digest)
+        RETENTION_DELETED_FILES.labels('file').inc(len(removed))
+        RETENTION_DELETED_BYTES.labels('file').inc(removed_size)
+
+    def _check_temp_file_retention(self, entry: RetentionEntry, now: float) -> None:
+        file = self._temp_directory / entry.name
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            return  # upload is completed or file is removed
+        if now - stat.st_mtime < TEMP_FILE_MAX_IDLE_SECONDS:
+            # Upload is still in progress
+            self._schedule_retention(
+                RetentionEntry(stat.st_mtime + TEMP_FILE_MAX_IDLE_SECONDS, 'temp', entry.name))
+            return
+        LOGGER.info('FileStorage: Remove outdated temp file: "%s"; size: %d', file, stat.st_size)
+        unlink_if_exists(file)
+        RETENTION_DELETED_FILES.labels('temp').inc()
+        RETENTION_DELETED_BYTES.labels('temp').inc(stat.st_size)
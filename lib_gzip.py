@@ -0,0 +1,95 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import gzip
+import threading
+import zlib
+from io import BytesIO
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from lib_http import is_gzip_accepted
+
+
+# Content types worth compressing (images are compressed already):
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# Smaller responses don't win from compression:
+GZIP_MIN_SIZE = 1024
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+# Each representation needs its own strong validator
+def make_gzip_etag(etag: str) -> str:
+    return etag[:-1] + '-gz"'
+
+
+def gzip_bytes(data: bytes, level: int) -> bytes:
+    buffer = BytesIO()
+    # mtime=0 makes compressed data depend on content only
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level, mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buffer.getvalue()
+
+
+# ==========================================
+# On-the-fly compression of responses.
+# CPU usage is bounded by compression level and by number of responses
+# compressed at the same time: when all slots are busy, the response is sent
+# uncompressed instead of waiting. zlib releases GIL while compressing,
+# so compressing responses don't block other threads.
+# ==========================================
+
+
+# WSGI response body compressed block by block
+class GzipStream:
+    def __init__(self, chunks: Iterable[bytes], level: int, on_close: Callable[[], None]):
+        self._chunks = chunks
+        # wbits=31 writes gzip header and trailer:
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self._on_close: Optional[Callable[[], None]] = on_close
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._chunks:
+            data = self._compressor.compress(chunk)
+            if data:
+                yield data
+        yield self._compressor.flush()
+        self.close()
+
+    def close(self) -> None:
+        if self._on_close is None:
+            return
+        on_close, self._on_close = self._on_close, None
+        try:
+            close: Any = getattr(self._chunks, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            on_close()
+
+
+class GzipCompressor:
+    # Level 0 disables compression
+    def __init__(self, level: int, max_streams: int):
+        self._level = max(0, min(level, 9))
+        self._streams = threading.BoundedSemaphore(max(1, max_streams))
+
+    def should_compress(self, content_type: str, size: Optional[int], accept_encoding: Optional[str]) -> bool:
+        return self._level > 0 and is_compressible(content_type) \
+            and (size is None or size >= GZIP_MIN_SIZE) and is_gzip_accepted(accept_encoding)
+
+    # Returns None when too many responses are being compressed right now
+    def compress_stream(self, chunks: Iterable[bytes]) -> Optional[GzipStream]:
+        if not self._streams.acquire(blocking=False):
+            return None
+        return GzipStream(chunks, self._level, self._streams.release)
+
+    # For responses which are compressed once and sent many times
+    def compress_page(self, data: bytes) -> Optional[bytes]:
+        if self._level == 0 or len(data) < GZIP_MIN_SIZE:
+            return None
+        return gzip_bytes(data, self._level)
@@ -0,0 +1,185 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import hashlib
+import re
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence
+
+
+# Requests with more ranges are served with the whole file:
+MAX_RANGES_COUNT = 64
+
+
+@dataclass
+class ByteRange:
+    start: int
+    end: int  # exclusive
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start
+
+    def content_range(self, size: int) -> str:
+        return f'bytes {self.start}-{self.end - 1}/{size}'
+
+
+def make_etag(size: int, modified_unixtime: float) -> str:
+    # Stored files never change after upload, so size and modification time
+    # identify the content well enough for a strong validator:
+    return f'"{size:x}-{int(modified_unixtime * 1000000):x}"'
+
+
+def make_content_etag(content: bytes) -> str:
+    # Equal content gets equal tag in every process of the service:
+    return '"' + hashlib.sha1(content).hexdigest()[:32] + '"'
+
+
+def _parse_etags(header: str) -> List[str]:
+    return re.findall(r'(?:W/)?"[^"]*"', header)
+
+
+def _strip_weak_prefix(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def etag_matches_weak(header: str, etag: str) -> bool:
+    if header.strip() == '*':
+        return True
+    return any(_strip_weak_prefix(item) == etag for item in _parse_etags(header))
+
+
+def etag_matches_strong(header: str, etag: str) -> bool:
+    return any(item == etag for item in _parse_etags(header))
+
+
+# Explicit gzip coding takes precedence over "*"
+def is_gzip_accepted(accept_encoding: Optional[str]) -> bool:
+    qvalues: Dict[str, float] = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.partition(';')
+        qvalue = 1.0
+        name, _, value = params.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                qvalue = float(value)
+            except ValueError:
+                qvalue = 0.0
+        qvalues[coding.strip().lower()] = qvalue
+    return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
+
+
+def parse_http_date(header: str) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def is_not_modified(if_none_match: Optional[str], if_modified_since: Optional[str],
+                    etag: str, modified_unixtime: float) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110, 13.2.2)
+    if if_none_match is not None:
+        return etag_matches_weak(if_none_match, etag)
+    if if_modified_since is not None:
+        since_unixtime = parse_http_date(if_modified_since)
+        # HTTP dates have one second resolution:
+        return since_unixtime is not None and int(modified_unixtime) <= since_unixtime
+    return False
+
+
+def is_range_allowed(if_range: Optional[str], etag: str, modified_unixtime: float) -> bool:
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return etag_matches_strong(if_range, etag)
+    range_unixtime = parse_http_date(if_range)
+    return range_unixtime is not None and int(modified_unixtime) == range_unixtime
+
+
+# Parse "Range: bytes=..." header.
+# Returns None when the header must be ignored (the whole file is sent)
+# and an empty list when none of the ranges is satisfiable (416 reply).
+# Overlapping and adjacent ranges are merged (RFC 7233, 6.1), so the file is
+# never sent more than once; ranges which ask for more than the whole file
+# are ignored.
+def parse_range_header(header: str, size: int) -> Optional[List[ByteRange]]:
+    unit, _, ranges_spec = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    items = ranges_spec.split(',')
+    if len(items) > MAX_RANGES_COUNT:
+        return None
+    ranges: List[ByteRange] = []
+    for item in items:
+        first, dash, last = item.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:  # suffix range: last N bytes
+                suffix_length = int(last)
+                if suffix_length > 0 and size > 0:
+                    ranges.append(ByteRange(max(0, size - suffix_length), size))
+                continue
+            start = int(first)
+            end = int(last) + 1 if last else max(start + 1, size)
+        except ValueError:
+            return None
+        if start < 0 or end <= start:
+            return None
+        if start < size:
+            ranges.append(ByteRange(start, min(end, size)))
+    if sum(byte_range.length for byte_range in ranges) > size:
+        return None
+    return _merge_ranges(ranges)
+
+
+def _merge_ranges(ranges: List[ByteRange]) -> List[ByteRange]:
+    merged: List[ByteRange] = []
+    for byte_range in sorted(ranges, key=lambda item: item.start):
+        if merged and byte_range.start <= merged[-1].end:
+            merged[-1].end = max(merged[-1].end, byte_range.end)
+        else:
+            merged.append(ByteRange(byte_range.start, byte_range.end))
+    return merged
+
+
+def _multipart_part_header(boundary: str, content_type: str, byte_range: ByteRange, size: int) -> bytes:
+    return (
+        f'\r\n--{boundary}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Range: {byte_range.content_range(size)}\r\n'
+        '\r\n'
+    ).encode('latin-1')
+
+
+def _multipart_footer(boundary: str) -> bytes:
+    return f'\r\n--{boundary}--\r\n'.encode('latin-1')
+
+
+def get_multipart_byteranges_length(ranges: Sequence[ByteRange], size: int, content_type: str, boundary: str) -> int:
+    length = len(_multipart_footer(boundary))
+    for byte_range in ranges:
+        length += len(_multipart_part_header(boundary, content_type, byte_range, size)) + byte_range.length
+    return length
+
+
+def iter_multipart_byteranges(file: BinaryIO, ranges: Sequence[ByteRange], size: int,
+                              content_type: str, boundary: str, block_size: int) -> Iterator[bytes]:
+    try:
+        for byte_range in ranges:
+            yield _multipart_part_header(boundary, content_type, byte_range, size)
+            file.seek(byte_range.start)
+            remaining = byte_range.length
+            while remaining > 0:
+                data = file.read(min(block_size, remaining))
+                if not data:
+                    raise EOFError('File is truncated')
+                remaining -= len(data)
+                yield data
+        yield _multipart_footer(boundary)
+    finally:
+        file.close()
@@ -0,0 +1,109 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import heapq
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from lib_file_storage import DisplayFileItem
+
+
+# Number of list items serialized at once in streamed response:
+JSON_BATCH_SIZE = 500
+
+SortKey = Tuple[Any, str]
+
+SORT_FIELDS: Dict[str, Callable[[DisplayFileItem], Any]] = {
+    'modified': lambda file: file.modified_unixtime,
+    'name': lambda file: file.display_filename,
+    'size': lambda file: file.size,
+}
+
+
+# ==========================================
+# Pages of file list.
+# Cursor is an opaque token with sort key of the last file on previous page.
+# Next page starts right after that key (not at a numeric offset), so files
+# added or removed between requests never cause skipped or repeated items.
+# ==========================================
+
+
+@dataclass
+class FilesPage:
+    files: List[DisplayFileItem]
+    next_cursor: Optional[str]
+
+
+class FilesQuery:
+    # Raises ValueError on bad parameters; sort is a field name, optionally prefixed by '-' for descending order
+    def __init__(self, sort: str = 'modified', prefix: str = '', cursor: Optional[str] = None,
+                 limit: Optional[int] = None):
+        self._descending = sort.startswith('-')
+        self._sort = sort[1:] if self._descending else sort
+        if self._sort not in SORT_FIELDS:
+            raise ValueError(f'Unknown sort field: {self._sort}')
+        if limit is not None and limit <= 0:
+            raise ValueError(f'Bad limit: {limit}')
+        self._prefix = prefix
+        self._limit = limit
+        self._sort_param = sort
+        self._after: Optional[SortKey] = None if cursor is None else self._decode_cursor(cursor)
+
+    def get_page(self, files: Iterable[DisplayFileItem]) -> FilesPage:
+        get_field = SORT_FIELDS[self._sort]
+        keyed: List[Tuple[SortKey, DisplayFileItem]] = []
+        for file in files:
+            if not file.display_filename.startswith(self._prefix):
+                continue
+            key = (get_field(file), file.url_filename)
+            if self._after is not None and not self._is_after(key, self._after):
+                continue
+            keyed.append((key, file))
+
+        if self._limit is None or len(keyed) <= self._limit:
+            keyed.sort(key=lambda item: item[0], reverse=self._descending)
+            return FilesPage(files=[file for _, file in keyed], next_cursor=None)
+
+        # No need to sort the whole list for a small page:
+        select = heapq.nlargest if self._descending else heapq.nsmallest
+        selected = select(self._limit, keyed, key=lambda item: item[0])
+        return FilesPage(files=[file for _, file in selected],
+                         next_cursor=self._encode_cursor(selected[-1][0]))
+
+    def _is_after(self, key: SortKey, after: SortKey) -> bool:
+        return key < after if self._descending else key > after
+
+    def _encode_cursor(self, key: SortKey) -> str:
+        data = json.dumps([self._sort_param, key[0], key[1]], separators=(',', ':'))
+        return urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def _decode_cursor(self, cursor: str) -> SortKey:
+        try:
+            padding = '=' * (-len(cursor) % 4)
+            cursor_sort, value, url_filename = json.loads(urlsafe_b64decode(cursor + padding))
+        except (ValueError, TypeError) as exc:
+            raise ValueError(f'Bad cursor: {cursor}') from exc
+        if cursor_sort != self._sort_param:
+            raise ValueError(f'Cursor does not match sort order: {cursor}')
+        # Values must be comparable with keys of files:
+        value_types = (str,) if self._sort == 'name' else (int, float)
+        if not isinstance(value, value_types) or isinstance(value, bool) or not isinstance(url_filename, str):
+            raise ValueError(f'Bad cursor: {cursor}')
+        return value, url_filename
+
+
+# Compact JSON array serialized by parts
+def iter_json_list(items: Sequence[Any]) -> Iterator[bytes]:
+    if not items:
+        yield b'[]'
+        return
+    separator = '['
+    for start in range(0, len(items), JSON_BATCH_SIZE):
+        batch = items[start:start + JSON_BATCH_SIZE]
+        text = ','.join(json.dumps(item, separators=(',', ':')) for item in batch)
+        yield (separator + text).encode('utf-8')
+        separator = ','
+    yield b']'
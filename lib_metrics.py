@@ -0,0 +1,331 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import json
+import logging
+import os
+import threading
+from bisect import bisect_left
+from pathlib import Path
+from typing import Callable, Dict, Generic, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+
+LOGGER = logging.getLogger('met')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of histogram buckets (seconds):
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# How often every process saves its values in pre-fork mode:
+SNAPSHOT_INTERVAL_SECONDS = 5.0
+
+Labels = Tuple[str, ...]
+# Name, help text and value of a gauge computed at collection time:
+CollectedGauge = Tuple[str, str, float]
+
+
+# ==========================================
+# Metrics in Prometheus text format.
+# Hot paths never take locks: every thread updates its own cell of a metric
+# and cells are summed up only when metrics are collected. Lock is taken
+# just once per thread and metric, when the cell is created. Cells of
+# finished threads are added to a common cell and dropped (when a cell
+# is created or metrics are collected), so short-lived threads don't
+# make the list of cells grow.
+# In pre-fork mode every process saves its values to a snapshot file
+# from time to time; the process which serves /metrics adds up
+# snapshots of the others (see share_between_processes()).
+# ==========================================
+
+
+class _Shards:
+    def __init__(self, size: int):
+        self._size = size
+        self._local = threading.local()
+        # Cells of threads which may still be running (protected by _lock):
+        self._cells: List[Tuple[threading.Thread, List[float]]] = []
+        # Sum of cells of finished threads (protected by _lock):
+        self._retired = [0.0] * size
+        self._lock = threading.Lock()
+
+    def get_cell(self) -> List[float]:
+        try:
+            cell: List[float] = self._local.cell
+        except AttributeError:
+            cell = [0.0] * self._size
+            with self._lock:
+                self._retire_finished_threads()
+                self._cells.append((threading.current_thread(), cell))
+            self._local.cell = cell
+        return cell
+
+    def get_total(self) -> List[float]:
+        with self._lock:
+            self._retire_finished_threads()
+            cells = [cell for _thread, cell in self._cells]
+            total = list(self._retired)
+        for cell in cells:
+            for index, value in enumerate(cell):
+                total[index] += value
+        return total
+
+    def after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._retired = [0.0] * self._size
+        for _thread, cell in self._cells:
+            cell[:] = [0.0] * self._size
+
+    # Finished thread never touches its cell again
+    def _retire_finished_threads(self) -> None:
+        running: List[Tuple[threading.Thread, List[float]]] = []
+        for thread, cell in self._cells:
+            if thread.is_alive():
+                running.append((thread, cell))
+            else:
+                for index, value in enumerate(cell):
+                    self._retired[index] += value
+        self._cells = running
+
+
+class Metric:
+    def __init__(self, size: int):
+        self._shards = _Shards(size)
+
+    def get_values(self) -> List[float]:
+        return self._shards.get_total()
+
+    def after_fork(self) -> None:
+        self._shards.after_fork()
+
+
+class Counter(Metric):
+    def __init__(self) -> None:
+        super().__init__(1)
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._shards.get_cell()[0] += amount
+
+
+class Gauge(Counter):
+    def dec(self, amount: float = 1.0) -> None:
+        self._shards.get_cell()[0] -= amount
+
+
+class Histogram(Metric):
+    def __init__(self, buckets: Sequence[float]):
+        # Count of every bucket (the last one is +Inf) and sum of values:
+        super().__init__(len(buckets) + 2)
+        self._buckets = buckets
+
+    def observe(self, value: float) -> None:
+        cell = self._shards.get_cell()
+        cell[bisect_left(self._buckets, value)] += 1
+        cell[-1] += value
+
+
+MetricT = TypeVar('MetricT', bound=Metric)
+
+
+class MetricFamily(Generic[MetricT]):
+    def __init__(self, kind: str, name: str, documentation: str, label_names: Sequence[str],
+                 make_metric: Callable[[], MetricT], buckets: Sequence[float] = ()):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._make_metric = make_metric
+        self._metrics: Dict[Labels, MetricT] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> MetricT:
+        metric = self._metrics.get(values)
+        if metric is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f'Metric {self.name} expects labels {self.label_names}')
+            with self._lock:
+                metric = self._metrics.setdefault(values, self._make_metric())
+        return metric
+
+    def collect(self) -> Dict[Labels, List[float]]:
+        with self._lock:
+            items = list(self._metrics.items())
+        return {labels: metric.get_values() for labels, metric in items}
+
+    # Locks could be held by other threads at the moment of fork
+    def after_fork(self) -> None:
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric.after_fork()
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._families: Dict[str, MetricFamily[Metric]] = {}
+        self._collectors: List[Callable[[], Iterable[CollectedGauge]]] = []
+        self._lock = threading.Lock()
+        self._snapshot_directory: Optional[Path] = None
+        self._stop_snapshots = threading.Event()
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> MetricFamily[Counter]:
+        family = MetricFamily('counter', name, documentation, label_names, Counter)
+        self._register(family)
+        return family
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> MetricFamily[Gauge]:
+        family = MetricFamily('gauge', name, documentation, label_names, Gauge)
+        self._register(family)
+        return family
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> MetricFamily[Histogram]:
+        family = MetricFamily('histogram', name, documentation, label_names,
+                              lambda: Histogram(buckets), buckets=buckets)
+        self._register(family)
+        return family
+
+    # Collector returns gauges which are cheaper to compute on demand (e.g. storage usage)
+    def add_collector(self, collector: Callable[[], Iterable[CollectedGauge]]) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    # Called before worker processes are forked. Every process (including
+    # the parent one) must call start_snapshots() after that.
+    def share_between_processes(self, directory: Path) -> None:
+        self._snapshot_directory = directory
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def start_snapshots(self) -> None:
+        if self._snapshot_directory is None:
+            return
+        thread = threading.Thread(target=self._snapshot_thread_procedure, name='metrics', daemon=True)
+        thread.start()
+
+    def stop_snapshots(self) -> None:
+        self._stop_snapshots.set()
+        self.save_snapshot()
+
+    def save_snapshot(self) -> None:
+        if self._snapshot_directory is None:
+            return
+        values = {family.name: [[list(labels), values] for labels, values in family.collect().items()]
+                  for family in self._get_families()}
+        filename = self._snapshot_directory / f'{os.getpid()}.json'
+        temp_filename = self._snapshot_directory / f'{os.getpid()}.{threading.get_ident()}.tmp'
+        temp_filename.write_text(json.dumps(values), encoding='utf-8')
+        os.replace(temp_filename, filename)
+
+    def render(self) -> str:
+        families = self._get_families()
+        totals = {family.name: family.collect() for family in families}
+        for pid, snapshot in self._load_snapshots():
+            is_alive = _is_process_alive(pid)
+            for family in families:
+                # Gauges of finished processes are meaningless; their counters still count
+                if family.kind == 'gauge' and not is_alive:
+                    continue
+                family_totals = totals[family.name]
+                for label_values, snapshot_values in snapshot.get(family.name, []):
+                    total = family_totals.setdefault(tuple(label_values), [0.0] * len(snapshot_values))
+                    for index, value in enumerate(snapshot_values):
+                        total[index] += value
+
+        lines: List[str] = []
+        for family in families:
+            lines += [f'# HELP {family.name} {_escape_help(family.documentation)}',
+                      f'# TYPE {family.name} {family.kind}']
+            for labels, values in sorted(totals[family.name].items()):
+                label_pairs = list(zip(family.label_names, labels))
+                if family.kind == 'histogram':
+                    lines += _render_histogram(family.name, family.buckets, label_pairs, values)
+                else:
+                    lines.append(f'{family.name}{_format_labels(label_pairs)} {_format_value(values[0])}')
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            for name, documentation, value in collector():
+                lines += [f'# HELP {name} {_escape_help(documentation)}',
+                          f'# TYPE {name} gauge',
+                          f'{name} {_format_value(value)}']
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, family: 'MetricFamily[MetricT]') -> None:
+        with self._lock:
+            if family.name in self._families:
+                raise ValueError(f'Metric {family.name} is registered already')
+            self._families[family.name] = family  # type: ignore
+
+    def _get_families(self) -> 'List[MetricFamily[Metric]]':
+        with self._lock:
+            return list(self._families.values())
+
+    def _load_snapshots(self) -> List[Tuple[int, Dict[str, List[Tuple[List[str], List[float]]]]]]:
+        snapshots: List[Tuple[int, Dict[str, List[Tuple[List[str], List[float]]]]]] = []
+        if self._snapshot_directory is None:
+            return snapshots
+        for file in self._snapshot_directory.glob('*.json'):
+            pid = int(file.stem)
+            if pid == os.getpid():
+                continue  # own values are current
+            try:
+                snapshots.append((pid, json.loads(file.read_text(encoding='utf-8'))))
+            except (OSError, ValueError) as exc:
+                LOGGER.warning('Metrics: Failed to read snapshot "%s": %s', file, repr(exc))
+        return snapshots
+
+    # Forked process starts from zero: values of the parent are in its own snapshot
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._stop_snapshots = threading.Event()
+        for family in self._families.values():
+            family.after_fork()
+
+    def _snapshot_thread_procedure(self) -> None:
+        while not self._stop_snapshots.wait(SNAPSHOT_INTERVAL_SECONDS):
+            try:
+                self.save_snapshot()
+            except OSError as exc:
+                LOGGER.warning('Metrics: Failed to save snapshot: %s', repr(exc))
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _render_histogram(name: str, buckets: Sequence[float], label_pairs: List[Tuple[str, str]],
+                      values: List[float]) -> List[str]:
+    lines: List[str] = []
+    count = 0.0
+    for bound, bucket_count in zip([*map(_format_value, buckets), '+Inf'], values):
+        count += bucket_count
+        lines.append(f'{name}_bucket{_format_labels(label_pairs + [("le", bound)])} {_format_value(count)}')
+    lines.append(f'{name}_sum{_format_labels(label_pairs)} {_format_value(values[-1])}')
+    lines.append(f'{name}_count{_format_labels(label_pairs)} {_format_value(count)}')
+    return lines
+
+
+def _format_labels(label_pairs: Sequence[Tuple[str, str]]) -> str:
+    if not label_pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, value in label_pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(label_pairs, escaped)) + '}'
+
+
+def _escape_help(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# Metrics of the whole application
+REGISTRY = MetricsRegistry()
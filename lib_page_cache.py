@@ -0,0 +1,48 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from lib_http import make_content_etag
+
+
+@dataclass
+class CachedPage:
+    generation: int
+    body: bytes
+    etag: str
+    gzip_body: Optional[bytes] = None
+
+
+# ==========================================
+# Responses built from the list of stored files.
+# A page is rendered once per storage generation and then served from memory.
+# Generation is taken before rendering, so a page rendered from a newer
+# list is at worst rendered once more; an outdated page is never kept.
+# ==========================================
+
+
+class PageCache:
+    # compress() returns None when the page should be sent uncompressed
+    def __init__(self, get_generation: Callable[[], int],
+                 compress: Callable[[bytes], Optional[bytes]] = lambda _: None):
+        self._get_generation = get_generation
+        self._compress = compress
+        self._protect_pages = threading.Lock()
+        self._pages: Dict[str, CachedPage] = {}
+
+    def get(self, name: str, render: Callable[[], bytes]) -> CachedPage:
+        generation = self._get_generation()
+        with self._protect_pages:
+            page = self._pages.get(name)
+        if page is not None and page.generation == generation:
+            return page
+        body = render()
+        page = CachedPage(generation=generation, body=body, etag=make_content_etag(body),
+                          gzip_body=self._compress(body))
+        with self._protect_pages:
+            self._pages[name] = page
+        return page
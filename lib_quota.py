@@ -0,0 +1,148 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import errno
+import logging
+import shutil
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from time import monotonic
+from typing import Callable, Tuple
+
+
+LOGGER = logging.getLogger('quo')
+
+# Free disk space is queried at most that often;
+# space admitted in between is subtracted from the last value:
+DISK_USAGE_CACHE_SECONDS = 1.0
+
+# Uploads of unknown size extend their reservations by such steps (when there is space):
+RESERVATION_STEP = 16 * 1024 * 1024
+
+
+@dataclass
+class StorageLimits:
+    max_bytes: int = 0  # 0 means no limit
+    max_files: int = 0  # 0 means no limit
+    min_free_bytes: int = 0  # disk space left untouched by uploads
+    evict_oldest: bool = False  # remove oldest files instead of rejecting uploads
+
+
+# Upload can never fit into storage limits
+class UploadTooLargeError(ValueError):
+    pass
+
+
+# Upload doesn't fit into storage right now
+class StorageFullError(OSError):
+    def __init__(self, message: str):
+        super().__init__(errno.ENOSPC, message)
+
+
+# ==========================================
+# Space accounting.
+# Every upload reserves its size (when it is known) before the first byte
+# is read. Uploads of unknown size extend their reservation while they are
+# written. Reservations are counted together with stored files, so parallel
+# uploads can't overfill the storage. Totals of stored files come from the
+# storage index; free disk space is cached. Nothing touches the file system
+# on every request.
+# Reservations are local to the process: in pre-fork mode other workers
+# see only what is stored already.
+# ==========================================
+
+
+class SpaceAccount:
+    # get_stored() returns number and size of stored files;
+    # evict(size, files) removes oldest stored files to free that much.
+    def __init__(self, directory: Path, limits: StorageLimits, get_stored: Callable[[], Tuple[int, int]],
+                 evict: Callable[[int, int], None]):
+        self._directory = directory
+        self.limits = limits
+        self._get_stored = get_stored
+        self._evict = evict
+        self._lock = threading.Lock()
+        self._reserved_size = 0
+        self._reserved_files = 0
+        self._disk_free = 0
+        self._disk_checked = float('-inf')
+        self._admitted_since_check = 0
+
+    # Raises UploadTooLargeError or StorageFullError
+    def reserve(self, size: int) -> 'SpaceReservation':
+        self.acquire(size, 1)
+        return SpaceReservation(self, size)
+
+    # Spare space is added to the reservation when it fits; returns reserved size
+    def acquire(self, size: int, files: int, spare: int = 0) -> int:
+        if self.limits.max_bytes and size > self.limits.max_bytes:
+            raise UploadTooLargeError(f'Upload of {size} bytes exceeds storage size limit')
+        with self._lock:
+            for amount in (size + spare, size):
+                if self._get_shortage(amount, files) == (0, 0):
+                    self._add(amount, files)
+                    return amount
+            shortage_size, shortage_files = self._get_shortage(size, files)
+        if not self.limits.evict_oldest:
+            raise StorageFullError(f'Not enough space in storage for {size} bytes')
+        LOGGER.info('SpaceAccount: Evict files to free %d bytes and %d files', shortage_size, shortage_files)
+        self._evict(shortage_size, shortage_files)
+        with self._lock:
+            self._disk_checked = float('-inf')  # space is freed right now
+            if self._get_shortage(size, files) != (0, 0):
+                raise StorageFullError(f'Not enough space in storage for {size} bytes')
+            self._add(size, files)
+        return size
+
+    def release(self, size: int, files: int) -> None:
+        with self._lock:
+            self._reserved_size -= size
+            self._reserved_files -= files
+
+    def _add(self, size: int, files: int) -> None:
+        self._reserved_size += size
+        self._reserved_files += files
+        self._admitted_since_check += size
+
+    # Returns size and number of files to be freed for the new reservation
+    def _get_shortage(self, size: int, files: int) -> Tuple[int, int]:
+        stored_files, stored_size = self._get_stored()
+        shortage_size = max(0, size + self.limits.min_free_bytes - self._get_disk_free())
+        if self.limits.max_bytes:
+            shortage_size = max(shortage_size, stored_size + self._reserved_size + size - self.limits.max_bytes)
+        shortage_files = 0
+        if self.limits.max_files:
+            shortage_files = max(0, stored_files + self._reserved_files + files - self.limits.max_files)
+        return shortage_size, shortage_files
+
+    def _get_disk_free(self) -> int:
+        now = monotonic()
+        if now - self._disk_checked >= DISK_USAGE_CACHE_SECONDS:
+            self._disk_free = shutil.disk_usage(self._directory).free
+            self._disk_checked = now
+            self._admitted_since_check = 0
+        return self._disk_free - self._admitted_since_check
+
+
+class SpaceReservation:
+    def __init__(self, account: SpaceAccount, size: int):
+        self._account = account
+        self._size = size
+        self._files = 1
+
+    # Called with the number of bytes written so far
+    def ensure(self, size: int) -> None:
+        if size <= self._size:
+            return
+        # Only the growth is acquired, so the whole size is checked here:
+        max_bytes = self._account.limits.max_bytes
+        if max_bytes and size > max_bytes:
+            raise UploadTooLargeError(f'Upload of {size} bytes exceeds storage size limit')
+        self._size += self._account.acquire(size - self._size, 0, spare=RESERVATION_STEP)
+
+    def release(self) -> None:
+        self._account.release(self._size, self._files)
+        self._size = 0
+        self._files = 0
@@ -0,0 +1,77 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import hashlib
+import logging
+import mimetypes
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+from lib_gzip import gzip_bytes, is_compressible, make_gzip_etag
+
+
+LOGGER = logging.getLogger('sta')
+
+
+# ==========================================
+# Static assets are read into memory once at startup.
+# Compressible assets also keep a gzip variant.
+# Web page refers to assets with a content hash in URL query
+# (see get_url()), so browsers may cache such responses forever.
+# Requests without the right hash get revalidated responses.
+# ==========================================
+
+
+@dataclass
+class StaticAsset:
+    content_type: str
+    body: bytes
+    gzip_body: Optional[bytes]
+    digest: str  # content hash
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.digest}"'
+
+    @property
+    def gzip_etag(self) -> str:
+        return make_gzip_etag(self.etag)
+
+
+class StaticAssets:
+    def __init__(self, root_directory: Path, exclude: Sequence[str] = ()):
+        self._assets: Dict[str, StaticAsset] = {}
+        for file in sorted(root_directory.rglob('*')):
+            urlpath = file.relative_to(root_directory).as_posix()
+            if file.is_file() and not any(urlpath.startswith(f'{prefix}/') for prefix in exclude):
+                self._assets[urlpath] = self._load(file)
+        LOGGER.info('StaticAssets: Loaded %d files; %d bytes', len(self._assets),
+                    sum(len(asset.body) for asset in self._assets.values()))
+
+    def get(self, urlpath: str) -> Optional[StaticAsset]:
+        return self._assets.get(urlpath)
+
+    # URL changes whenever the asset changes
+    def get_url(self, urlpath: str) -> str:
+        asset = self._assets[urlpath]
+        return f'/static/{urlpath}?v={asset.digest}'
+
+    @staticmethod
+    def _load(file: Path) -> StaticAsset:
+        body = file.read_bytes()
+        content_type = mimetypes.guess_type(file.name)[0] or 'application/octet-stream'
+        gzip_body: Optional[bytes] = None
+        if is_compressible(content_type):
+            compressed = gzip_bytes(body, 9)
+            if len(compressed) < len(body):
+                gzip_body = compressed
+            if content_type.startswith('text/'):
+                content_type += '; charset=UTF-8'
+        return StaticAsset(
+            content_type=content_type,
+            body=body,
+            gzip_body=gzip_body,
+            digest=hashlib.sha1(body).hexdigest()[:16],
+        )
@@ -0,0 +1,120 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+
+LOGGER = logging.getLogger('jrn')
+
+# Journal is replaced by an empty one when it grows bigger:
+MAX_JOURNAL_SIZE = 16 * 1024 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+# ==========================================
+# Journal of storage changes shared by processes.
+# Every change of the storage is appended to the journal as a JSON line
+# (O_APPEND writes of whole lines don't interleave). Every process reads
+# records of the others from its own offset and applies them to its index,
+# so nobody has to scan the storage directory again.
+# Journal is rotated by replacing it with an empty file which starts with
+# the next sequence number. A reader reads the old file up to its end before
+# it switches to the new one; a writer which finds the journal replaced after
+# its append writes the record again to the new file (records may be applied
+# twice; they are idempotent). A reader which has missed a whole file (it was
+# idle during two rotations) has to scan the storage again.
+# ==========================================
+
+
+class StorageJournal:
+    # Records which are in the journal already are not read: they are in the index
+    def __init__(self, path: Path):
+        self._path = path
+        self._lock = threading.Lock()
+        # Records of this journal instance are skipped when they are read:
+        self._writer_id = uuid4().hex
+        if not self._path.is_file():
+            self._create(0)
+        self._write_fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        self._read_fd = os.open(self._path, os.O_RDONLY)
+        self._read_sequence, _ = self._read_header()
+        self._read_offset = os.fstat(self._read_fd).st_size
+
+    # Called in a forked process
+    def after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._writer_id = uuid4().hex
+
+    def append(self, record: Dict[str, Any]) -> None:
+        line = (json.dumps(dict(record, writer=self._writer_id), separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            while True:
+                os.write(self._write_fd, line)
+                if os.fstat(self._write_fd).st_ino == self._path.stat().st_ino:
+                    return
+                # Journal was replaced; readers of the new one may miss the record
+                os.close(self._write_fd)
+                self._write_fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+
+    # Returns records appended by others since the last call;
+    # None when some records are lost (the storage must be scanned again)
+    def read(self) -> Optional[List[Dict[str, Any]]]:
+        records: List[Dict[str, Any]] = []
+        with self._lock:
+            while True:
+                # Journal may be replaced right now: the old one is read to its end first
+                path_inode = self._path.stat().st_ino
+                records.extend(self._read_to_end())
+                if os.fstat(self._read_fd).st_ino == path_inode:
+                    return records
+                os.close(self._read_fd)
+                self._read_fd = os.open(self._path, os.O_RDONLY)
+                sequence, self._read_offset = self._read_header()
+                is_next = sequence == self._read_sequence + 1
+                self._read_sequence = sequence
+                if not is_next:
+                    LOGGER.warning('StorageJournal: Journal records are lost; sequence: %d', sequence)
+                    return None
+
+    # Called by one process only
+    def rotate(self, max_size: int = MAX_JOURNAL_SIZE) -> None:
+        with self._lock:
+            size = self._path.stat().st_size
+            if size < max_size:
+                return
+            with self._path.open('rb') as file:
+                sequence = json.loads(file.readline())['sequence']
+            LOGGER.info('StorageJournal: Rotate journal; size: %d', size)
+            self._create(sequence + 1)
+
+    def _create(self, sequence: int) -> None:
+        temp_path = self._path.with_name(f'{self._path.name}.{self._writer_id}.tmp')
+        temp_path.write_text(json.dumps({'sequence': sequence}) + '\n', encoding='utf-8')
+        os.replace(temp_path, self._path)
+
+    # Returns sequence number of the journal and offset of its first record
+    def _read_header(self) -> Tuple[int, int]:
+        data = os.pread(self._read_fd, READ_BLOCK_SIZE, 0)
+        end = data.index(b'\n') + 1
+        return json.loads(data[:end])['sequence'], end
+
+    def _read_to_end(self) -> List[Dict[str, Any]]:
+        records: List[Dict[str, Any]] = []
+        while True:
+            data = os.pread(self._read_fd, READ_BLOCK_SIZE, self._read_offset)
+            # Line which is being written is read next time:
+            end = data.rfind(b'\n') + 1
+            if not end:
+                return records
+            self._read_offset += end
+            for line in data[:end].splitlines():
+                record = json.loads(line)
+                if record.pop('writer') != self._writer_id:
+                    records.append(record)
@@ -0,0 +1,394 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from queue import Empty, Queue, SimpleQueue
+from time import perf_counter
+from typing import Any, Awaitable, Callable, List, Optional
+
+from streaming_form_data.targets import BaseTarget
+
+from lib_file_storage import AtomicFile
+
+
+LOGGER = logging.getLogger('upl')
+
+READ_CHUNK_SIZE = 64 * 1024
+ASYNC_READ_CHUNK_SIZE = 1024 * 1024
+# Async reading waits for the parser when it is that much ahead:
+ASYNC_MAX_PENDING_SIZE = 8 * 1024 * 1024
+WRITE_BUFFER_SIZE = 256 * 1024
+
+
+# ==========================================
+# Upload is processed by 3 stages connected with bounded queues:
+# 1) reader: request thread reads request body from the network
+# 2) parser: parses multipart body and packs file data into write buffers
+# 3) writer: writes buffers to disk (write-behind)
+# Write buffers are reused. A slow disk does not stop network reading
+# until the queues are full.
+# Multipart request may carry many files; each of them is written to its own
+# AtomicFile and committed as soon as its part ends. Errors accepted by
+# is_file_error fail only the current file: the rest of its data is skipped
+# and the next files are stored as usual.
+# ==========================================
+
+
+@dataclass
+class StageTimings:
+    busy_seconds: float = 0
+    wait_seconds: float = 0
+
+
+@dataclass
+class UploadTimings:
+    read: StageTimings = field(default_factory=StageTimings)
+    parse: StageTimings = field(default_factory=StageTimings)
+    write: StageTimings = field(default_factory=StageTimings)
+
+    def get_bottleneck(self) -> str:
+        stages = {'read': self.read, 'parse': self.parse, 'write': self.write}
+        return max(stages, key=lambda name: stages[name].busy_seconds)
+
+    # https://www.w3.org/TR/server-timing/
+    def get_server_timing_header(self) -> str:
+        return ', '.join((
+            f'read;dur={self.read.busy_seconds * 1000:.1f}',
+            f'parse;dur={self.parse.busy_seconds * 1000:.1f}',
+            f'write;dur={self.write.busy_seconds * 1000:.1f}',
+        ))
+
+
+@dataclass
+class UploadedFile:
+    filename: str  # original file name
+    size: int = 0  # bytes written
+    error: Optional[Exception] = None
+
+
+@dataclass
+class WriteCommand:
+    action: str  # 'start', 'data' or 'finish'
+    filename: str = ''
+    buffer: Optional[bytearray] = None
+    length: int = 0
+
+
+class PipelineFileTarget(BaseTarget):  # type: ignore
+    def __init__(self, pipeline: 'UploadPipeline') -> None:
+        super().__init__()
+        self._pipeline = pipeline
+
+    def on_start(self) -> None:
+        LOGGER.debug('PipelineFileTarget: on_start')
+        self._pipeline.submit(WriteCommand('start', filename=self.multipart_filename))
+
+    def on_data_received(self, chunk: bytes) -> None:
+        LOGGER.debug('PipelineFileTarget: on_data_received: %d bytes', len(chunk))
+        self._pipeline.append_data(chunk)
+
+    def on_finish(self) -> None:
+        LOGGER.debug('PipelineFileTarget: on_finish')
+        self._pipeline.flush_data()
+        self._pipeline.submit(WriteCommand('finish'))
+
+
+# Counterpart of StreamingFormDataParser for requests which body is the file data itself
+class RawBodyParser:
+    def __init__(self, target: BaseTarget, original_filename: str, expected_size: Optional[int]):
+        self._target = target
+        self._target.multipart_filename = original_filename
+        self._expected_size = expected_size
+        self._size = 0
+        self._started = False
+
+    def data_received(self, chunk: bytes) -> None:
+        self._start()
+        self._size += len(chunk)
+        self._target.data_received(chunk)
+
+    def data_ended(self) -> None:
+        self._start()  # empty file is fine too
+        if self._expected_size is not None and self._size != self._expected_size:
+            raise EOFError(f'Request body is truncated: got {self._size} of {self._expected_size} bytes')
+        self._target.finish()
+
+    def _start(self) -> None:
+        if not self._started:
+            self._started = True
+            self._target.start()
+
+
+class UploadPipeline:  # pylint: disable=too-many-instance-attributes
+    # queue_depth == 0 disables background threads: all stages are run by the caller thread.
+    # size_hint is size of the file of raw request body when it is known;
+    # files of multipart body are not preallocated: their sizes are unknown.
+    def __init__(self, open_file_writer: Callable[[str, Optional[int]], AtomicFile], queue_depth: int,
+                 size_hint: Optional[int] = None, is_file_error: Optional[Callable[[Exception], bool]] = None):
+        self._open_file_writer = open_file_writer
+        self._queue_depth = queue_depth
+        self._size_hint = size_hint
+        self._is_file_error = is_file_error
+        self.timings = UploadTimings()
+        self.files: List[UploadedFile] = []
+        self.target = PipelineFileTarget(self)
+
+        self._parse_queue: 'Queue[Optional[bytes]]' = Queue(maxsize=queue_depth)
+        self._write_queue: 'Queue[Optional[WriteCommand]]' = Queue(maxsize=queue_depth)
+        self._free_buffers: 'SimpleQueue[bytearray]' = SimpleQueue()
+        self._buffer: Optional[bytearray] = None
+        self._buffer_length = 0
+        self._writer: Optional[AtomicFile] = None
+        self._errors: List[BaseException] = []
+
+    # data_received() is called by the parser stage for every chunk of request body
+    # and data_ended() is called after the last one.
+    def run(self, read: Callable[[int], bytes], data_received: Callable[[bytes], Any],
+            data_ended: Optional[Callable[[], Any]] = None) -> int:
+        if self._queue_depth <= 0:
+            return self._run_inline(read, data_received, data_ended)
+
+        parser_thread = threading.Thread(
+            target=self._parser_thread_procedure, args=(data_received, data_ended),
+            name='upload-parser', daemon=True)
+        writer_thread = threading.Thread(
+            target=self._writer_thread_procedure, name='upload-writer', daemon=True)
+        parser_thread.start()
+        writer_thread.start()
+
+        size = 0
+        try:
+            while not self._errors:
+                chunk = self._timed_read(read)
+                if not chunk:
+                    break
+                size += len(chunk)
+                time1 = perf_counter()
+                self._parse_queue.put(chunk)
+                self.timings.read.wait_seconds += perf_counter() - time1
+        except Exception as exc:
+            self._errors.append(exc)
+            raise
+        finally:
+            self._parse_queue.put(None)
+            parser_thread.join()
+            writer_thread.join()
+            self._log_timings(size)
+
+        if self._errors:
+            raise self._errors[0]
+        return size
+
+    # Variant of run() for asyncio server: request body is read by the event loop
+    # while the data read before is parsed and written by run_blocking() executor.
+    # Background threads are not used (queue_depth must be 0).
+    async def run_async(self, read: Callable[[int], Awaitable[bytes]], data_received: Callable[[bytes], Any],
+                        data_ended: Optional[Callable[[], Any]],
+                        run_blocking: Callable[..., 'asyncio.Future[Any]']) -> int:
+        assert self._queue_depth <= 0
+        size = 0
+        pending: List[bytes] = []
+        pending_size = 0
+        parsing: Optional['asyncio.Future[Any]'] = None
+        try:
+            while True:
+                chunk = await self._timed_async_read(read)
+                size += len(chunk)
+                pending.append(chunk)
+                pending_size += len(chunk)
+                if parsing is not None and (parsing.done() or not chunk or pending_size >= ASYNC_MAX_PENDING_SIZE):
+                    time1 = perf_counter()
+                    future, parsing = parsing, None
+                    await future
+                    self.timings.read.wait_seconds += perf_counter() - time1
+                # Parser gets all the data which was read while it was busy:
+                if parsing is None and pending_size:
+                    data = b''.join(pending)
+                    pending.clear()
+                    pending_size = 0
+                    parsing = run_blocking(self._timed_parse, data_received, data)
+                if not chunk and parsing is None:
+                    break
+            if data_ended is not None:
+                await run_blocking(data_ended)
+        finally:
+            if parsing is not None:
+                # Writer must not be touched while the executor is using it
+                await asyncio.wait([parsing])
+                if not parsing.cancelled():
+                    parsing.exception()  # the first error is being raised already
+            await run_blocking(self._abort_writer)
+            self._log_timings(size)
+        return size
+
+    def submit(self, command: WriteCommand) -> None:
+        if self._queue_depth <= 0:
+            self._execute(command)
+            return
+        time1 = perf_counter()
+        self._write_queue.put(command)
+        # Parser is blocked by the writer here:
+        self.timings.parse.wait_seconds += perf_counter() - time1
+
+    def append_data(self, chunk: bytes) -> None:
+        offset = 0
+        while offset < len(chunk):
+            if self._buffer is None:
+                self._buffer = self._get_free_buffer()
+                self._buffer_length = 0
+            count = min(len(chunk) - offset, WRITE_BUFFER_SIZE - self._buffer_length)
+            self._buffer[self._buffer_length:self._buffer_length + count] = chunk[offset:offset + count]
+            self._buffer_length += count
+            offset += count
+            if self._buffer_length == WRITE_BUFFER_SIZE:
+                self.flush_data()
+
+    def flush_data(self) -> None:
+        if self._buffer is None:
+            return
+        buffer, length = self._buffer, self._buffer_length
+        self._buffer = None
+        self.submit(WriteCommand('data', buffer=buffer, length=length))
+
+    def _get_free_buffer(self) -> bytearray:
+        try:
+            return self._free_buffers.get_nowait()
+        except Empty:
+            return bytearray(WRITE_BUFFER_SIZE)
+
+    def _timed_read(self, read: Callable[[int], bytes]) -> bytes:
+        time1 = perf_counter()
+        chunk = read(READ_CHUNK_SIZE)
+        self.timings.read.busy_seconds += perf_counter() - time1
+        LOGGER.debug('Got chunk from network: %d bytes', len(chunk))
+        return chunk
+
+    async def _timed_async_read(self, read: Callable[[int], Awaitable[bytes]]) -> bytes:
+        time1 = perf_counter()
+        chunk = await read(ASYNC_READ_CHUNK_SIZE)
+        self.timings.read.busy_seconds += perf_counter() - time1
+        LOGGER.debug('Got chunk from network: %d bytes', len(chunk))
+        return chunk
+
+    def _timed_parse(self, data_received: Callable[[bytes], Any], chunk: bytes) -> None:
+        wait_seconds = self.timings.parse.wait_seconds
+        write_seconds = self.timings.write.busy_seconds
+        time1 = perf_counter()
+        data_received(chunk)
+        elapsed = perf_counter() - time1
+        # Time spent in waiting for the writer (or in writing itself
+        # when there are no background threads) is not parsing:
+        nested_seconds = self.timings.parse.wait_seconds - wait_seconds
+        if self._queue_depth <= 0:
+            nested_seconds += self.timings.write.busy_seconds - write_seconds
+        self.timings.parse.busy_seconds += elapsed - nested_seconds
+
+    def _run_inline(self, read: Callable[[int], bytes], data_received: Callable[[bytes], Any],
+                    data_ended: Optional[Callable[[], Any]]) -> int:
+        size = 0
+        try:
+            while True:
+                chunk = self._timed_read(read)
+                if not chunk:
+                    break
+                size += len(chunk)
+                self._timed_parse(data_received, chunk)
+            if data_ended is not None:
+                data_ended()
+        finally:
+            self._abort_writer()
+            self._log_timings(size)
+        return size
+
+    def _parser_thread_procedure(self, data_received: Callable[[bytes], Any],
+                                 data_ended: Optional[Callable[[], Any]]) -> None:
+        data_is_over = False
+        try:
+            while True:
+                time1 = perf_counter()
+                chunk = self._parse_queue.get()
+                self.timings.parse.wait_seconds += perf_counter() - time1
+                if chunk is None:
+                    data_is_over = True
+                    break
+                if not self._errors:  # skip the rest of data after a failure
+                    self._timed_parse(data_received, chunk)
+            if data_ended is not None and not self._errors:
+                data_ended()
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.exception('Upload parser got exception: %s', repr(exc))
+            self._errors.append(exc)
+            # Unblock the reader:
+            while not data_is_over:
+                data_is_over = self._parse_queue.get() is None
+        finally:
+            self._write_queue.put(None)
+
+    def _writer_thread_procedure(self) -> None:
+        while True:
+            time1 = perf_counter()
+            command = self._write_queue.get()
+            self.timings.write.wait_seconds += perf_counter() - time1
+            if command is None:
+                break
+            if self._errors:
+                continue  # skip the rest of data after a failure
+            try:
+                self._execute(command)
+            except Exception as exc:  # pylint: disable=broad-except
+                LOGGER.exception('Upload writer got exception: %s', repr(exc))
+                self._errors.append(exc)
+        self._abort_writer()
+
+    def _execute(self, command: WriteCommand) -> None:
+        time1 = perf_counter()
+        try:
+            self._execute_command(command)
+        except Exception as exc:
+            if self._is_file_error is None or not self._is_file_error(exc) or not self.files:
+                raise
+            self.files[-1].error = exc
+            self._abort_writer()
+        finally:
+            if command.buffer is not None:
+                self._free_buffers.put(command.buffer)
+            self.timings.write.busy_seconds += perf_counter() - time1
+
+    def _execute_command(self, command: WriteCommand) -> None:
+        if command.action == 'start':
+            self.files.append(UploadedFile(command.filename))
+            self._writer = self._open_file_writer(command.filename, self._size_hint)
+            return
+        if self.files[-1].error is not None:
+            return  # the rest of failed file is skipped
+        assert self._writer is not None
+        if command.action == 'data':
+            assert command.buffer is not None
+            self._writer.write(memoryview(command.buffer)[:command.length])
+            self.files[-1].size += command.length
+        elif command.action == 'finish':
+            writer, self._writer = self._writer, None
+            writer.close()
+
+    def _abort_writer(self) -> None:
+        # File which was not finished by the parser is incomplete
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+            if self.files[-1].error is None:
+                self.files[-1].error = EOFError(f'File is incomplete: {self.files[-1].filename}')
+
+    def _log_timings(self, size: int) -> None:
+        timings = self.timings
+        LOGGER.info(
+            'Upload pipeline: %d bytes; busy: read %.3f s, parse %.3f s, write %.3f s; '
+            'waiting: read %.3f s, parse %.3f s, write %.3f s; bottleneck: %s',
+            size,
+            timings.read.busy_seconds, timings.parse.busy_seconds, timings.write.busy_seconds,
+            timings.read.wait_seconds, timings.parse.wait_seconds, timings.write.wait_seconds,
+            timings.get_bottleneck(),
+        )
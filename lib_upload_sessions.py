@@ -0,0 +1,322 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List
+from uuid import uuid4
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+from lib_common import unlink_if_exists
+from lib_file_storage import FileStorage
+from lib_quota import SpaceReservation
+
+
+LOGGER = logging.getLogger('ses')
+
+WRITE_BLOCK_SIZE = 1024 * 1024
+
+SESSION_ID_REGEX = re.compile(r'^[0-9a-f]{32}$')
+
+
+# ==========================================
+# Resumable uploads (in the spirit of tus protocol).
+# Client creates an upload session for a file of known size, writes chunks
+# at any offsets (possibly in parallel) and finishes the session when
+# all the data is written. Data and state of a session are kept in files
+# of storage temp directory: sessions survive service restart, and
+# abandoned sessions are removed by temp files retention.
+# Chunks of a session may be handled by different worker processes,
+# so sessions are also protected by file locks. Chunks are written under
+# a shared lock of the data file; finish and abort take it exclusively,
+# so no chunk is written into a file which is stored already. Session
+# state is updated under an exclusive lock of the state file.
+# Every session has its own locks: finishing a big session (hashing,
+# syncing) doesn't hold up chunks of other sessions.
+# Space of the whole file is reserved when a session is created and held
+# until the session is finished, aborted or expired (its data file is
+# removed by retention). Reservations are local to the process which has
+# created the session; sessions gone in other processes are noticed when
+# sessions are created, finished or aborted.
+# ==========================================
+
+
+@dataclass
+class UploadSession:
+    session_id: str
+    original_filename: str
+    size: int
+    ranges: List[List[int]] = field(default_factory=list)  # written [start, end) ranges, sorted and merged
+
+    # Size of data written from the file beginning
+    @property
+    def offset(self) -> int:
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    def is_complete(self) -> bool:
+        return self.offset == self.size
+
+    def add_range(self, start: int, end: int) -> None:
+        if start >= end:
+            return
+        merged: List[List[int]] = []
+        for item in sorted(self.ranges + [[start, end]]):
+            if merged and item[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], item[1])
+            else:
+                merged.append(list(item))
+        self.ranges = merged
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = asdict(self)
+        result['offset'] = self.offset
+        return result
+
+
+class _SessionLock:
+    def __init__(self) -> None:
+        # Data of the session is shared by chunk writers and owned exclusively by finish and abort:
+        self.condition = threading.Condition()
+        self.writers = 0
+        self.exclusive = False
+        # Serializes updates of the session state:
+        self.state_lock = threading.Lock()
+        self.users = 0
+
+
+class ChunkWriter:
+    def __init__(self, file: BinaryIO, session: UploadSession, offset: int, length: int):
+        self._file = file
+        # State of the session (updated when the chunk is closed):
+        self.session = session
+        self.length = length
+        self.written = 0
+        file.seek(offset)
+
+    @property
+    def remaining(self) -> int:
+        return self.length - self.written
+
+    def write(self, data: bytes) -> None:
+        if len(data) > self.remaining:
+            raise ValueError(f'Chunk data is longer than {self.length} bytes')
+        self._file.write(data)
+        self.written += len(data)
+
+
+class UploadSessions:
+    def __init__(self, storage: FileStorage):
+        self._storage = storage
+        # Locks of sessions in use (protected by _protect_sessions):
+        self._session_locks: Dict[str, _SessionLock] = {}
+        # Space of sessions created by this process (protected by _protect_sessions):
+        self._reservations: Dict[str, SpaceReservation] = {}
+        self._protect_sessions = threading.Lock()
+
+    # Raises UploadTooLargeError or StorageFullError when the file doesn't fit into storage
+    def create(self, original_filename: str, size: int) -> UploadSession:
+        self._release_expired_reservations()
+        session = UploadSession(uuid4().hex, original_filename, size)
+        LOGGER.info('UploadSessions: Create %s: "%s"; size: %d', session.session_id, original_filename, size)
+        reservation = self._storage.reserve_space(size)
+        try:
+            self._storage.create_temp_file(self._get_data_disk_filename(session.session_id), size)
+            self._storage.create_temp_file(self._get_state_disk_filename(session.session_id), 0)
+            with self._lock_state(session.session_id):
+                self._save(session)
+        except BaseException:
+            reservation.release()
+            unlink_if_exists(self._get_data_file(session.session_id))
+            unlink_if_exists(self._get_state_file(session.session_id))
+            raise
+        with self._protect_sessions:
+            self._reservations[session.session_id] = reservation
+        return session
+
+    def get(self, session_id: str) -> UploadSession:
+        with self._lock_state(session_id):
+            return self._load(session_id)
+
+    # Data which was written before a read failure is kept: the client may resume from there.
+    def write_chunk(self, session_id: str, offset: int, length: int, read: Callable[[int], bytes]) -> UploadSession:
+        with self.open_chunk(session_id, offset, length) as chunk:
+            while chunk.remaining:
+                data = read(min(WRITE_BLOCK_SIZE, chunk.remaining))
+                if not data:
+                    raise EOFError(f'Chunk is truncated: got {chunk.written} of {length} bytes')
+                chunk.write(data)
+        return chunk.session
+
+    # Range of the data written into the chunk is recorded when the chunk is closed (even on error).
+    # The session can't be finished or aborted while a chunk is open.
+    @contextmanager
+    def open_chunk(self, session_id: str, offset: int, length: int) -> Iterator['ChunkWriter']:
+        with self._lock_data(session_id, exclusive=False) as file:
+            session = self.get(session_id)
+            if offset < 0 or length < 0 or offset + length > session.size:
+                raise ValueError(f'Chunk {offset}+{length} is out of file size {session.size}')
+            chunk = ChunkWriter(file, session, offset, length)
+            try:
+                yield chunk
+            finally:
+                file.flush()
+                with self._lock_state(session_id):
+                    session = self._load(session_id)
+                    session.add_range(offset, offset + chunk.written)
+                    self._save(session)
+                chunk.session = session
+
+    # Returns URL file name of the stored file
+    def finish(self, session_id: str) -> str:
+        with self._lock_data(session_id, exclusive=True):
+            session = self.get(session_id)
+            if not session.is_complete():
+                raise ValueError(f'Upload is incomplete: {session.offset} of {session.size} bytes')
+            LOGGER.info('UploadSessions: Finish %s: "%s"', session_id, session.original_filename)
+            url_filename = self._storage.commit_temp_file(
+                self._get_data_file(session_id), session.original_filename)
+            unlink_if_exists(self._get_state_file(session_id))
+        self._release_reservation(session_id)
+        self._release_expired_reservations()
+        return url_filename
+
+    def abort(self, session_id: str) -> None:
+        with self._lock_data(session_id, exclusive=True):
+            self.get(session_id)
+            LOGGER.info('UploadSessions: Abort %s', session_id)
+            unlink_if_exists(self._get_data_file(session_id))
+            unlink_if_exists(self._get_state_file(session_id))
+        self._release_reservation(session_id)
+        self._release_expired_reservations()
+
+    def _release_reservation(self, session_id: str) -> None:
+        with self._protect_sessions:
+            reservation = self._reservations.pop(session_id, None)
+        if reservation is not None:
+            reservation.release()
+
+    # Sessions expire (or are finished by other processes) without notice to this process
+    def _release_expired_reservations(self) -> None:
+        with self._protect_sessions:
+            session_ids = list(self._reservations)
+        for session_id in session_ids:
+            if not self._get_data_file(session_id).is_file():
+                LOGGER.info('UploadSessions: Session is gone: %s', session_id)
+                self._release_reservation(session_id)
+
+    @staticmethod
+    def _get_data_disk_filename(session_id: str) -> str:
+        return f'{session_id}.upload'
+
+    @staticmethod
+    def _get_state_disk_filename(session_id: str) -> str:
+        return f'{session_id}.session'
+
+    def _get_data_file(self, session_id: str) -> Path:
+        return self._storage.get_temp_file_path(self._get_data_disk_filename(session_id))
+
+    def _get_state_file(self, session_id: str) -> Path:
+        return self._storage.get_temp_file_path(self._get_state_disk_filename(session_id))
+
+    @contextmanager
+    def _use_session_lock(self, session_id: str) -> Iterator[_SessionLock]:
+        # Session id becomes a part of file name:
+        if not SESSION_ID_REGEX.match(session_id):
+            raise FileNotFoundError(f'Bad upload session id: {session_id}')
+        with self._protect_sessions:
+            session_lock = self._session_locks.get(session_id)
+            if session_lock is None:
+                session_lock = self._session_locks[session_id] = _SessionLock()
+            session_lock.users += 1
+        try:
+            yield session_lock
+        finally:
+            with self._protect_sessions:
+                session_lock.users -= 1
+                if not session_lock.users:
+                    del self._session_locks[session_id]
+
+    # Yields the data file opened for writing. Chunk writers lock it shared, finish and abort exclusively
+    # (other processes are locked out by the file lock).
+    @contextmanager
+    def _lock_data(self, session_id: str, exclusive: bool) -> Iterator[BinaryIO]:
+        with self._use_session_lock(session_id) as session_lock:
+            with session_lock.condition:
+                session_lock.condition.wait_for(
+                    lambda: not session_lock.exclusive and not (exclusive and session_lock.writers))
+                if exclusive:
+                    session_lock.exclusive = True
+                else:
+                    session_lock.writers += 1
+            try:
+                data_file = self._get_data_file(session_id)
+                try:
+                    file = data_file.open('r+b')
+                except FileNotFoundError as exc:
+                    raise FileNotFoundError(f'Upload session is not found: {session_id}') from exc
+                with file:
+                    if fcntl is not None:
+                        fcntl.flock(file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                    # Session may be finished (its data file stored) while the lock is awaited:
+                    if not self._is_same_file(file, data_file):
+                        raise FileNotFoundError(f'Upload session is not found: {session_id}')
+                    yield file
+            finally:
+                with session_lock.condition:
+                    if exclusive:
+                        session_lock.exclusive = False
+                    else:
+                        session_lock.writers -= 1
+                    session_lock.condition.notify_all()
+
+    # State file is replaced on every save, so the lock is taken again when it was replaced meanwhile
+    @contextmanager
+    def _lock_state(self, session_id: str) -> Iterator[None]:
+        with self._use_session_lock(session_id) as session_lock, session_lock.state_lock:
+            state_file = self._get_state_file(session_id)
+            while True:
+                try:
+                    file = state_file.open('rb')
+                except FileNotFoundError as exc:
+                    raise FileNotFoundError(f'Upload session is not found: {session_id}') from exc
+                with file:
+                    if fcntl is not None:
+                        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+                    if self._is_same_file(file, state_file):
+                        yield
+                        return
+
+    @staticmethod
+    def _is_same_file(file: BinaryIO, path: Path) -> bool:
+        try:
+            return os.fstat(file.fileno()).st_ino == path.stat().st_ino
+        except FileNotFoundError:
+            return False
+
+    def _load(self, session_id: str) -> UploadSession:
+        if not self._get_data_file(session_id).is_file():
+            raise FileNotFoundError(f'Upload session is not found: {session_id}')
+        try:
+            state = json.loads(self._get_state_file(session_id).read_text(encoding='utf-8'))
+        except ValueError as exc:
+            raise FileNotFoundError(f'Upload session is broken: {session_id}') from exc
+        return UploadSession(**state)
+
+    def _save(self, session: UploadSession) -> None:
+        state_file = self._get_state_file(session.session_id)
+        temp_state_file = state_file.with_name(f'{state_file.name}.tmp')
+        temp_state_file.write_text(json.dumps(asdict(session)), encoding='utf-8')
+        os.replace(temp_state_file, state_file)
@@ -0,0 +1,258 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import socket
+from typing import Any, BinaryIO, Callable, Dict, Iterator, Optional, Type, Union
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+import bottle
+
+
+# Block size for servers which have to copy file data through Python:
+FILE_WRAPPER_BLOCK_SIZE = 1024 * 1024
+
+
+# ==========================================
+# Zero-copy file transmission.
+#
+# Bottle passes file-like response bodies to environ['wsgi.file_wrapper'].
+# Our wrapper is recognized by the server adapters below. They transmit
+# wrapped files with os.sendfile() (through socket.sendfile())
+# instead of reading data into Python memory.
+# Servers without such support simply iterate the wrapper by big blocks.
+# ==========================================
+
+
+# File-like object which reads only a part of a file.
+# It is used as a body of responses to requests with a single range.
+class FileRange:
+    # on_close gets the number of bytes transferred
+    def __init__(self, file: BinaryIO, offset: int, count: int, on_close: Optional[Callable[[int], None]] = None):
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self._on_close = on_close
+        self.file.seek(offset)
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.offset + self.count - self.file.tell()
+        if size < 0 or size > remaining:
+            size = remaining
+        return self.file.read(max(0, size))
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def close(self) -> None:
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            # Both reading and sendfile() leave file position after the data sent
+            position = self.offset if self.file.closed else self.file.tell()
+            on_close(min(max(0, position - self.offset), self.count))
+        self.file.close()
+
+
+class FileWrapper:
+    def __init__(self, filelike: Union[BinaryIO, FileRange], blksize: int = FILE_WRAPPER_BLOCK_SIZE):
+        self.filelike = filelike
+        self.blksize = max(blksize, FILE_WRAPPER_BLOCK_SIZE)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                break
+            yield data
+
+    def close(self) -> None:
+        self.filelike.close()
+
+
+def sendfile_to_socket(sock: socket.socket, wrapper: FileWrapper) -> int:
+    # socket.sendfile() uses os.sendfile() where it is available
+    # and falls back to send() otherwise. It also respects socket timeout.
+    filelike = wrapper.filelike
+    if isinstance(filelike, FileRange):
+        return sock.sendfile(filelike.file, filelike.offset, filelike.count)
+    return sock.sendfile(filelike)
+
+
+# ==========================================
+# wsgiref
+# ==========================================
+
+
+# wsgiref passes socket stream as wsgi.input without any limits,
+# so reading past request body end blocks forever.
+# This reader stops at the end of body. Chunked body is decoded like cheroot does.
+class RequestBodyReader:
+    def __init__(self, rfile: BinaryIO, environ: Dict[str, Any]):
+        self._rfile = rfile
+        self._chunked = 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+        # Size of the rest of current chunk (or the whole body when not chunked):
+        self._remaining: Optional[int] = None if self._chunked else int(environ.get('CONTENT_LENGTH') or 0)
+        self._finished = False
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            return b''.join(iter(lambda: self.read(1024 * 1024), b''))
+        while not self._finished:
+            if not self._remaining:
+                if not self._chunked:
+                    self._finished = True
+                    break
+                self._remaining = self._read_chunk_header()
+                continue
+            data = self._rfile.read(min(size, self._remaining))
+            if not data:
+                raise EOFError('Request body is truncated')
+            self._remaining -= len(data)
+            if self._chunked and not self._remaining:
+                self._rfile.readline()  # CRLF after chunk data
+            return data
+        return b''
+
+    def _read_chunk_header(self) -> int:
+        line = self._rfile.readline(1024)
+        if not line.endswith(b'\n'):
+            raise EOFError('Bad chunk header in request body')
+        chunk_size = int(line.split(b';', 1)[0].strip(), 16)
+        if chunk_size == 0:
+            # Skip trailer fields up to the empty line:
+            while self._rfile.readline(65537).strip():
+                pass
+            self._finished = True
+        return chunk_size
+
+
+class WSGIRefServerHandler(ServerHandler):
+    wsgi_file_wrapper = FileWrapper  # type: ignore
+    request_handler: WSGIRequestHandler
+    result: Any
+    headers_sent: bool
+
+    def sendfile(self) -> bool:
+        assert isinstance(self.result, FileWrapper)
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        self.bytes_sent = sendfile_to_socket(self.request_handler.connection, self.result)
+        return True
+
+
+class WSGIRefRequestHandler(WSGIRequestHandler):
+    def address_string(self) -> str:  # Prevent reverse DNS lookups please.
+        return str(self.client_address[0])
+
+    # Copy of WSGIRequestHandler.handle() with another ServerHandler class and wsgi.input
+    def handle(self) -> None:
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():  # An error code has been sent, just exit
+            return
+
+        environ = self.get_environ()
+        environ['wsgi.input_terminated'] = True
+        handler = WSGIRefServerHandler(
+            RequestBodyReader(self.rfile, environ), self.wfile, self.get_stderr(), environ,  # type: ignore
+            multithread=False,
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())  # type: ignore
+
+
+# Several worker processes listen on the same port
+class ReusePortWSGIServer(WSGIServer):
+    def server_bind(self) -> None:
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class WSGIRefServer(bottle.WSGIRefServer):  # type: ignore
+    def run(self, app: Any) -> None:
+        self.options.setdefault('handler_class', WSGIRefRequestHandler)
+        if self.options.pop('reuse_port', False):
+            self.options['server_class'] = ReusePortWSGIServer
+        super().run(app)
+
+
+# ==========================================
+# cheroot
+# ==========================================
+
+
+def _make_cheroot_gateway() -> Type[Any]:
+    from cheroot import wsgi  # pylint: disable=import-outside-toplevel
+
+    class SendfileGateway(wsgi.Gateway_10):
+        def get_environ(self) -> Any:
+            env = super().get_environ()  # type: ignore
+            env['wsgi.file_wrapper'] = FileWrapper
+            return env
+
+        def _can_sendfile(self) -> bool:
+            # TLS connections and chunked responses need data to be transformed:
+            return self.req.server.ssl_adapter is None \
+                and self.remaining_bytes_out is not None \
+                and not self.req.chunked_write
+
+        def respond(self) -> None:
+            response = self.req.server.wsgi_app(self.env, self.start_response)
+            if isinstance(response, FileWrapper) and self._can_sendfile():
+                try:
+                    self.req.ensure_headers_sent()
+                    self.req.conn.wfile.flush()
+                    sent = sendfile_to_socket(self.req.conn.socket, response)
+                    if sent != self.remaining_bytes_out:
+                        # Client would wait for the missing data forever
+                        self.req.close_connection = True
+                finally:
+                    response.close()
+                return
+
+            # Copy of cheroot.wsgi.Gateway.respond() code:
+            try:
+                for chunk in filter(None, response):
+                    if not isinstance(chunk, bytes):
+                        raise ValueError('WSGI Applications must yield bytes')
+                    self.write(chunk)
+            finally:
+                self.req.ensure_headers_sent()
+                if hasattr(response, 'close'):
+                    response.close()
+
+    return SendfileGateway
+
+
+class CherootServer(bottle.ServerAdapter):  # type: ignore
+    def run(self, handler: Any) -> None:
+        from cheroot import wsgi  # pylint: disable=import-outside-toplevel
+        self.options['bind_addr'] = (self.host, self.port)
+        self.options['wsgi_app'] = handler
+        server = wsgi.Server(**self.options)
+        server.gateway = _make_cheroot_gateway()
+        try:
+            server.start()
+        finally:
+            server.stop()
+
+
+def get_server_adapter(server_name: str) -> Union[str, Type[bottle.ServerAdapter]]:
+    adapters = {
+        'wsgiref': WSGIRefServer,
+        'cheroot': CherootServer,
+    }
+    return adapters.get(server_name, server_name)
@@ -0,0 +1,102 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import logging
+import os
+import signal
+import sys
+from time import monotonic, sleep
+from typing import Callable, Dict
+
+
+LOGGER = logging.getLogger('wrk')
+
+# Worker which exits faster is considered broken (e.g. port is busy); it is not restarted:
+MIN_WORKER_LIFETIME_SECONDS = 5.0
+STOP_TIMEOUT_SECONDS = 10.0
+POLL_INTERVAL_SECONDS = 0.5
+
+
+# ==========================================
+# Pre-fork mode.
+# Parent process forks worker processes which serve HTTP on the same port
+# (every worker binds its own socket with SO_REUSEPORT, so the kernel
+# balances connections). Parent process doesn't serve requests itself:
+# it restarts crashed workers and forwards termination to them.
+# POSIX only.
+# ==========================================
+
+
+class WorkerProcesses:
+    def __init__(self, count: int, serve: Callable[[], None]):
+        self._count = count
+        self._serve = serve
+        self._workers: Dict[int, float] = {}  # PID -> start time
+
+    # Runs until is_terminating() returns True or a worker fails right after start
+    def run(self, is_terminating: Callable[[], bool]) -> None:
+        try:
+            for _ in range(self._count):
+                self._start_worker()
+            while not is_terminating():
+                if not self._check_workers():
+                    break
+                sleep(POLL_INTERVAL_SECONDS)
+        except (KeyboardInterrupt, SystemExit):
+            LOGGER.warning('Workers: Caught global exception')
+        finally:
+            self._stop_workers()
+
+    def _start_worker(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self._serve()
+            except BaseException:  # pylint: disable=broad-except
+                LOGGER.exception('Workers: Worker failed')
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # Never return to the code of parent process:
+                os._exit(exit_code)  # pylint: disable=protected-access
+        LOGGER.info('Workers: Started worker PID %d', pid)
+        self._workers[pid] = monotonic()
+
+    # Returns False when workers can't be kept running
+    def _check_workers(self) -> bool:
+        while self._workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            started = self._workers.pop(pid, None)
+            if started is None:
+                continue
+            LOGGER.error('Workers: Worker PID %d exited unexpectedly with status %d', pid, status)
+            if monotonic() - started < MIN_WORKER_LIFETIME_SECONDS:
+                return False
+            self._start_worker()
+        return True
+
+    def _stop_workers(self) -> None:
+        for pid in self._workers:
+            LOGGER.info('Workers: Stop worker PID %d', pid)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = monotonic() + STOP_TIMEOUT_SECONDS
+        while self._workers:
+            pid, _status = os.waitpid(-1, os.WNOHANG)
+            if pid != 0:
+                self._workers.pop(pid, None)
+                continue
+            if monotonic() > deadline:
+                for pid in self._workers:
+                    LOGGER.error('Workers: Kill worker PID %d', pid)
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float('inf')
+            sleep(0.1)
+        LOGGER.info('Workers: All workers are stopped')
@@ -0,0 +1,81 @@
+# Limbo file sharing (https://github.com/kolomenkin/limbo)
+# Copyright 2018-2022 Sergey Kolomenkin
+# Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
+#
+import logging
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from time import localtime
+from typing import Iterable, Iterator, List, Optional, Union
+
+
+LOGGER = logging.getLogger('zip')
+
+# ZIP format can't keep earlier times:
+MIN_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+@dataclass
+class ZipEntry:
+    name: str  # name in archive
+    path: Path
+    size: int
+    modified_unixtime: float
+
+
+# ==========================================
+# ZIP archive generated on the fly.
+# zipfile module writes to an unseekable sink here: every entry gets
+# a data descriptor with CRC and sizes after its data, so the data is
+# read and checksummed in a single pass and nothing is written back.
+# Sink is emptied after every block, so memory usage doesn't depend
+# on sizes of files. ZIP64 records are used for big files.
+# ==========================================
+
+
+# Write-only file object; has no tell(), so zipfile treats it as unseekable
+class _ZipSink:
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def pop(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+# Files which can't be opened (e.g. removed meanwhile) are skipped.
+# compress_level None stores files without compression.
+def iter_zip(entries: Iterable[ZipEntry], block_size: int, compress_level: Optional[int] = None) -> Iterator[bytes]:
+    sink = _ZipSink()
+    compression = zipfile.ZIP_STORED if compress_level is None else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(sink, 'w', compression=compression, compresslevel=compress_level,  # type: ignore
+                         allowZip64=True) as archive:
+        for entry in entries:
+            try:
+                file = entry.path.open('rb')
+            except FileNotFoundError:
+                LOGGER.warning('Zip: File is removed: %s', entry.path)
+                continue
+            info = zipfile.ZipInfo(entry.name, date_time=max(MIN_ZIP_DATE_TIME, localtime(entry.modified_unixtime)[:6]))
+            info.compress_type = compression
+            info.file_size = entry.size  # zipfile decides on ZIP64 records by this size
+            with file, archive.open(info, 'w') as archive_file:
+                while True:
+                    data = file.read(block_size)
+                    if not data:
+                        break
+                    archive_file.write(data)
+                    chunk = sink.pop()
+                    if chunk:
+                        yield chunk
+            yield sink.pop()
+    yield sink.pop()
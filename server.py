@@ -4,29 +4,67 @@
 # Licensed under MIT (https://github.com/kolomenkin/limbo/blob/master/LICENSE)
 #
 import asyncio
+import errno
 import json
 import logging
 import mimetypes
 import os
+import re
+import shutil
 import signal
 import sys
+import tempfile
 import threading
 import urllib.parse
+from contextlib import contextmanager, ExitStack
+from email.utils import formatdate
 from pathlib import Path
-from time import time
-from typing import Any, Dict, List, Mapping, Optional, Union
+from time import gmtime, perf_counter, strftime
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+from uuid import uuid4
 
 import bottle
 from streaming_form_data import StreamingFormDataParser
-from streaming_form_data.targets import BaseTarget, NullTarget
+from streaming_form_data.targets import NullTarget
 
 import config
-from lib_bottle import bottle_get, bottle_post, bottle_route, bottle_view, RouteResponse
-from lib_common import get_file_modified_unixtime
-from lib_file_storage import AtomicFile, FileStorage, StorageFileItem
+from lib_async_server import AsyncHandler, AsyncioServer, AsyncRequest, AsyncRoute, RunBlocking
+from lib_bottle import (
+    bottle_delete,
+    bottle_get,
+    bottle_post,
+    bottle_put,
+    bottle_route,
+    RouteResponse,
+    RouteTimingPlugin,
+)
+from lib_cache_policy import CachePolicy
+from lib_durability import Durability
+from lib_file_storage import DisplayFileItem, FileStorage, StorageFileItem, StorageGeneration
+from lib_gzip import GzipCompressor, is_compressible, make_gzip_etag
+from lib_http import (
+    ByteRange,
+    etag_matches_weak,
+    get_multipart_byteranges_length,
+    is_gzip_accepted,
+    is_not_modified,
+    is_range_allowed,
+    iter_multipart_byteranges,
+    make_etag,
+    parse_range_header,
+)
+from lib_listing import FilesQuery, iter_json_list
+from lib_metrics import CollectedGauge, CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY
+from lib_page_cache import CachedPage, PageCache
+from lib_quota import StorageFullError, StorageLimits, UploadTooLargeError
+from lib_static import StaticAssets
+from lib_upload_pipeline import RawBodyParser, UploadPipeline
+from lib_upload_sessions import UploadSessions, WRITE_BLOCK_SIZE
+from lib_web_servers import FILE_WRAPPER_BLOCK_SIZE, FileRange, FileWrapper, get_server_adapter
+from lib_workers import WorkerProcesses
+from lib_zip import iter_zip, ZipEntry
 
 
-ViewResponse = Dict[str, Any]
 MethodResponse = str
 
 LOGGER = logging.getLogger('app')
@@ -39,16 +77,142 @@
 # 4) Display name. Used on web page and to save file on end user's computer
 # ==========================================
 
+# Servers which can share listening port between worker processes:
+REUSE_PORT_SERVERS = {'asyncio', 'cheroot', 'wsgiref'}
+
 STORAGE_URL_SUBDIR = '/files/'
 URLPREFIX = config.STORAGE_WEB_URL_BASE or STORAGE_URL_SUBDIR
 
-STORAGE = FileStorage(config.STORAGE_DIRECTORY, config.MAX_STORAGE_SECONDS)
+STORAGE_LIMITS = StorageLimits(
+    max_bytes=config.MAX_STORAGE_BYTES,
+    max_files=config.MAX_STORAGE_FILES,
+    min_free_bytes=config.MIN_FREE_DISK_BYTES,
+    evict_oldest=config.EVICT_OLDEST_FILES,
+)
+CACHE_POLICY = CachePolicy(config.DROP_CACHE_MIN_BYTES)
+DURABILITY = Durability(config.DURABILITY)
+STORAGE = FileStorage(config.STORAGE_DIRECTORY, config.MAX_STORAGE_SECONDS, config.DEDUPLICATE_FILES, STORAGE_LIMITS,
+                      config.STORAGE_LAYOUT, config.STORAGE_BUCKET_SECONDS, CACHE_POLICY, DURABILITY)
+UPLOAD_SESSIONS = UploadSessions(STORAGE)
+GZIP = GzipCompressor(config.GZIP_LEVEL, config.GZIP_MAX_STREAMS)
+PAGE_CACHE = PageCache(STORAGE.get_generation, GZIP.compress_page)
+STATIC_ASSETS = StaticAssets(Path(__file__).parent.absolute() / 'static', exclude=('templates',))
+
+UPLOADED_BYTES = REGISTRY.counter('limbo_uploaded_bytes_total', 'Bytes of uploaded files received').labels()
+DOWNLOADED_BYTES = REGISTRY.counter(
+    'limbo_downloaded_bytes_total', 'Bytes of stored files sent (before compression)').labels()
+UPLOADS_IN_PROGRESS = REGISTRY.gauge('limbo_uploads_in_progress', 'Uploads being received').labels()
+DOWNLOADS_IN_PROGRESS = REGISTRY.gauge('limbo_downloads_in_progress', 'Downloads being sent').labels()
+REQUEST_SECONDS = REGISTRY.histogram(
+    'limbo_request_duration_seconds', 'Time spent in request handlers (streamed bodies are sent after that)',
+    ['method', 'route'])
 
 
 class ProcessSignals:  # pylint: disable=too-few-public-methods
     process_is_terminating = False
 
 
+# ==========================================
+# Metrics (see lib_metrics) are served at /metrics.
+# Transfer counters are updated for every chunk of data,
+# so rates are smooth even for huge files. Handler time is measured
+# by RouteTimingPlugin and by timed_async_handler() for native routes.
+# ==========================================
+
+
+def observe_request(method: str, rule: str, seconds: float) -> None:
+    REQUEST_SECONDS.labels(method, rule).observe(seconds)
+
+
+def timed_async_handler(method: str, rule: str, handler: AsyncHandler) -> AsyncHandler:
+    async def timed_handler(*args: Any) -> bottle.HTTPResponse:
+        time1 = perf_counter()
+        try:
+            return await handler(*args)
+        finally:
+            observe_request(method, rule, perf_counter() - time1)
+    return timed_handler
+
+
+def count_uploaded(read: Callable[[int], bytes]) -> Callable[[int], bytes]:
+    def counted_read(size: int) -> bytes:
+        data = read(size)
+        UPLOADED_BYTES.inc(len(data))
+        return data
+    return counted_read
+
+
+def count_uploaded_async(read: Callable[[int], Awaitable[bytes]]) -> Callable[[int], Awaitable[bytes]]:
+    async def counted_read(size: int) -> bytes:
+        data = await read(size)
+        UPLOADED_BYTES.inc(len(data))
+        return data
+    return counted_read
+
+
+@contextmanager
+def track_upload() -> Iterator[None]:
+    UPLOADS_IN_PROGRESS.inc()
+    try:
+        yield
+    finally:
+        UPLOADS_IN_PROGRESS.dec()
+
+
+def finish_download(size: int) -> None:
+    DOWNLOADED_BYTES.inc(size)
+    DOWNLOADS_IN_PROGRESS.dec()
+
+
+# Download is over when the server closes response body
+def open_download(file: Any, offset: int, count: int, file_size: int) -> FileRange:
+    CACHE_POLICY.advise_read(file.fileno(), offset, count)
+
+    def finish(size: int) -> None:
+        if not file.closed:
+            CACHE_POLICY.drop(file.fileno(), offset, size, file_size)
+        finish_download(size)
+
+    file_range = FileRange(file, offset, count, on_close=finish)
+    DOWNLOADS_IN_PROGRESS.inc()
+    return file_range
+
+
+def iter_download(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    # Bottle starts iterating the body right away, so finally is always reached:
+    DOWNLOADS_IN_PROGRESS.inc()
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        close: Any = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+        finish_download(size)
+
+
+def collect_storage_metrics() -> List[CollectedGauge]:
+    usage = STORAGE.get_usage()
+    return [
+        ('limbo_storage_files', 'Files in storage', usage.files),
+        ('limbo_storage_bytes', 'Size of files in storage', usage.size),
+        ('limbo_storage_incomplete_files', 'Files of unfinished uploads', usage.incomplete_files),
+        ('limbo_storage_incomplete_bytes', 'Size of unfinished uploads', usage.incomplete_size),
+    ]
+
+
+REGISTRY.add_collector(collect_storage_metrics)
+bottle.install(RouteTimingPlugin(observe_request))
+
+
+# Prometheus endpoint
+@bottle_get('/metrics')
+def metrics() -> RouteResponse:
+    return bottle.HTTPResponse(REGISTRY.render(), **{'Content-Type': METRICS_CONTENT_TYPE})
+
+
 def format_size(size: int) -> str:
     kib = 1024
     mib = kib * kib
@@ -66,13 +230,8 @@ def format_size(size: int) -> str:
     return f'{size / tib:.1f} TiB'
 
 
-def format_age(seconds: int) -> str:
-    if seconds < 120:
-        return f'{seconds}s'
-    minutes = seconds // 60
-    if minutes < 60:
-        return f'{minutes}m'
-    return f'{minutes // 60}h {minutes % 60}m'
+def format_unixtime(unixtime: float) -> str:
+    return strftime('%Y-%m-%d %H:%M UTC', gmtime(unixtime))
 
 
 def assert_float_int(value: Any) -> Union[float, int]:
@@ -80,53 +239,102 @@ def assert_float_int(value: Any) -> Union[float, int]:
     return value
 
 
-@bottle_route('/')
-@bottle_view('root.html')
-def root_page() -> ViewResponse:
-    LOGGER.info('Root page is requested')
+def make_cached_response(page: CachedPage, content_type: str) -> RouteResponse:
+    environ = bottle.request.environ
+    use_gzip = page.gzip_body is not None and is_gzip_accepted(environ.get('HTTP_ACCEPT_ENCODING'))
+    etag = make_gzip_etag(page.etag) if use_gzip else page.etag
+    # Client has to revalidate the page every time; unchanged page costs a 304 reply:
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None and etag_matches_weak(if_none_match, etag):
+        return bottle.HTTPResponse(status=304, **headers)
+    headers['Content-Type'] = content_type
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return bottle.HTTPResponse(page.gzip_body if use_gzip else page.body, **headers)
+
+
+# Page doesn't depend on current time: ages of files are shown by the browser
+def render_root_page() -> bytes:
+    files = sorted(STORAGE.enumerate_files(), key=lambda file: file.modified_unixtime, reverse=True)
     result_files: List[Mapping[str, Any]] = []
-    files = STORAGE.enumerate_files()
-    now = time()
     for file in files:
-        modified_unixtime = get_file_modified_unixtime(file.full_disk_filename)
         result_files.append(
             {
                 'display_filename': file.display_filename,
                 'url': URLPREFIX + urllib.parse.quote(file.url_filename),
                 'url_filename': file.url_filename,
-                'size': format_size(file.full_disk_filename.stat().st_size),
-                'age': format_age(int(now - modified_unixtime)),
-                'sortBy': now - modified_unixtime,
+                'size': format_size(file.size),
+                'modified': file.modified_unixtime,
+                'modified_text': format_unixtime(file.modified_unixtime),
             }
         )
-    result_files = sorted(result_files, key=lambda item: assert_float_int(item['sortBy']))
+    page: str = bottle.template(
+        'root.html',
+        title='Limbo: the file sharing lightweight service',
+        h1='Limbo. The file sharing lightweight service',
+        files=result_files,
+        static_url=STATIC_ASSETS.get_url,
+    )
+    return page.encode('utf-8')
+
+
+@bottle_route('/')
+def root_page() -> RouteResponse:
+    LOGGER.info('Root page is requested')
+    return make_cached_response(PAGE_CACHE.get('root', render_root_page), 'text/html; charset=UTF-8')
+
+
+def make_file_json(file: DisplayFileItem) -> Dict[str, Any]:
     return {
-        'title': 'Limbo: the file sharing lightweight service',
-        'h1': 'Limbo. The file sharing lightweight service',
-        'files': result_files,
+        'display_filename': file.display_filename,
+        'url': URLPREFIX + urllib.parse.quote(file.url_filename),
+        'url_filename': file.url_filename,
+        'size': file.size,
+        'modified': file.modified_unixtime,
     }
 
 
-# JSON API for auto tests and automation
+def render_enumerate() -> bytes:
+    result_files = [make_file_json(file) for file in STORAGE.enumerate_files()]
+    result_files = sorted(result_files, key=lambda item: assert_float_int(item['modified']))
+    return json.dumps(result_files, indent=4).encode('utf-8')
+
+
+# JSON API for auto tests and automation.
+# Without query parameters all files are returned sorted by modification time.
+# Any of parameters limit, cursor, sort, prefix switches to compact streamed
+# output; Link header refers to the next page when there is one.
 @bottle_get('/cgi/enumerate/')
-def cgi_enumerate() -> MethodResponse:
+def cgi_enumerate() -> RouteResponse:
     LOGGER.info('Enumerate result_files')
-    bottle.response.content_type = 'application/json'
-    result_files = []
-    files = STORAGE.enumerate_files()
-    for file in files:
-        modified_unixtime = get_file_modified_unixtime(file.full_disk_filename)
-        result_files.append(
-            {
-                'display_filename': file.display_filename,
-                'url': URLPREFIX + urllib.parse.quote(file.url_filename),
-                'url_filename': file.url_filename,
-                'size': file.full_disk_filename.stat().st_size,
-                'modified': modified_unixtime,
-            }
+    query = bottle.request.query
+    if not any(name in query for name in ('limit', 'cursor', 'sort', 'prefix')):
+        return make_cached_response(PAGE_CACHE.get('enumerate', render_enumerate), 'application/json')
+
+    try:
+        files_query = FilesQuery(
+            sort=query.get('sort') or 'modified',
+            prefix=query.getunicode('prefix', default=''),
+            cursor=query.get('cursor') or None,
+            limit=int(query['limit']) if query.get('limit') else None,
         )
-    result_files = sorted(result_files, key=lambda item: assert_float_int(item['modified']))
-    return json.dumps(result_files, indent=4)
+    except ValueError as exc:
+        return bottle.HTTPError(400, str(exc))
+    page = files_query.get_page(STORAGE.enumerate_files())
+
+    headers = {'Content-Type': 'application/json', 'Vary': 'Accept-Encoding'}
+    if page.next_cursor is not None:
+        next_query = {name: query.getunicode(name) for name in query.keys() if name != 'cursor'}
+        next_query['cursor'] = page.next_cursor
+        headers['Link'] = f'<{bottle.request.path}?{urllib.parse.urlencode(next_query)}>; rel="next"'
+    body: Iterable[bytes] = iter_json_list([make_file_json(file) for file in page.files])
+    if GZIP.should_compress('application/json', None, bottle.request.environ.get('HTTP_ACCEPT_ENCODING')):
+        gzip_body = GZIP.compress_stream(body)
+        if gzip_body is not None:
+            headers['Content-Encoding'] = 'gzip'
+            body = gzip_body
+    return bottle.HTTPResponse(body, **headers)
 
 
 @bottle_post('/cgi/addtext/')
@@ -139,78 +347,350 @@ def cgi_addtext() -> MethodResponse:
 
     with STORAGE.open_file_writer(original_filename) as writer:
         writer.write(body)
+    UPLOADED_BYTES.inc(len(body))
 
     LOGGER.info('Shared text size: %d', len(body))
     return 'OK'
 
 
-class StorageFileTarget(BaseTarget):  # type: ignore
-    def __init__(self) -> None:
-        super().__init__()
-        self._writer: Optional[AtomicFile] = None
+def make_multipart_parser(headers: Mapping[str, str], pipeline: UploadPipeline) -> StreamingFormDataParser:
+    parser = StreamingFormDataParser(headers=headers)
+    parser.register('file', NullTarget() if config.DISABLE_STORAGE else pipeline.target)
+    return parser
 
-    def on_start(self) -> None:
-        LOGGER.debug('StorageFileTarget: on_start')
-        self._writer = STORAGE.open_file_writer(self.multipart_filename)
 
-    def on_data_received(self, chunk: bytes) -> None:
-        LOGGER.debug('StorageFileTarget: on_data_received: %d bytes', len(chunk))
-        assert self._writer is not None
-        self._writer.write(chunk)
-
-    def on_finish(self) -> None:
-        LOGGER.debug('StorageFileTarget: on_finish')
-        assert self._writer is not None
-        self._writer.close()
+# Raises HTTPError when a file of that size can't be stored
+def check_storage_space(size: int) -> None:
+    if config.DISABLE_STORAGE:
+        return
+    try:
+        STORAGE.check_space(size)
+    except UploadTooLargeError as exc:
+        raise bottle.HTTPError(413, 'File is too large.') from exc
+    except StorageFullError as exc:
+        raise bottle.HTTPError(507, 'Not enough free space.') from exc
 
 
+# Multipart body is a bit bigger than the file; it is close enough to reject uploads early.
+# Uploads of unknown size are checked while they are written.
+def check_multipart_upload(headers: Mapping[str, str]) -> None:
+    try:
+        content_length = int(headers.get('Content-Length', ''))
+    except ValueError:
+        return
+    check_storage_space(content_length)
+
+
+# Errors which fail a single file of multipart upload; the rest of files are still stored
+def is_file_upload_error(exc: Exception) -> bool:
+    return isinstance(exc, (UploadTooLargeError, FileExistsError)) \
+        or isinstance(exc, OSError) and exc.errno == errno.ENOSPC
+
+
+def make_multipart_upload(headers: Mapping[str, str],
+                          queue_depth: int) -> Tuple[UploadPipeline, StreamingFormDataParser]:
+    check_multipart_upload(headers)
+    pipeline = UploadPipeline(STORAGE.open_file_writer, queue_depth, is_file_error=is_file_upload_error)
+    return pipeline, make_multipart_parser(headers, pipeline)
+
+
+# Clients which accept JSON get result of every file. Others get 'OK'
+# or the error of the first failed file (as for a single file upload).
+def make_multipart_upload_response(headers: Mapping[str, str], pipeline: UploadPipeline,
+                                   size: int) -> bottle.HTTPResponse:
+    LOGGER.info('Uploaded request size: %s bytes', size)
+    results: List[Dict[str, Any]] = []
+    first_error: Optional[bottle.HTTPError] = None
+    for file in pipeline.files:
+        result: Dict[str, Any] = {'name': file.filename, 'size': file.size}
+        if file.error is None:
+            result['url'] = URLPREFIX + urllib.parse.quote(STORAGE.get_url_filename(file.filename))
+        else:
+            error = get_upload_error_response(file.error)
+            assert error is not None
+            result.update(status=error.status_code, error=error.body)
+            first_error = first_error or error
+        results.append(result)
+
+    timing_headers = {'Server-Timing': pipeline.timings.get_server_timing_header()}
+    if 'application/json' in headers.get('Accept', ''):
+        return bottle.HTTPResponse(json.dumps({'files': results}), **timing_headers,
+                                   **{'Content-Type': 'application/json'})
+    if first_error is not None:
+        first_error.headers.update(timing_headers)
+        return first_error
+    return bottle.HTTPResponse('OK', **timing_headers)
+
+
+# Request may carry many files (all in 'file' fields); every file is stored on its own
 @bottle_post('/cgi/upload/')
-def cgi_upload() -> MethodResponse:
+def cgi_upload() -> RouteResponse:
     LOGGER.info('Upload file begin')
+    pipeline, parser = make_multipart_upload(bottle.request.headers, config.UPLOAD_QUEUE_DEPTH)
 
-    # wsgiref does not support async reading from environ['wsgi.input']
-    # It blocks forever in read(size) call.
-    use_async_implementation = config.WEB_SERVER != 'wsgiref'
-
-    if use_async_implementation:
-        size = 0
-        file = NullTarget() if config.DISABLE_STORAGE else StorageFileTarget()
-        parser = StreamingFormDataParser(headers=bottle.request.headers)
-        parser.register('file', file)
-
-        while True:
-            LOGGER.debug('Read async chunk...')
-            buffer = bottle.request.environ['wsgi.input']
-            chunk = buffer.read(64 * 1024)
-            if not chunk:
-                break
-            LOGGER.debug('Got async chunk from network: %d bytes', len(chunk))
-            parser.data_received(chunk)
-            size += len(chunk)
-
-        LOGGER.info('Uploaded request size: %s bytes', size)
+    # wsgi.input is read until EOF: all supported servers stop it at the end of request body
+    # (see lib_web_servers for wsgiref). Chunked request bodies arrive decoded.
+    try:
+        with track_upload():
+            size = pipeline.run(count_uploaded(bottle.request.environ['wsgi.input'].read), parser.data_received)
+    except (EOFError, OSError, UploadTooLargeError) as exc:
+        error = get_upload_error_response(exc)
+        if error is None:
+            raise
+        raise error from exc
+    return make_multipart_upload_response(bottle.request.headers, pipeline, size)
+
+
+# Returns expected size of raw upload (None for chunked request body).
+# Raises HTTPError when the upload is rejected before its body is read.
+def check_raw_upload(original_filename: str, headers: Mapping[str, str]) -> Optional[int]:
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        content_length = None
     else:
-        size = 0
-        files: bottle.FormsDict = bottle.request.files
-        upload = files.file  # pylint: disable=no-member
-        if upload is None:
-            raise Exception('ERROR! "file" multipart field was not found')
-        original_filename = upload.raw_filename
-        body = upload.file
-
-        with STORAGE.open_file_writer(original_filename) as writer:
-            while True:
-                LOGGER.debug('Read synchronous chunk...')
-                chunk = body.read(64 * 1024)
-                if not chunk:
-                    break
-                LOGGER.debug('Got synchronous chunk from network: %d bytes', len(chunk))
-                if not config.DISABLE_STORAGE:
-                    writer.write(chunk)
-                size += len(chunk)
-
-        LOGGER.info('Uploaded file size: %d bytes', size)
-    return 'OK'
+        try:
+            content_length = int(headers.get('Content-Length', ''))
+        except ValueError as exc:
+            raise bottle.HTTPError(411, 'Content-Length is required.') from exc
+    if STORAGE.is_file_stored(original_filename):
+        raise bottle.HTTPError(409, 'File already exists.')
+    if content_length is not None:
+        check_storage_space(content_length)
+    return content_length
+
+
+def make_raw_upload(original_filename: str, content_length: Optional[int],
+                    queue_depth: int) -> Tuple[UploadPipeline, RawBodyParser]:
+    pipeline = UploadPipeline(STORAGE.open_file_writer, queue_depth, size_hint=content_length)
+    target = NullTarget() if config.DISABLE_STORAGE else pipeline.target
+    return pipeline, RawBodyParser(target, original_filename, content_length)
+
+
+def get_upload_error_response(exc: Exception) -> Optional[bottle.HTTPError]:
+    if isinstance(exc, UploadTooLargeError):
+        LOGGER.warning('Upload failed: %s', exc)
+        return bottle.HTTPError(413, 'File is too large.')
+    if isinstance(exc, EOFError):
+        LOGGER.warning('Upload failed: %s', exc)
+        return bottle.HTTPError(400, 'Request body is incomplete.')
+    if isinstance(exc, FileExistsError):
+        LOGGER.warning('Upload failed: %s', exc)
+        return bottle.HTTPError(409, 'File already exists.')
+    if isinstance(exc, OSError) and exc.errno == errno.ENOSPC:
+        LOGGER.warning('Upload failed: %s', exc)
+        return bottle.HTTPError(507, 'Not enough free space.')
+    return None
+
+
+def make_raw_upload_response(original_filename: str, pipeline: UploadPipeline, size: int) -> bottle.HTTPResponse:
+    LOGGER.info('Raw upload size: %s bytes', size)
+    url = URLPREFIX + urllib.parse.quote(STORAGE.get_url_filename(original_filename))
+    return bottle.HTTPResponse('Created', status=201, **{
+        'Location': url,
+        'Server-Timing': pipeline.timings.get_server_timing_header(),
+    })
+
+
+# Upload without multipart framing: request body is the file itself.
+# Example: curl -T file.bin http://localhost:8080/files/file.bin
+@bottle_put(STORAGE_URL_SUBDIR + '<original_filename>')
+def put_file(original_filename: str) -> RouteResponse:
+    LOGGER.info('Raw upload begin: %s', original_filename)
+    content_length = check_raw_upload(original_filename, bottle.request.headers)
+    pipeline, parser = make_raw_upload(original_filename, content_length, config.UPLOAD_QUEUE_DEPTH)
+    try:
+        with track_upload():
+            size = pipeline.run(count_uploaded(bottle.request.environ['wsgi.input'].read),
+                                parser.data_received, parser.data_ended)
+    except (EOFError, OSError, UploadTooLargeError) as exc:
+        error = get_upload_error_response(exc)
+        if error is None:
+            raise
+        return error
+    return make_raw_upload_response(original_filename, pipeline, size)
+
+
+# ==========================================
+# Native handlers of asyncio server (see lib_async_server) for uploads.
+# Request body is read by the event loop; parsing and writing are run
+# by the thread pool, so slow clients don't hold threads.
+# ==========================================
+
+
+async def async_cgi_upload(request: AsyncRequest, run_blocking: RunBlocking) -> bottle.HTTPResponse:
+    LOGGER.info('Upload file begin')
+    pipeline, parser = make_multipart_upload(request.headers, 0)
+    try:
+        with track_upload():
+            size = await pipeline.run_async(count_uploaded_async(request.body.read), parser.data_received, None,
+                                            run_blocking)
+    except (EOFError, OSError, UploadTooLargeError) as exc:
+        error = get_upload_error_response(exc)
+        if error is None:
+            raise
+        return error
+    return make_multipart_upload_response(request.headers, pipeline, size)
+
+
+async def async_put_file(request: AsyncRequest, run_blocking: RunBlocking,
+                         original_filename: str) -> bottle.HTTPResponse:
+    LOGGER.info('Raw upload begin: %s', original_filename)
+    content_length = check_raw_upload(original_filename, request.headers)
+    pipeline, parser = make_raw_upload(original_filename, content_length, 0)
+    try:
+        with track_upload():
+            size = await pipeline.run_async(count_uploaded_async(request.body.read), parser.data_received,
+                                            parser.data_ended, run_blocking)
+    except (EOFError, OSError, UploadTooLargeError) as exc:
+        error = get_upload_error_response(exc)
+        if error is None:
+            raise
+        return error
+    return make_raw_upload_response(original_filename, pipeline, size)
+
+
+# ==========================================
+# Resumable uploads (see lib_upload_sessions):
+# POST   /cgi/upload-session/               create session (form fields: fileName, size)
+# GET    /cgi/upload-session/<id>           session state: size, offset, written ranges
+# PUT    /cgi/upload-session/<id>?offset=N  write request body at offset N
+# POST   /cgi/upload-session/<id>/finish    move completed file to storage
+# DELETE /cgi/upload-session/<id>           abort
+# ==========================================
+
+
+def json_response(data: Any, status: int = 200) -> bottle.HTTPResponse:
+    return bottle.HTTPResponse(json.dumps(data), status=status, **{'Content-Type': 'application/json'})
+
+
+@bottle_post('/cgi/upload-session/')
+def cgi_create_upload_session() -> RouteResponse:
+    forms: bottle.FormsDict = bottle.request.forms
+    original_filename = forms.fileName  # pylint: disable=no-member
+    try:
+        size = int(forms.size)  # pylint: disable=no-member
+    except ValueError:
+        return bottle.HTTPError(400, 'File size is required.')
+    if not original_filename or size < 0:
+        return bottle.HTTPError(400, 'File name and size are required.')
+    if STORAGE.is_file_stored(original_filename):
+        return bottle.HTTPError(409, 'File already exists.')
+    try:
+        session = UPLOAD_SESSIONS.create(original_filename, size)
+    except (OSError, UploadTooLargeError) as exc:
+        error = get_upload_error_response(exc)
+        if error is None:
+            raise
+        return error
+    return json_response(session.to_dict(), status=201)
+
+
+@bottle_get('/cgi/upload-session/<session_id>')
+def cgi_get_upload_session(session_id: str) -> RouteResponse:
+    try:
+        session = UPLOAD_SESSIONS.get(session_id)
+    except FileNotFoundError:
+        return bottle.HTTPError(404, 'Upload session does not exist.')
+    return json_response(session.to_dict())
+
+
+@bottle_put('/cgi/upload-session/<session_id>')
+def cgi_write_upload_session(session_id: str) -> RouteResponse:
+    length = bottle.request.content_length
+    if length < 0:
+        return bottle.HTTPError(411, 'Content-Length is required.')
+    try:
+        offset = int(bottle.request.query.offset)  # pylint: disable=no-member
+    except ValueError:
+        return bottle.HTTPError(400, 'Chunk offset is required.')
+    try:
+        with track_upload():
+            session = UPLOAD_SESSIONS.write_chunk(
+                session_id, offset, length, count_uploaded(bottle.request.environ['wsgi.input'].read))
+    except FileNotFoundError:
+        return bottle.HTTPError(404, 'Upload session does not exist.')
+    except ValueError as exc:
+        return bottle.HTTPError(416, str(exc))
+    except EOFError as exc:
+        LOGGER.warning('Upload session chunk failed: %s', exc)
+        return bottle.HTTPError(400, 'Request body is incomplete.')
+    return json_response(session.to_dict())
+
+
+# Chunk is read by the event loop while the data read before is written by run_blocking() executor
+async def async_write_upload_session(request: AsyncRequest, run_blocking: RunBlocking,
+                                     session_id: str) -> bottle.HTTPResponse:
+    try:
+        length = int(request.headers.get('Content-Length', ''))
+    except ValueError:
+        return bottle.HTTPError(411, 'Content-Length is required.')
+    try:
+        offset = int(urllib.parse.parse_qs(request.query_string).get('offset', [''])[0])
+    except ValueError:
+        return bottle.HTTPError(400, 'Chunk offset is required.')
+    read = count_uploaded_async(request.body.read)
+    chunks = ExitStack()
+    try:
+        with track_upload():
+            chunk = await run_blocking(chunks.enter_context, UPLOAD_SESSIONS.open_chunk(session_id, offset, length))
+            writing: Optional['asyncio.Future[Any]'] = None
+            try:
+                received = 0
+                while received < length:
+                    data = await read(min(WRITE_BLOCK_SIZE, length - received))
+                    if not data:
+                        raise EOFError(f'Chunk is truncated: got {received} of {length} bytes')
+                    received += len(data)
+                    if writing is not None:
+                        await writing
+                    writing = run_blocking(chunk.write, data)
+                if writing is not None:
+                    await writing
+            finally:
+                if writing is not None:
+                    # Chunk must not be closed while the executor is writing it
+                    await asyncio.wait([writing])
+                    if not writing.cancelled():
+                        writing.exception()  # the first error is being raised already
+                await run_blocking(chunks.close)
+    except FileNotFoundError:
+        return bottle.HTTPError(404, 'Upload session does not exist.')
+    except ValueError as exc:
+        return bottle.HTTPError(416, str(exc))
+    except EOFError as exc:
+        LOGGER.warning('Upload session chunk failed: %s', exc)
+        return bottle.HTTPError(400, 'Request body is incomplete.')
+    return json_response(chunk.session.to_dict())
+
+
+@bottle_post('/cgi/upload-session/<session_id>/finish')
+def cgi_finish_upload_session(session_id: str) -> RouteResponse:
+    try:
+        url_filename = UPLOAD_SESSIONS.finish(session_id)
+    except FileNotFoundError:
+        return bottle.HTTPError(404, 'Upload session does not exist.')
+    except FileExistsError:
+        return bottle.HTTPError(409, 'File already exists.')
+    except ValueError as exc:
+        return bottle.HTTPError(409, str(exc))
+    return json_response({'url': URLPREFIX + urllib.parse.quote(url_filename), 'url_filename': url_filename})
+
+
+@bottle_delete('/cgi/upload-session/<session_id>')
+def cgi_abort_upload_session(session_id: str) -> RouteResponse:
+    try:
+        UPLOAD_SESSIONS.abort(session_id)
+    except FileNotFoundError:
+        return bottle.HTTPError(404, 'Upload session does not exist.')
+    return bottle.HTTPResponse('OK')
+
+
+ASYNC_ROUTES: List[AsyncRoute] = [
+    ('POST', re.compile('^/cgi/upload/$'), timed_async_handler('POST', '/cgi/upload/', async_cgi_upload)),
+    ('PUT', re.compile(f'^{STORAGE_URL_SUBDIR}([^/]+)$'),
+     timed_async_handler('PUT', STORAGE_URL_SUBDIR + '<original_filename>', async_put_file)),
+    ('PUT', re.compile('^/cgi/upload-session/([^/]+)$'),
+     timed_async_handler('PUT', '/cgi/upload-session/<session_id>', async_write_upload_session)),
+]
 
 
 @bottle_post('/cgi/remove/')
@@ -233,10 +713,30 @@ def cgi_remove_all() -> MethodResponse:
 @bottle_route('/static/<urlpath:path>')
 def server_static(urlpath: str) -> RouteResponse:
     LOGGER.debug('Static file requested: %s', urlpath)
-    root_folder = Path(__file__).parent.absolute()
-    response = bottle.static_file(urlpath, root=root_folder / 'static')
-    response.set_header('Cache-Control', 'public, max-age=604800')
-    return response
+    asset = STATIC_ASSETS.get(urlpath)
+    if asset is None:
+        return bottle.HTTPError(404, 'File does not exist.')
+
+    environ = bottle.request.environ
+    use_gzip = asset.gzip_body is not None and is_gzip_accepted(environ.get('HTTP_ACCEPT_ENCODING'))
+    etag = asset.gzip_etag if use_gzip else asset.etag
+    # Web page refers to assets by URLs with content hash:
+    is_versioned = bottle.request.query.get('v') == asset.digest
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=31536000, immutable' if is_versioned else 'no-cache',
+    }
+    if asset.gzip_body is not None:
+        headers['Vary'] = 'Accept-Encoding'
+
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None and etag_matches_weak(if_none_match, etag):
+        return bottle.HTTPResponse(status=304, **headers)
+
+    headers['Content-Type'] = asset.content_type
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return bottle.HTTPResponse(asset.gzip_body if use_gzip else asset.body, **headers)
 
 
 @bottle_route('/favicon.ico')
@@ -247,7 +747,10 @@ def server_favicon() -> RouteResponse:
 @bottle_route(STORAGE_URL_SUBDIR + '<url_filename>')
 def server_storage(url_filename: str) -> RouteResponse:
     LOGGER.info('File download: %s', url_filename)
-    info: StorageFileItem = STORAGE.get_file_info_to_read(url_filename)
+    try:
+        info: StorageFileItem = STORAGE.get_file_info_to_read(url_filename)
+    except FileNotFoundError:
+        return bottle.HTTPError(404, 'File does not exist.')
 
     # show preview for images and text files
     # force text files to be shown as text/plain
@@ -266,24 +769,124 @@ def server_storage(url_filename: str) -> RouteResponse:
     quoted_display_filename = urllib.parse.quote(info.display_filename)
 
     if showpreview:
-        response = bottle.static_file(
-            info.disk_filename,
-            root=info.storage_directory,
-            mimetype=mimetype,
-        )
+        content_type = f'{mimetype}; charset=UTF-8' if mimetype.startswith('text/') else mimetype
         content_disposition = f'inline; filename="{quoted_display_filename}"'
-        response.set_header('Content-Disposition', content_disposition)
     else:
-        response = bottle.static_file(
-            info.disk_filename,
-            root=info.storage_directory,
-            download=quoted_display_filename,
-        )
+        content_type = mimetypes.guess_type(info.display_filename)[0] or 'application/octet-stream'
+        content_disposition = f'attachment; filename="{quoted_display_filename}"'
+    return make_file_response(info, content_type, content_disposition)
+
+
+def make_file_response(info: StorageFileItem, content_type: str, content_disposition: str) -> RouteResponse:
+    environ = bottle.request.environ
+    etag = make_etag(info.size, info.modified_unixtime)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(info.modified_unixtime, usegmt=True),
+        'Accept-Ranges': 'bytes',
+        # Stored files never change, but they may be removed at any time:
+        'Cache-Control': 'no-cache',
+        'Content-Disposition': content_disposition,
+    }
+
+    # Ranges refer to uncompressed data, so only the whole file may be compressed:
+    use_gzip = environ.get('HTTP_RANGE') is None \
+        and GZIP.should_compress(content_type, info.size, environ.get('HTTP_ACCEPT_ENCODING'))
+    if is_compressible(content_type):
+        headers['Vary'] = 'Accept-Encoding'
+    if use_gzip:
+        headers['ETag'] = make_gzip_etag(etag)
+
+    if is_not_modified(environ.get('HTTP_IF_NONE_MATCH'), environ.get('HTTP_IF_MODIFIED_SINCE'),
+                       headers['ETag'], info.modified_unixtime):
+        return bottle.HTTPResponse(status=304, **headers)
+
+    ranges: Optional[List[ByteRange]] = None
+    range_header = environ.get('HTTP_RANGE')
+    if range_header is not None and bottle.request.method == 'GET' \
+            and is_range_allowed(environ.get('HTTP_IF_RANGE'), etag, info.modified_unixtime):
+        ranges = parse_range_header(range_header, info.size)
+        if ranges is not None and not ranges:
+            return bottle.HTTPResponse(status=416, **headers, **{'Content-Range': f'bytes */{info.size}'})
+
+    if bottle.request.method == 'HEAD':
+        headers['Content-Type'] = content_type
+        if use_gzip:
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            headers['Content-Length'] = str(info.size)
+        return bottle.HTTPResponse('', **headers)
+
+    try:
+        file = (info.storage_directory / info.disk_filename).open('rb')  # pylint: disable=consider-using-with
+    except FileNotFoundError:
+        return bottle.HTTPError(404, 'File does not exist.')
+
+    # Bottle hands file objects over to the server through wsgi.file_wrapper.
+    # Servers from lib_web_servers transmit our FileWrapper with sendfile();
+    # other servers either have their own wrapper or iterate ours by big blocks.
+    environ.setdefault('wsgi.file_wrapper', FileWrapper)
+
+    if ranges is None:
+        headers['Content-Type'] = content_type
+        file_range = open_download(file, 0, info.size, info.size)
+        if use_gzip:
+            gzip_body = GZIP.compress_stream(FileWrapper(file_range))
+            if gzip_body is not None:
+                headers['Content-Encoding'] = 'gzip'
+                return bottle.HTTPResponse(gzip_body, **headers)
+            headers['ETag'] = etag  # all compression slots are busy
+        headers['Content-Length'] = str(info.size)
+        return bottle.HTTPResponse(file_range, **headers)
+
+    if len(ranges) == 1:
+        byte_range = ranges[0]
+        headers['Content-Type'] = content_type
+        headers['Content-Length'] = str(byte_range.length)
+        headers['Content-Range'] = byte_range.content_range(info.size)
+        file_range = open_download(file, byte_range.start, byte_range.length, info.size)
+        return bottle.HTTPResponse(file_range, status=206, **headers)
+
+    boundary = uuid4().hex
+    headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+    headers['Content-Length'] = str(get_multipart_byteranges_length(ranges, info.size, content_type, boundary))
+    body = iter_download(
+        iter_multipart_byteranges(file, ranges, info.size, content_type, boundary, FILE_WRAPPER_BLOCK_SIZE))
+    return bottle.HTTPResponse(body, status=206, **headers)
+
+
+# ZIP archive of stored files generated on the fly (see lib_zip).
+# Files are selected by URL file names in fileName parameters (repeated);
+# all files are taken when there are none. deflate=1 compresses files.
+# POST with form fields suits long lists of files.
+@bottle_get('/cgi/zip/')
+@bottle_post('/cgi/zip/')
+def cgi_zip() -> RouteResponse:
+    params = bottle.request.params.decode()
+    url_filenames = list(dict.fromkeys(params.getall('fileName')))  # unique, in order
+    LOGGER.info('ZIP download: %d files requested', len(url_filenames))
+    entries: List[ZipEntry] = []
+    if url_filenames:
+        for url_filename in url_filenames:
+            try:
+                info = STORAGE.get_file_info_to_read(url_filename)
+            except FileNotFoundError:
+                return bottle.HTTPError(404, 'File does not exist.')
+            entries.append(ZipEntry(name=info.display_filename, path=info.storage_directory / info.disk_filename,
+                                    size=info.size, modified_unixtime=info.modified_unixtime))
+    else:
+        for file in sorted(STORAGE.enumerate_files(), key=lambda file: file.display_filename):
+            entries.append(ZipEntry(name=file.display_filename, path=file.full_disk_filename,
+                                    size=file.size, modified_unixtime=file.modified_unixtime))
 
-    response.set_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-    response.set_header('Pragma', 'no-cache')
-    response.set_header('Expires', '0')
-    return response
+    # Compression level of on-the-fly gzip applies here too; 0 disables compression
+    compress_level = config.GZIP_LEVEL if params.get('deflate') == '1' and config.GZIP_LEVEL > 0 else None
+    body = iter_download(iter_zip(entries, FILE_WRAPPER_BLOCK_SIZE, compress_level))
+    return bottle.HTTPResponse(body, **{
+        'Content-Type': 'application/zip',
+        'Content-Disposition': 'attachment; filename="limbo.zip"',
+        'Cache-Control': 'no-store',
+    })
 
 
 def run_bottle() -> None:
@@ -292,13 +895,22 @@ def run_bottle() -> None:
     if config.WEB_SERVER == 'tornado':
         asyncio.set_event_loop(asyncio.new_event_loop())
 
+    server: Any = get_server_adapter(config.WEB_SERVER)
+    options: Dict[str, Any] = {}
+    if config.WEB_SERVER == 'asyncio':
+        server = AsyncioServer
+        options = {'native_routes': ASYNC_ROUTES, 'max_workers': config.ASYNC_MAX_WORKERS}
+    if config.WORKERS > 1:
+        options['reuse_port'] = True
+
     app = bottle.app()
     bottle.run(
         app,
-        server=config.WEB_SERVER,
+        server=server,
         host=config.LISTEN_HOST,
         port=config.LISTEN_PORT,
         debug=config.IS_DEBUG,
+        **options,
     )
     LOGGER.info('Bottle child thread finished gracefully')
 
@@ -311,6 +923,33 @@ def signal_handler(signalnum: int, _stack: Any) -> None:
         LOGGER.info('Got process signal %d...', signalnum)
 
 
+# Runs web server until process gets termination signal
+def serve() -> None:
+    LOGGER.info('Start server...')
+
+    server_thread = threading.Thread(target=run_bottle, daemon=True, name='bottle')
+    server_thread.start()
+
+    try:
+        while server_thread.is_alive() and not ProcessSignals.process_is_terminating:
+            server_thread.join(1)
+        if not server_thread.is_alive():
+            LOGGER.info('Bottle thread was found stopped')
+        else:
+            LOGGER.info('Stopping main thread after process got special signal...')
+    except (KeyboardInterrupt, SystemExit):
+        LOGGER.warning('Caught global exception, web server thread will be killed rudely')
+
+
+# Entry point of a forked worker process
+def run_worker() -> None:
+    STORAGE.detach_retention()
+    REGISTRY.start_snapshots()
+    serve()
+    REGISTRY.stop_snapshots()
+    LOGGER.info('Worker is stopped')
+
+
 def main() -> None:
     logging.basicConfig(
         stream=sys.stdout,
@@ -345,24 +984,25 @@ def main() -> None:
     for ext in text_extenstions:
         mimetypes.add_type(f'text/{ext}', f'.{ext}')
 
-    STORAGE.start()
-
-    LOGGER.info('Start server...')
-
     bottle.TEMPLATE_PATH = [Path(__file__).parent / 'static' / 'templates']
 
-    server_thread = threading.Thread(target=run_bottle, daemon=True, name='bottle')
-    server_thread.start()
-
-    try:
-        while server_thread.is_alive() and not ProcessSignals.process_is_terminating:
-            server_thread.join(1)
-        if not server_thread.is_alive():
-            LOGGER.info('Bottle thread was found stopped')
-        else:
-            LOGGER.info('Stopping main thread after process got special signal...')
-    except (KeyboardInterrupt, SystemExit):
-        LOGGER.warning('Caught global exception, web server thread will be killed rudely')
+    if config.WORKERS > 1:
+        if config.WEB_SERVER not in REUSE_PORT_SERVERS or not hasattr(os, 'fork'):
+            LOGGER.error('LIMBO_WORKERS is not supported for server %s on this OS', config.WEB_SERVER)
+            sys.exit(1)
+        # Must be shared before workers are forked:
+        STORAGE.share_between_processes(StorageGeneration())
+        metrics_directory = Path(tempfile.mkdtemp(prefix='limbo-metrics-'))
+        REGISTRY.share_between_processes(metrics_directory)
+        REGISTRY.start_snapshots()
+        STORAGE.start()
+        LOGGER.info('Start %d workers...', config.WORKERS)
+        WorkerProcesses(config.WORKERS, run_worker).run(lambda: ProcessSignals.process_is_terminating)
+        REGISTRY.stop_snapshots()
+        shutil.rmtree(metrics_directory, ignore_errors=True)
+    else:
+        STORAGE.start()
+        serve()
 
     LOGGER.info('Unloading server %s; port %d', config.WEB_SERVER, config.LISTEN_PORT)
     LOGGER.info('Unloading...')
@@ -0,0 +1,59 @@
+import asyncio
+import re
+from typing import Any, Callable, Iterable, List, Tuple
+from unittest import TestCase
+
+import bottle
+
+from lib_async_server import AsyncRequest, AsyncServer, RunBlocking
+
+
+def wsgi_app(environ: Any, start_response: Callable[..., Callable[[bytes], None]]) -> Iterable[bytes]:
+    if environ['PATH_INFO'] == '/fail':
+        raise RuntimeError('WSGI app failure')
+    if environ['PATH_INFO'] == '/no-start':
+        return []
+    write = start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '11')])
+    write(b'hello')
+    return [b' ', b'world']
+
+
+async def failing_handler(_request: AsyncRequest, _run_blocking: RunBlocking) -> bottle.HTTPResponse:
+    raise ValueError('Native handler failure')
+
+
+async def exchange(requests: List[bytes]) -> List[bytes]:
+    server = AsyncServer(wsgi_app, '127.0.0.1', 0, native_routes=[('POST', re.compile('^/native$'), failing_handler)])
+    server._loop = asyncio.get_running_loop()  # pylint: disable=protected-access
+    listener = await asyncio.start_server(server._handle_connection, '127.0.0.1', 0)  # pylint: disable=protected-access
+    port = listener.sockets[0].getsockname()[1]
+    responses: List[bytes] = []
+    async with listener:
+        for request in requests:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            responses.append(await asyncio.wait_for(reader.read(), 10))
+            writer.close()
+    return responses
+
+
+def parse_response(response: bytes) -> Tuple[str, bytes]:
+    head, _, body = response.partition(b'\r\n\r\n')
+    return head.split(b'\r\n')[0].decode('latin-1'), body
+
+
+class AsyncServerTestCase(TestCase):
+
+    def test_responses(self) -> None:
+        responses = asyncio.run(exchange([
+            b'GET /hello HTTP/1.1\r\nConnection: close\r\n\r\n',
+            b'POST /native HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc',
+            b'GET /fail HTTP/1.1\r\n\r\n',
+            b'GET /no-start HTTP/1.1\r\n\r\n',
+        ]))
+        # Data of write() callable precedes the returned iterable:
+        self.assertEqual(('HTTP/1.1 200 OK', b'hello world'), parse_response(responses[0]))
+        # Unexpected exceptions are answered and the connection is closed:
+        for response in responses[1:]:
+            self.assertEqual(('HTTP/1.1 500 Internal Server Error', b''), parse_response(response))
+            self.assertIn(b'Connection: close', response)
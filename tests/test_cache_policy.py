@@ -0,0 +1,43 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import skipUnless, TestCase
+
+from lib_cache_policy import CachePolicy, DROP_STEP
+from lib_file_storage import FileStorage
+from utils.testing_helpers import get_random_bytes
+
+
+@skipUnless(hasattr(os, 'posix_fadvise'), 'posix_fadvise() is not available')
+class CachePolicyTestCase(TestCase):
+
+    def test_drop_written(self) -> None:
+        policy = CachePolicy(2 * DROP_STEP)
+        with TemporaryDirectory() as temp_directory, (Path(temp_directory) / 'file.dat').open('wb') as file:
+            fd = file.fileno()
+            # Small files stay in cache:
+            self.assertFalse(policy.is_large(2 * DROP_STEP - 1))
+            self.assertEqual(0, policy.drop_written(fd, 0, 2 * DROP_STEP - 1))
+            # Large file is dropped by steps:
+            self.assertEqual(2 * DROP_STEP, policy.drop_written(fd, 0, 2 * DROP_STEP))
+            self.assertEqual(2 * DROP_STEP, policy.drop_written(fd, 2 * DROP_STEP, 3 * DROP_STEP - 1))
+            self.assertEqual(3 * DROP_STEP, policy.drop_written(fd, 2 * DROP_STEP, 3 * DROP_STEP))
+
+        disabled = CachePolicy(0)
+        self.assertFalse(disabled.is_large(10 ** 12))
+        self.assertEqual(0, disabled.drop_written(-1, 0, 10 ** 12))
+
+    def test_storage(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600, cache_policy=CachePolicy(1024 * 1024))
+            data = get_random_bytes(3 * DROP_STEP + 12345, 42)
+            with storage.open_file_writer('file.dat') as writer:
+                for offset in range(0, len(data), 1000000):
+                    writer.write(data[offset:offset + 1000000])
+            writer = storage.open_file_writer('small.dat')
+            writer.write(b'abc')
+            writer.close()
+
+            files = {file.display_filename: file for file in storage.enumerate_files()}
+            self.assertEqual(data, files['file.dat'].full_disk_filename.read_bytes())
+            self.assertEqual(b'abc', files['small.dat'].full_disk_filename.read_bytes())
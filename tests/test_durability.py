@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from lib_durability import Durability, DURABILITY_MODES
+from lib_file_storage import FileStorage
+
+
+class DurabilityTestCase(TestCase):
+
+    def test_storage(self) -> None:
+        for mode in DURABILITY_MODES:
+            with TemporaryDirectory() as temp_directory:
+                storage = FileStorage(Path(temp_directory), 24 * 3600, durability=Durability(mode))
+
+                def upload(index: int) -> None:
+                    with storage.open_file_writer(f'file_{index}.dat') as writer:
+                        writer.write(f'data {index}'.encode('utf-8'))
+
+                # Concurrent uploads are committed in common batches in periodic mode:
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    list(executor.map(upload, range(20)))
+
+                files = {file.display_filename: file for file in storage.enumerate_files()}
+                self.assertEqual(20, len(files), mode)
+                self.assertEqual(b'data 7', files['file_7.dat'].full_disk_filename.read_bytes())
+                self.assertEqual([], list((Path(temp_directory) / '.limbo' / 'incomplete').iterdir()))
+
+    def test_failed_commit(self) -> None:
+        durability = Durability('periodic')
+        with TemporaryDirectory() as temp_directory:
+            directory = Path(temp_directory)
+            (directory / 'a.tmp').write_bytes(b'a')
+            (directory / 'b.tmp').write_bytes(b'b')
+            durability.commit(directory / 'a.tmp', directory / 'a.dat')
+            with self.assertRaises(FileNotFoundError):
+                durability.commit(directory / 'a.tmp', directory / 'a2.dat')
+            # Flusher thread is started again after it is done:
+            durability.commit(directory / 'b.tmp', directory / 'b.dat')
+            self.assertEqual(['a.dat', 'b.dat'], sorted(file.name for file in directory.iterdir()))
+
+        with self.assertRaises(ValueError):
+            Durability('always')
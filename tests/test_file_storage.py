@@ -1,13 +1,16 @@
+import os
 from base64 import b64decode
 from dataclasses import dataclass
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from time import sleep, time
 from typing import Sequence
 from unittest import TestCase
 
 from numpy import random
 
-from lib_file_storage import DisplayFileItem, FileStorage, StorageFileItem
+from lib_file_storage import DisplayFileItem, FileStorage, StorageFileItem, StorageGeneration
+from lib_quota import StorageFullError, StorageLimits, UploadTooLargeError
 
 
 def get_random_bytes(size: int, seed: int) -> bytes:
@@ -163,3 +166,363 @@ def test_start_stop() -> None:
 
         storage.start()
         storage.stop()
+
+    def test_index_metadata(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage = temp_storage.storage
+
+        with storage.open_file_writer('file1.txt') as writer:
+            writer.write(b'abcde')
+
+        files: Sequence[DisplayFileItem] = storage.enumerate_files()
+        self.assertEqual(1, len(files))
+        item = files[0]
+        stat = item.full_disk_filename.stat()
+        self.assertEqual(item.size, stat.st_size)
+        self.assertEqual(item.modified_unixtime, stat.st_mtime)
+
+        # Index is filled from existing files on start:
+        storage2 = FileStorage(Path(temp_storage.temp_directory.name), 24 * 3600)
+        self.assertEqual(storage.enumerate_files(), storage2.enumerate_files())
+
+    def test_retention_updates_index(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage = FileStorage(Path(temp_storage.temp_directory.name), 0)
+
+        with storage.open_file_writer('file1.txt') as writer:
+            writer.write(b'abcde')
+        self.assertEqual(1, len(storage.enumerate_files()))
+
+        sleep(0.01)
+        storage._check_retention()  # pylint: disable=protected-access
+
+        self.assertEqual(0, len(storage.enumerate_files()))
+        self.assertEqual([], [file for file in Path(temp_storage.temp_directory.name).iterdir() if file.is_file()])
+
+    def test_retention_temp_files(self) -> None:
+        temp_storage = get_temp_file_storage()
+        temp_directory = Path(temp_storage.temp_directory.name) / '.limbo' / 'incomplete'
+        old_file = temp_directory / 'old.file'
+        old_file.write_bytes(b'abc')
+        old_unixtime = time() - 3600
+        os.utime(old_file, (old_unixtime, old_unixtime))
+        fresh_file = temp_directory / 'fresh.file'
+        fresh_file.write_bytes(b'abc')
+
+        storage = FileStorage(Path(temp_storage.temp_directory.name), 24 * 3600)
+        storage._check_retention()  # pylint: disable=protected-access
+
+        self.assertFalse(old_file.exists())
+        self.assertTrue(fresh_file.exists())
+
+    def test_retention_thread_removes_file_on_time(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage = FileStorage(Path(temp_storage.temp_directory.name), 1)
+        storage.start()
+        try:
+            with storage.open_file_writer('file1.txt') as writer:
+                writer.write(b'abcde')
+            self.assertEqual(1, len(storage.enumerate_files()))
+
+            deadline = time() + 5
+            while storage.enumerate_files() and time() < deadline:
+                sleep(0.05)
+            self.assertEqual(0, len(storage.enumerate_files()))
+        finally:
+            storage.stop()
+
+    def test_deduplication(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        content_directory = storage_directory / '.limbo' / 'content'
+        storage = FileStorage(storage_directory, 24 * 3600, deduplicate=True)
+
+        data = get_random_bytes(100000, 42)
+        for original_filename in ('file1.dat', 'file2.dat', 'file3.dat'):
+            with storage.open_file_writer(original_filename) as writer:
+                writer.write(data)
+        with storage.open_file_writer('other.dat') as writer:
+            writer.write(b'other data')
+
+        files = storage.enumerate_files()
+        self.assertEqual(4, len(files))
+        inodes = {file.display_filename: file.full_disk_filename.stat().st_ino for file in files}
+        self.assertEqual(inodes['file1.dat'], inodes['file2.dat'])
+        self.assertEqual(inodes['file1.dat'], inodes['file3.dat'])
+        self.assertNotEqual(inodes['file1.dat'], inodes['other.dat'])
+        self.assertEqual(2, len(list(content_directory.iterdir())))
+        self.assertEqual(data, (storage_directory / 'file3.dat').read_bytes())
+
+        # Content store is kept while any file uses it:
+        storage.remove_file('file1.dat')
+        storage.remove_file('other.dat')
+        self.assertEqual(1, len(list(content_directory.iterdir())))
+        self.assertEqual(data, (storage_directory / 'file2.dat').read_bytes())
+
+        # Links to content store survive restart:
+        storage2 = FileStorage(storage_directory, 24 * 3600, deduplicate=True)
+        storage2.remove_file('file2.dat')
+        storage2.remove_file('file3.dat')
+        self.assertEqual(0, len(storage2.enumerate_files()))
+        self.assertEqual([], list(content_directory.iterdir()))
+
+    def test_deduplication_upload_times(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        storage = FileStorage(storage_directory, 3600, deduplicate=True)
+        with storage.open_file_writer('old.dat') as writer:
+            writer.write(b'abcde')
+        old_unixtime = time() - 3000
+        os.utime(storage_directory / 'old.dat', (old_unixtime, old_unixtime))
+        storage = FileStorage(storage_directory, 3600, deduplicate=True)
+        with storage.open_file_writer('new.dat') as writer:
+            writer.write(b'abcde')
+
+        # Every name keeps its own upload time, also after restart:
+        for storage in (storage, FileStorage(storage_directory, 3600, deduplicate=True)):
+            times = {file.display_filename: file.modified_unixtime for file in storage.enumerate_files()}
+            self.assertAlmostEqual(old_unixtime, times['old.dat'], delta=1)
+            self.assertAlmostEqual(time(), times['new.dat'], delta=10)
+        storage.remove_file('new.dat')
+        self.assertEqual([], list((storage_directory / '.limbo' / 'times').iterdir()))
+
+    def test_internal_directories(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        storage = temp_storage.storage
+        # Internal directory name can't be taken by an uploaded file:
+        with storage.open_file_writer('.limbo') as writer:
+            writer.write(b'abcde')
+        with storage.open_file_writer('shards') as writer:
+            writer.write(b'abcde')
+        self.assertEqual(['_limbo', 'shards'], sorted(file.display_filename for file in storage.enumerate_files()))
+        storage = FileStorage(storage_directory, 24 * 3600, layout='sharded')
+        self.assertEqual(2, len(storage.enumerate_files()))
+
+        # Internal directories of older versions are moved:
+        old_storage_directory = storage_directory / 'old'
+        (old_storage_directory / 'shards' / 'ab').mkdir(parents=True)
+        (old_storage_directory / 'shards' / 'ab' / 'file.dat').write_bytes(b'abcde')
+        storage = FileStorage(old_storage_directory, 24 * 3600)
+        self.assertEqual(['.limbo'], [file.name for file in old_storage_directory.iterdir()])
+        self.assertEqual(5, storage.get_file_info_to_read('file.dat').size)
+
+    def test_deduplication_retention(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        storage = FileStorage(storage_directory, 0, deduplicate=True)
+
+        for original_filename in ('file1.dat', 'file2.dat'):
+            with storage.open_file_writer(original_filename) as writer:
+                writer.write(b'abcde')
+
+        sleep(0.01)
+        storage._check_retention()  # pylint: disable=protected-access
+
+        self.assertEqual(0, len(storage.enumerate_files()))
+        self.assertEqual([], list((storage_directory / '.limbo' / 'content').iterdir()))
+
+    def test_shared_between_processes(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        generation = StorageGeneration()
+        # Each instance stands for a process with its own index:
+        storage1 = FileStorage(storage_directory, 24 * 3600)
+        storage2 = FileStorage(storage_directory, 24 * 3600)
+        storage1.share_between_processes(generation)
+        storage2.share_between_processes(generation)
+        storage2.detach_retention()
+
+        with storage2.open_file_writer('file.dat') as writer:
+            writer.write(b'abcde')
+        self.assertTrue(storage1.is_file_stored('file.dat'))
+        self.assertEqual(5, storage1.get_file_info_to_read('file.dat').size)
+
+        storage1.remove_file('file.dat')
+        self.assertEqual(0, len(storage2.enumerate_files()))
+        with self.assertRaises(FileNotFoundError):
+            storage2.get_file_info_to_read('file.dat')
+
+    def test_shared_changes_are_applied(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        generation = StorageGeneration()
+        storage1 = FileStorage(storage_directory, 24 * 3600, layout='buckets')
+        storage2 = FileStorage(storage_directory, 24 * 3600, layout='buckets')
+        storage1.share_between_processes(generation)
+        storage2.share_between_processes(generation)
+        storage2.detach_retention()
+
+        # Storage directory is not scanned again: changes come from the journal
+        (storage_directory / 'unknown.dat').write_bytes(b'abc')
+        with storage2.open_file_writer('file.dat') as writer:
+            writer.write(b'abcde')
+        self.assertEqual(['file.dat'], [file.display_filename for file in storage1.enumerate_files()])
+
+        # Retention owner removes abandoned uploads of other processes:
+        writer = storage2.open_file_writer('slow.dat')
+        storage1.get_generation()
+        retention_heap = storage1._retention_heap  # pylint: disable=protected-access
+        self.assertIn('slow.dat', [entry.name.split('.', 1)[1] for entry in retention_heap if entry.kind == 'temp'])
+        writer.abort()
+
+    def test_generation(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage = FileStorage(Path(temp_storage.temp_directory.name), 0)
+        generations = [storage.get_generation()]
+
+        with storage.open_file_writer('file.dat') as writer:
+            writer.write(b'abcde')
+        generations.append(storage.get_generation())
+        storage.remove_file('file.dat')
+        generations.append(storage.get_generation())
+
+        with storage.open_file_writer('file.dat') as writer:
+            writer.write(b'abcde')
+        generations.append(storage.get_generation())
+        sleep(0.01)
+        storage._check_retention()  # pylint: disable=protected-access
+        generations.append(storage.get_generation())
+
+        self.assertEqual(sorted(set(generations)), generations)
+
+    def test_limits(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage = FileStorage(Path(temp_storage.temp_directory.name), 24 * 3600,
+                              limits=StorageLimits(max_bytes=100, max_files=3))
+        with self.assertRaises(UploadTooLargeError):
+            storage.check_space(101)
+        storage.check_space(100)
+
+        # Upload of unknown size which grows bigger than the limit is too large, not just short of space:
+        with self.assertRaises(UploadTooLargeError):
+            with storage.open_file_writer('big.dat') as writer:
+                writer.write(b'x' * 60)
+                writer.write(b'x' * 60)
+
+        # Reserved space of uploads in progress is counted:
+        writer = storage.open_file_writer('file1.dat', 60)
+        with self.assertRaises(StorageFullError):
+            storage.open_file_writer('file2.dat', 60)
+        writer.write(b'x' * 60)
+        writer.close()
+        with self.assertRaises(StorageFullError):
+            storage.check_space(60)
+
+        # Uploads of unknown size fail when they grow too big:
+        with self.assertRaises(StorageFullError):
+            with storage.open_file_writer('file2.dat') as writer:
+                writer.write(b'x' * 30)
+                writer.write(b'x' * 30)
+        with storage.open_file_writer('file3.dat') as writer:
+            writer.write(b'x' * 40)
+        with self.assertRaises(StorageFullError):
+            storage.check_space(1)  # 100 bytes are stored
+
+        storage.remove_file('file3.dat')
+        storage.check_space(40)
+        for filename in ('file4.dat', 'file5.dat'):
+            with storage.open_file_writer(filename) as writer:
+                writer.write(b'x' * 10)
+        with self.assertRaises(StorageFullError):
+            storage.check_space(1)  # max number of files
+
+    def test_eviction(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage = FileStorage(Path(temp_storage.temp_directory.name), 24 * 3600,
+                              limits=StorageLimits(max_bytes=100, max_files=3, evict_oldest=True))
+        for index in range(3):
+            with storage.open_file_writer(f'file{index}.dat') as writer:
+                writer.write(b'x' * 30)
+            os.utime(Path(temp_storage.temp_directory.name) / f'file{index}.dat', (1000 + index, 1000 + index))
+        self.assertEqual(3, len(storage.enumerate_files()))
+
+        # One file is removed to free a file slot:
+        with storage.open_file_writer('new1.dat', 10) as writer:
+            writer.write(b'x' * 10)
+        self.assertEqual({'file1.dat', 'file2.dat', 'new1.dat'},
+                         {file.display_filename for file in storage.enumerate_files()})
+        # Two oldest files are removed to free space:
+        with storage.open_file_writer('new2.dat', 75) as writer:
+            writer.write(b'x' * 75)
+        self.assertEqual({'new1.dat', 'new2.dat'}, {file.display_filename for file in storage.enumerate_files()})
+
+    def test_sharded_layout(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        with temp_storage.storage.open_file_writer('flat.dat') as writer:
+            writer.write(b'flat')
+
+        # Files of flat layout are still served; new files go to shards:
+        storage = FileStorage(storage_directory, 24 * 3600, layout='sharded')
+        with storage.open_file_writer('sharded.dat') as writer:
+            writer.write(b'sharded')
+        with self.assertRaises(FileExistsError):
+            storage.open_file_writer('flat.dat')
+        files = {file.display_filename: file for file in storage.enumerate_files()}
+        self.assertEqual(storage_directory / 'flat.dat', files['flat.dat'].full_disk_filename)
+        self.assertEqual(storage_directory / '.limbo' / 'shards', files['sharded.dat'].full_disk_filename.parent.parent)
+        info = storage.get_file_info_to_read('sharded.dat')
+        self.assertEqual(b'sharded', (info.storage_directory / info.disk_filename).read_bytes())
+
+        # Flat storage reads sharded files too:
+        storage = FileStorage(storage_directory, 24 * 3600)
+        self.assertEqual(['flat.dat', 'sharded.dat'],
+                         sorted(file.display_filename for file in storage.enumerate_files()))
+
+        storage = FileStorage(storage_directory, 24 * 3600, layout='migrate')
+        self.assertFalse((storage_directory / 'flat.dat').exists())
+        info = storage.get_file_info_to_read('flat.dat')
+        self.assertEqual(b'flat', (info.storage_directory / info.disk_filename).read_bytes())
+        storage.remove_file('flat.dat')
+        self.assertFalse((info.storage_directory / info.disk_filename).exists())
+
+        storage = FileStorage(storage_directory, 0, layout='sharded')
+        storage._check_retention()  # pylint: disable=protected-access
+        self.assertEqual(0, len(storage.enumerate_files()))
+        self.assertEqual([], [file for file in (storage_directory / '.limbo' / 'shards').rglob('*') if file.is_file()])
+
+        with self.assertRaises(ValueError):
+            FileStorage(storage_directory, 0, layout='unknown')
+
+    def test_bucket_layout(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        storage = FileStorage(storage_directory, 3600, layout='buckets', bucket_seconds=600)
+        for name in ('file1.dat', 'file2.dat'):
+            with storage.open_file_writer(name) as writer:
+                writer.write(b'abcde')
+        bucket_start = int(time()) // 600 * 600
+        info = storage.get_file_info_to_read('file1.dat')
+        self.assertEqual(storage_directory / '.limbo' / 'buckets' / str(bucket_start), info.storage_directory)
+        self.assertEqual(b'abcde', (info.storage_directory / info.disk_filename).read_bytes())
+        storage.remove_file('file1.dat')
+        self.assertFalse((info.storage_directory / info.disk_filename).exists())
+
+        # Expired bucket is removed as a whole; live one is kept:
+        old_bucket = storage_directory / '.limbo' / 'buckets' / '600'
+        old_bucket.mkdir()
+        (old_bucket / 'old1.dat').write_bytes(b'old')
+        (old_bucket / 'old2.dat').write_bytes(b'old')
+        os.utime(old_bucket / 'old1.dat', (1000, 1000))
+        os.utime(old_bucket / 'old2.dat', (1100, 1100))
+        storage = FileStorage(storage_directory, 3600, layout='buckets', bucket_seconds=600)
+        self.assertEqual(3, len(storage.enumerate_files()))
+        storage._check_retention()  # pylint: disable=protected-access
+        self.assertEqual(['file2.dat'], [file.display_filename for file in storage.enumerate_files()])
+        self.assertFalse(old_bucket.exists())
+        self.assertTrue(storage.is_file_stored('file2.dat'))
+
+    def test_bucket_chosen_on_commit(self) -> None:
+        temp_storage = get_temp_file_storage()
+        storage_directory = Path(temp_storage.temp_directory.name)
+        storage = FileStorage(storage_directory, 3600, layout='buckets', bucket_seconds=1)
+        with storage.open_file_writer('file.dat') as writer:
+            opened_bucket = int(time())
+            writer.write(b'abcde')
+            sleep(1.1)
+        # Upload lasted longer than bucket interval: the file goes to the bucket of its commit time
+        info = storage.get_file_info_to_read('file.dat')
+        self.assertLess(opened_bucket, int(info.storage_directory.name))
+        self.assertEqual([info.storage_directory.name],
+                         [bucket.name for bucket in (storage_directory / '.limbo' / 'buckets').iterdir()])
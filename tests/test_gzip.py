@@ -0,0 +1,58 @@
+import gzip
+from typing import Iterator
+from unittest import TestCase
+
+from lib_gzip import GzipCompressor, make_gzip_etag
+from utils.testing_helpers import get_random_text
+
+
+class GzipCompressorTestCase(TestCase):
+
+    def test_compress_stream(self) -> None:
+        text = get_random_text(300000, 42).encode('utf-8')
+        closed = []
+
+        class Chunks:
+            def __iter__(self) -> Iterator[bytes]:
+                for offset in range(0, len(text), 65536):
+                    yield text[offset:offset + 65536]
+
+            @staticmethod
+            def close() -> None:
+                closed.append(True)
+
+        compressor = GzipCompressor(6, 1)
+        stream = compressor.compress_stream(Chunks())
+        assert stream is not None
+        # The only slot is busy:
+        self.assertIsNone(compressor.compress_stream([b'abc']))
+        self.assertEqual(text, gzip.decompress(b''.join(stream)))
+        stream.close()
+        self.assertEqual([True], closed)
+
+        # Slot is released by close() even when the body is not read:
+        stream = compressor.compress_stream([b'abc'])
+        assert stream is not None
+        stream.close()
+        self.assertIsNotNone(compressor.compress_stream([b'abc']))
+
+    def test_should_compress(self) -> None:
+        compressor = GzipCompressor(6, 4)
+        self.assertTrue(compressor.should_compress('text/plain; charset=UTF-8', 100000, 'gzip, br'))
+        self.assertTrue(compressor.should_compress('application/json', None, 'gzip'))
+        self.assertFalse(compressor.should_compress('image/png', 100000, 'gzip'))
+        self.assertFalse(compressor.should_compress('text/plain', 100, 'gzip'))
+        self.assertFalse(compressor.should_compress('text/plain', 100000, 'identity'))
+        self.assertFalse(GzipCompressor(0, 4).should_compress('text/plain', 100000, 'gzip'))
+
+    def test_compress_page(self) -> None:
+        page = b'<html>' + b'<p>row</p>' * 1000 + b'</html>'
+        compressed = GzipCompressor(6, 4).compress_page(page)
+        assert compressed is not None
+        self.assertEqual(page, gzip.decompress(compressed))
+        self.assertEqual(compressed, GzipCompressor(6, 4).compress_page(page))  # same bytes every time
+        self.assertIsNone(GzipCompressor(6, 4).compress_page(b'<html/>'))
+        self.assertIsNone(GzipCompressor(0, 4).compress_page(page))
+
+    def test_etag(self) -> None:
+        self.assertEqual('"abc-gz"', make_gzip_etag('"abc"'))
@@ -0,0 +1,97 @@
+from io import BytesIO
+from unittest import TestCase
+
+from lib_http import (
+    ByteRange,
+    etag_matches_strong,
+    etag_matches_weak,
+    get_multipart_byteranges_length,
+    is_gzip_accepted,
+    is_not_modified,
+    is_range_allowed,
+    iter_multipart_byteranges,
+    make_etag,
+    parse_range_header,
+)
+
+
+class HttpTestCase(TestCase):
+
+    def test_parse_range_header(self) -> None:
+        self.assertEqual([ByteRange(0, 10)], parse_range_header('bytes=0-9', 100))
+        self.assertEqual([ByteRange(90, 100)], parse_range_header('bytes=90-', 100))
+        self.assertEqual([ByteRange(95, 100)], parse_range_header('bytes=-5', 100))
+        self.assertEqual([ByteRange(0, 100)], parse_range_header('bytes=-500', 100))
+        self.assertEqual([ByteRange(50, 100)], parse_range_header('bytes=50-500', 100))
+        self.assertEqual([ByteRange(0, 1), ByteRange(10, 21)], parse_range_header('bytes=0-0, 10-20', 100))
+
+    def test_parse_range_header_merged(self) -> None:
+        self.assertEqual([ByteRange(0, 30)], parse_range_header('bytes=10-29, 0-9', 100))
+        self.assertEqual([ByteRange(0, 30)], parse_range_header('bytes=0-19, 10-29', 100))
+        self.assertEqual([ByteRange(0, 10), ByteRange(90, 100)], parse_range_header('bytes=-10, 0-4, 5-9', 100))
+        self.assertEqual([ByteRange(0, 10)], parse_range_header('bytes=0-9, 0-9, 5-7', 100))
+
+    def test_parse_range_header_unsatisfiable(self) -> None:
+        self.assertEqual([], parse_range_header('bytes=100-', 100))
+        self.assertEqual([], parse_range_header('bytes=-0', 100))
+        self.assertEqual([], parse_range_header('bytes=0-', 0))
+
+    def test_parse_range_header_ignored(self) -> None:
+        self.assertIsNone(parse_range_header('items=0-9', 100))
+        self.assertIsNone(parse_range_header('bytes=9-0', 100))
+        self.assertIsNone(parse_range_header('bytes=a-b', 100))
+        self.assertIsNone(parse_range_header('bytes=5', 100))
+        self.assertIsNone(parse_range_header('bytes=' + ','.join(['0-1'] * 1000), 100))
+        # The whole file would be sent several times:
+        self.assertIsNone(parse_range_header('bytes=' + ','.join(['0-'] * 64), 100))
+        self.assertIsNone(parse_range_header('bytes=0-59, 40-99', 100))
+
+    def test_etags(self) -> None:
+        etag = make_etag(123, 1600000000.5)
+        self.assertEqual(etag, make_etag(123, 1600000000.5))
+        self.assertNotEqual(etag, make_etag(123, 1600000001.5))
+        self.assertNotEqual(etag, make_etag(124, 1600000000.5))
+
+        self.assertTrue(etag_matches_weak(etag, etag))
+        self.assertTrue(etag_matches_weak(f'"abc", W/{etag}', etag))
+        self.assertTrue(etag_matches_weak('*', etag))
+        self.assertFalse(etag_matches_weak('"abc"', etag))
+
+        self.assertTrue(etag_matches_strong(etag, etag))
+        self.assertFalse(etag_matches_strong(f'W/{etag}', etag))
+
+    def test_conditions(self) -> None:
+        etag = make_etag(123, 1600000000.5)
+        self.assertFalse(is_not_modified(None, None, etag, 1600000000.5))
+        self.assertTrue(is_not_modified(etag, None, etag, 1600000000.5))
+        self.assertFalse(is_not_modified('"abc"', 'Sun, 13 Sep 2020 12:26:40 GMT', etag, 1600000000.5))
+        self.assertTrue(is_not_modified(None, 'Sun, 13 Sep 2020 12:26:40 GMT', etag, 1600000000.5))
+        self.assertFalse(is_not_modified(None, 'Sun, 13 Sep 2020 12:26:39 GMT', etag, 1600000000.5))
+
+        self.assertTrue(is_range_allowed(None, etag, 1600000000.5))
+        self.assertTrue(is_range_allowed(etag, etag, 1600000000.5))
+        self.assertFalse(is_range_allowed('"abc"', etag, 1600000000.5))
+        self.assertTrue(is_range_allowed('Sun, 13 Sep 2020 12:26:40 GMT', etag, 1600000000.5))
+        self.assertFalse(is_range_allowed('Sun, 13 Sep 2020 12:26:41 GMT', etag, 1600000000.5))
+
+    def test_gzip_accepted(self) -> None:
+        self.assertTrue(is_gzip_accepted('gzip, deflate, br'))
+        self.assertTrue(is_gzip_accepted('br;q=1.0, GZIP;q=0.5'))
+        self.assertTrue(is_gzip_accepted('*'))
+        self.assertTrue(is_gzip_accepted('*;q=0, gzip'))
+        self.assertFalse(is_gzip_accepted(None))
+        self.assertFalse(is_gzip_accepted(''))
+        self.assertFalse(is_gzip_accepted('identity'))
+        self.assertFalse(is_gzip_accepted('gzip;q=0'))
+        self.assertFalse(is_gzip_accepted('gzip;q=0.0, *'))
+
+    def test_multipart_byteranges(self) -> None:
+        data = b'0123456789abcdef'
+        ranges = [ByteRange(0, 2), ByteRange(10, 16)]
+        body = b''.join(iter_multipart_byteranges(BytesIO(data), ranges, len(data), 'text/plain', 'XYZ', 4))
+        self.assertEqual(len(body), get_multipart_byteranges_length(ranges, len(data), 'text/plain', 'XYZ'))
+        self.assertEqual(
+            b'\r\n--XYZ\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-1/16\r\n\r\n01'
+            b'\r\n--XYZ\r\nContent-Type: text/plain\r\nContent-Range: bytes 10-15/16\r\n\r\nabcdef'
+            b'\r\n--XYZ--\r\n',
+            body)
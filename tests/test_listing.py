@@ -0,0 +1,75 @@
+import json
+from pathlib import Path
+from typing import List, Optional, Sequence
+from unittest import TestCase
+
+from lib_file_storage import DisplayFileItem
+from lib_listing import FilesQuery, iter_json_list, SORT_FIELDS
+
+
+def make_files(count: int) -> List[DisplayFileItem]:
+    return [
+        DisplayFileItem(
+            full_disk_filename=Path(f'file{index:03}.dat'),
+            url_filename=f'file{index:03}.dat',
+            display_filename=f'file{index:03}.dat',
+            size=index % 7,
+            modified_unixtime=1000.0 + index % 10,  # many equal times
+        )
+        for index in range(count)
+    ]
+
+
+def read_all_pages(files: Sequence[DisplayFileItem], sort: str, limit: int, prefix: str = '') -> List[str]:
+    names: List[str] = []
+    cursor: Optional[str] = None
+    while True:
+        page = FilesQuery(sort=sort, prefix=prefix, cursor=cursor, limit=limit).get_page(files)
+        assert len(page.files) <= limit
+        names += [file.url_filename for file in page.files]
+        if page.next_cursor is None:
+            return names
+        cursor = page.next_cursor
+
+
+class FilesQueryTestCase(TestCase):
+
+    def test_sort(self) -> None:
+        files = make_files(50)
+        for sort, key in SORT_FIELDS.items():
+            for descending in (False, True):
+                sort_param = f'-{sort}' if descending else sort
+                names = [file.url_filename for file in FilesQuery(sort=sort_param).get_page(files).files]
+                expected = sorted(((key(file), file.url_filename) for file in files), reverse=descending)
+                self.assertEqual([url_filename for _, url_filename in expected], names)
+                self.assertEqual(names, read_all_pages(files, sort_param, 7))
+
+    def test_prefix(self) -> None:
+        files = make_files(120)
+        names = read_all_pages(files, 'name', 3, prefix='file01')
+        self.assertEqual([f'file{index:03}.dat' for index in range(10, 20)], names)
+
+    def test_files_change_between_pages(self) -> None:
+        files = make_files(10)
+        page = FilesQuery(sort='name', limit=5).get_page(files)
+        self.assertEqual('file004.dat', page.files[-1].url_filename)
+        # Files of the first page are removed, a new one is added:
+        files = files[5:] + make_files(3)[:1] + [make_files(11)[10]]
+        page = FilesQuery(sort='name', limit=5, cursor=page.next_cursor).get_page(files)
+        self.assertEqual([f'file{index:03}.dat' for index in range(5, 10)], [file.url_filename for file in page.files])
+
+    def test_bad_parameters(self) -> None:
+        with self.assertRaises(ValueError):
+            FilesQuery(sort='color')
+        with self.assertRaises(ValueError):
+            FilesQuery(limit=0)
+        with self.assertRaises(ValueError):
+            FilesQuery(cursor='garbage')
+        cursor = FilesQuery(sort='name', limit=1).get_page(make_files(2)).next_cursor
+        with self.assertRaises(ValueError):
+            FilesQuery(sort='size', cursor=cursor)
+
+    def test_json_list(self) -> None:
+        for count in (0, 1, 1000, 1234):
+            items = [{'index': index} for index in range(count)]
+            self.assertEqual(items, json.loads(b''.join(iter_json_list(items))))
@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List
+from unittest import TestCase
+
+from lib_metrics import MetricsRegistry
+
+
+def get_samples(registry: MetricsRegistry) -> List[str]:
+    return [line for line in registry.render().splitlines() if not line.startswith('#')]
+
+
+class MetricsTestCase(TestCase):
+
+    def test_counter_threads(self) -> None:
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'Test counter').labels()
+
+        def increment() -> None:
+            for _ in range(10000):
+                counter.inc()
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['test_total 80000'], get_samples(registry))
+
+    def test_finished_threads(self) -> None:
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'Test counter').labels()
+        for _ in range(100):
+            thread = threading.Thread(target=counter.inc, args=(2,))
+            thread.start()
+            thread.join()
+        counter.inc()
+        self.assertEqual(['test_total 201'], get_samples(registry))
+        # Cells of finished threads are merged; only the cell of this thread is left:
+        self.assertEqual(1, len(counter._shards._cells))  # pylint: disable=protected-access
+
+    def test_labels_and_gauge(self) -> None:
+        registry = MetricsRegistry()
+        gauge = registry.gauge('test_gauge', 'Test "gauge"\nwith labels', ['route'])
+        gauge.labels('/a').inc(3)
+        gauge.labels('/a').dec()
+        gauge.labels('say "hi"\\').inc(0.5)
+        registry.add_collector(lambda: [('test_collected', 'Collected', 7)])
+        self.assertEqual([
+            '# HELP test_gauge Test "gauge"\\nwith labels',
+            '# TYPE test_gauge gauge',
+            'test_gauge{route="/a"} 2',
+            'test_gauge{route="say \\"hi\\"\\\\"} 0.5',
+            '# HELP test_collected Collected',
+            '# TYPE test_collected gauge',
+            'test_collected 7',
+        ], registry.render().splitlines())
+        with self.assertRaises(ValueError):
+            gauge.labels()
+        with self.assertRaises(ValueError):
+            registry.counter('test_gauge', 'Duplicate')
+
+    def test_histogram(self) -> None:
+        registry = MetricsRegistry()
+        histogram = registry.histogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0)).labels()
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual([
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 2.65',
+            'test_seconds_count 4',
+        ], get_samples(registry))
+
+    def test_snapshots(self) -> None:
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'Test counter').labels()
+        gauge = registry.gauge('test_gauge', 'Test gauge').labels()
+        counter.inc(2)
+        gauge.inc()
+        with TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            registry.share_between_processes(directory)
+            registry.save_snapshot()
+            self.assertEqual([f'{os.getpid()}.json'], [file.name for file in directory.iterdir()])
+
+            # Values of other processes are added; gauges of finished processes are not:
+            snapshot = {'test_total': [[[], [5]]], 'test_gauge': [[[], [1]]]}
+            (directory / '1.json').write_text(json.dumps(snapshot))  # PID 1 is always alive
+            self.assertEqual(['test_total 7', 'test_gauge 2'], get_samples(registry))
+            dead_pid = 2 ** 22 + 1  # above maximum PID of Linux
+            (directory / f'{dead_pid}.json').write_text(json.dumps(snapshot))
+            self.assertEqual(['test_total 12', 'test_gauge 2'], get_samples(registry))
@@ -0,0 +1,33 @@
+from typing import List
+from unittest import TestCase
+
+from lib_page_cache import PageCache
+
+
+class PageCacheTestCase(TestCase):
+
+    def test_render_once_per_generation(self) -> None:
+        generation = [1]
+        rendered: List[int] = []
+
+        def render() -> bytes:
+            rendered.append(generation[0])
+            return f'page {generation[0] // 3}'.encode('utf-8')
+
+        cache = PageCache(lambda: generation[0])
+        page1 = cache.get('root', render)
+        self.assertIs(page1, cache.get('root', render))
+        self.assertEqual([1], rendered)
+
+        generation[0] = 2
+        page2 = cache.get('root', render)
+        self.assertEqual([1, 2], rendered)
+        # Same content gets the same tag:
+        self.assertEqual(page1.body, page2.body)
+        self.assertEqual(page1.etag, page2.etag)
+
+        generation[0] = 3
+        page3 = cache.get('root', render)
+        self.assertNotEqual(page1.etag, page3.etag)
+        cache.get('other', render)
+        self.assertEqual([1, 2, 3, 3], rendered)
@@ -1,14 +1,20 @@
+import gzip
 import os
+import socket
 import subprocess
 import sys
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from base64 import b64decode
+from io import BytesIO
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any, List, Optional, Sequence
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 from unittest import TestCase
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 
 import requests
 from dataclasses_json import dataclass_json, Undefined
@@ -49,9 +55,11 @@ def __init__(self, *args: Any, **kwargs: Any) -> None:
         self._text_filename_postfix = '.txt'
         self._server_name: Optional[str] = None
         self._base_url: Optional[str] = None
+        self._workers = 1
 
     @staticmethod
-    def run_child_server(server_name: str, host: str, port: int) -> RunningServer:
+    def run_child_server(server_name: str, host: str, port: int, workers: int = 1,
+                         extra_env: Optional[Dict[str, str]] = None) -> RunningServer:
         script_dir = Path(__file__).parent.absolute()
         root_dir = script_dir.parent
         server_py = root_dir / 'server.py'
@@ -65,11 +73,14 @@ def run_child_server(server_name: str, host: str, port: int) -> RunningServer:
         subenv['LIMBO_LISTEN_PORT'] = str(port)
         subenv['LIMBO_STORAGE_DIRECTORY'] = temp_directory.name
         subenv['LIMBO_IS_DEBUG'] = '1'
+        subenv['LIMBO_WORKERS'] = str(workers)
         subenv['PYTHONUNBUFFERED'] = '1'
+        subenv.update(extra_env or {})
 
         log(f'Run subprocess: {sys.executable} {server_py}')
         log(f'Subprocess server name: {server_name}')
         log(f'Subprocess listen port: {port}')
+        log(f'Subprocess workers: {workers}')
 
         process = subprocess.Popen(  # pylint: disable=consider-using-with
             args=[sys.executable, server_py],
@@ -123,6 +134,13 @@ def download_file(self, url_path: str) -> bytes:
         return response.content or b''
 
     def upload_file(self, original_filename: str, filedata: bytes) -> None:
+        response = self.post_file(original_filename, filedata)
+        self.check_response(response)
+
+    def post_file(self, original_filename: str, filedata: bytes) -> Response:
+        return self.post_files([(original_filename, filedata)])
+
+    def post_files(self, files: Sequence[Tuple[str, bytes]], accept: Optional[str] = None) -> Response:
         assert self._base_url is not None
         url = self._base_url + '/cgi/upload/'
         log('Request: POST ' + url)
@@ -137,17 +155,49 @@ def upload_file(self, original_filename: str, filedata: bytes) -> None:
 
         boundary = 'Ab522e64be24449aa3131245da23b3yZ'
 
+        payload = b''
+        for original_filename, filedata in files:
+            payload_prefix = \
+                f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{original_filename}"\r\n\r\n'
+            payload += payload_prefix.encode('utf-8') + filedata + b'\r\n'
+        payload += f'--{boundary}--\r\n'.encode('utf-8')
+
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        if accept is not None:
+            headers['Accept'] = accept
+
+        return requests.post(url, data=payload, headers=headers)
+
+    def upload_file_chunked(self, original_filename: str, filedata: bytes) -> None:
+        assert self._base_url is not None
+        url = self._base_url + '/cgi/upload/'
+        log('Request: POST ' + url + ' (chunked)')
+
+        boundary = 'Ab522e64be24449aa3131245da23b3yZ'
+
         payload_prefix = \
             f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{original_filename}"\r\n\r\n'
         payload_postfix = f'\r\n--{boundary}--\r\n'
-        payload = payload_prefix.encode('utf-8') + filedata + payload_postfix.encode('utf-8')
+
+        def generate_payload() -> Iterator[bytes]:
+            yield payload_prefix.encode('utf-8')
+            for offset in range(0, len(filedata), 100000):
+                yield filedata[offset:offset + 100000]
+            yield payload_postfix.encode('utf-8')
 
         headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
 
-        response = requests.post(url, data=payload, headers=headers)
+        # requests library sends generator data with "Transfer-Encoding: chunked"
+        response = requests.post(url, data=generate_payload(), headers=headers)
 
         self.check_response(response)
 
+    def put_file(self, original_filename: str, filedata: bytes) -> Response:
+        assert self._base_url is not None
+        url = self._base_url + '/files/' + quote(original_filename)
+        log('Request: PUT ' + url)
+        return requests.put(url, data=filedata)
+
     def upload_text(self, title: str, text: str) -> None:
         assert self._base_url is not None
         url = self._base_url + '/cgi/addtext/'
@@ -211,6 +261,167 @@ def do_test_upload_text(self, name: str, text: str) -> None:
         self.remove_file(url_filename)
         self.assertEqual(0, len(self.get_stored_files()))
 
+    def do_test_upload_file_chunked(self, name: str, data: bytes) -> None:
+        self.on_test_start(f'FileUploadChunked("{name}")')
+        self.remove_all_files()
+
+        self.upload_file_chunked(name, data)
+        files = self.get_stored_files()
+        self.assertEqual(1, len(files))
+        self.assertEqual(name, files[0].display_filename)
+        self.assertEqual(len(data), files[0].size)
+        self.assertEqual(data, self.download_file(files[0].url))
+        self.remove_all_files()
+
+    def do_test_put_file(self, name: str, data: bytes) -> None:
+        self.on_test_start(f'FilePut("{name}")')
+        self.remove_all_files()
+
+        response = self.put_file(name, data)
+        self.assertEqual(201, response.status_code)
+        files = self.get_stored_files()
+        self.assertEqual(1, len(files))
+        self.assertEqual(name, files[0].display_filename)
+        self.assertEqual(len(data), files[0].size)
+        self.assertEqual(files[0].url, response.headers['Location'])
+        self.assertEqual(data, self.download_file(files[0].url))
+
+        # Existing file is not overwritten:
+        self.assertEqual(409, self.put_file(name, b'other data').status_code)
+        self.assertEqual(data, self.download_file(files[0].url))
+        self.remove_all_files()
+
+    def do_test_upload_session(self, name: str, data: bytes) -> None:
+        self.on_test_start(f'UploadSession("{name}")')
+        assert self._base_url is not None
+        self.remove_all_files()
+
+        url = self._base_url + '/cgi/upload-session/'
+        response = requests.post(url, data={'fileName': name, 'size': len(data)})
+        self.assertEqual(201, response.status_code)
+        session_url = url + response.json()['session_id']
+
+        # Several chunks at once; the last one is sent in two parts:
+        chunk_size = 300000
+        offsets = list(range(0, len(data), chunk_size))
+        last_offset = offsets.pop()
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            responses = list(executor.map(
+                lambda offset: requests.put(f'{session_url}?offset={offset}', data=data[offset:offset + chunk_size]),
+                offsets))
+        self.assertEqual([200] * len(offsets), [response.status_code for response in responses])
+        response = requests.put(f'{session_url}?offset={last_offset}', data=data[last_offset:last_offset + 1000])
+        self.assertEqual(200, response.status_code)
+
+        self.assertEqual(409, requests.post(session_url + '/finish').status_code)
+        state = requests.get(session_url).json()
+        self.assertEqual(last_offset + 1000, state['offset'])
+        response = requests.put(f'{session_url}?offset={state["offset"]}', data=data[state['offset']:])
+        self.assertEqual(200, response.status_code)
+        response = requests.post(session_url + '/finish')
+        self.assertEqual(200, response.status_code)
+
+        files = self.get_stored_files()
+        self.assertEqual(1, len(files))
+        self.assertEqual(name, files[0].display_filename)
+        self.assertEqual(files[0].url, response.json()['url'])
+        self.assertEqual(data, self.download_file(files[0].url))
+        self.assertEqual(404, requests.get(session_url).status_code)
+        self.remove_all_files()
+
+    # Server must serve requests while many clients are idle or stuck in the middle of upload
+    def do_test_slow_connections(self) -> None:
+        self.on_test_start('SlowConnections')
+        assert self._base_url is not None
+        self.remove_all_files()
+
+        address = urlparse(self._base_url)
+        assert address.hostname is not None and address.port is not None
+        response = requests.post(self._base_url + '/cgi/upload-session/', data={'fileName': 'slow.dat', 'size': 1000})
+        self.assertEqual(201, response.status_code)
+        session_id = response.json()['session_id']
+        connections = []
+        try:
+            for index in range(300):
+                connection = socket.create_connection((address.hostname, address.port))
+                connections.append(connection)
+                if index % 4 == 1:
+                    connection.sendall(b'GET / HTTP/1.1\r\n')
+                elif index % 4 == 2:
+                    connection.sendall(
+                        f'PUT /files/slow{index}.dat HTTP/1.1\r\nContent-Length: 1000\r\n\r\nabc'.encode('ascii'))
+                elif index % 4 == 3:
+                    connection.sendall(f'PUT /cgi/upload-session/{session_id}?offset=0 HTTP/1.1\r\n'
+                                       'Content-Length: 1000\r\n\r\nabc'.encode('ascii'))
+
+            self.upload_file('file.dat', b'abcdef')
+            files = self.get_stored_files()
+            self.assertEqual(1, len(files))
+            self.assertEqual(b'abcdef', self.download_file(files[0].url))
+        finally:
+            for connection in connections:
+                connection.close()
+        self.remove_all_files()
+
+    def do_test_download_ranges(self) -> None:
+        self.on_test_start('DownloadRanges')
+        assert self._base_url is not None
+        self.remove_all_files()
+
+        data = get_random_bytes(300000, 42)
+        self.upload_file('file.dat', data)
+        files = self.get_stored_files()
+        self.assertEqual(1, len(files))
+        url = self._base_url + files[0].url
+
+        log('Request: HEAD ' + url)
+        response = requests.head(url)
+        self.check_response(response)
+        self.assertEqual(str(len(data)), response.headers['Content-Length'])
+        self.assertEqual('bytes', response.headers['Accept-Ranges'])
+        etag = response.headers['ETag']
+
+        log('Request: GET ' + url + ' (If-None-Match)')
+        response = requests.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.content)
+
+        log('Request: GET ' + url + ' (Range)')
+        response = requests.get(url, headers={'Range': 'bytes=1000-1999'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(f'bytes 1000-1999/{len(data)}', response.headers['Content-Range'])
+        self.assertEqual(data[1000:2000], response.content)
+
+        log('Request: GET ' + url + ' (Range, If-Range)')
+        response = requests.get(url, headers={'Range': 'bytes=-10', 'If-Range': etag})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(data[-10:], response.content)
+        response = requests.get(url, headers={'Range': 'bytes=-10', 'If-Range': '"outdated"'})
+        self.check_response(response)
+        self.assertEqual(data, response.content)
+
+        log('Request: GET ' + url + ' (multiple ranges)')
+        response = requests.get(url, headers={'Range': 'bytes=0-9,200000-200099'})
+        self.assertEqual(206, response.status_code)
+        self.assertTrue(response.headers['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertIn(data[0:10], response.content)
+        self.assertIn(data[200000:200100], response.content)
+
+        log('Request: GET ' + url + ' (overlapping ranges)')
+        response = requests.get(url, headers={'Range': 'bytes=10-19,0-14'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(f'bytes 0-19/{len(data)}', response.headers['Content-Range'])
+        self.assertEqual(data[0:20], response.content)
+        response = requests.get(url, headers={'Range': 'bytes=' + ','.join(['0-'] * 64)})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(data, response.content)
+
+        log('Request: GET ' + url + ' (unsatisfiable range)')
+        response = requests.get(url, headers={'Range': f'bytes={len(data)}-'})
+        self.assertEqual(416, response.status_code)
+
+        self.remove_all_files()
+
     def do_test_few_files(self) -> None:
         self.on_test_start('FewFiles')
         self.remove_all_files()
@@ -233,6 +444,203 @@ def do_test_few_files(self) -> None:
         self.remove_all_files()
         self.assertEqual(0, len(self.get_stored_files()))
 
+    def do_test_upload_multiple_files(self) -> None:
+        self.on_test_start('UploadMultipleFiles')
+        self.remove_all_files()
+
+        data = get_random_bytes(345678, 42)
+        response = self.post_files([('m1.dat', data), ('m2.txt', b'abc'), ('m3', b'')], accept='application/json')
+        self.check_response(response)
+        results = response.json()['files']
+        self.assertEqual(['m1.dat', 'm2.txt', 'm3'], [result['name'] for result in results])
+        self.assertEqual([len(data), 3, 0], [result['size'] for result in results])
+        files = self.get_stored_files()
+        self.assertEqual(['m1.dat', 'm2.txt', 'm3'], [file.display_filename for file in files])
+        self.assertEqual([file.url for file in files], [result['url'] for result in results])
+        self.assertEqual(data, self.download_file(files[0].url))
+
+        # Failed file doesn't stop the others:
+        response = self.post_files([('m2.txt', b'def'), ('m4.txt', b'ghi')], accept='application/json')
+        self.check_response(response)
+        results = response.json()['files']
+        self.assertEqual(409, results[0]['status'])
+        self.assertNotIn('url', results[0])
+        self.assertIn('url', results[1])
+        self.assertEqual(4, len(self.get_stored_files()))
+
+        # Clients which don't accept JSON get the first error:
+        response = self.post_files([('m5.txt', b'jkl'), ('m4.txt', b'mno')])
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(5, len(self.get_stored_files()))
+        self.remove_all_files()
+
+    def do_test_enumerate_pages(self) -> None:
+        assert self._base_url is not None
+        self.on_test_start('EnumeratePages')
+        self.remove_all_files()
+        for index in range(5):
+            self.upload_text(f'page{index}', 'abc')
+        self.upload_text('other', 'abc')
+
+        url: Optional[str] = self._base_url + '/cgi/enumerate/?limit=2&sort=-name&prefix=page'
+        names: List[str] = []
+        while url is not None:
+            log('Request: GET ' + url)
+            response = requests.get(url)
+            self.check_response(response)
+            self.assertNotIn(b'\n', response.content)  # compact
+            names += [item['display_filename'] for item in response.json()]
+            url = self._base_url + response.links['next']['url'] if 'next' in response.links else None
+        self.assertEqual([f'page{index}.txt' for index in reversed(range(5))], names)
+
+        response = requests.get(self._base_url + '/cgi/enumerate/?sort=color')
+        self.assertEqual(400, response.status_code)
+        self.remove_all_files()
+
+    def do_test_cached_pages(self) -> None:
+        assert self._base_url is not None
+        self.on_test_start('CachedPages')
+        for url_path in ('/', '/cgi/enumerate/'):
+            url = self._base_url + url_path
+            log('Request: GET ' + url)
+            response = requests.get(url)
+            self.check_response(response)
+            etag = response.headers['ETag']
+
+            response = requests.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(b'', response.content)
+
+            self.upload_text('cached', 'abc')
+            response = requests.get(url, headers={'If-None-Match': etag})
+            self.check_response(response)
+            self.assertNotEqual(etag, response.headers['ETag'])
+            self.assertIn(b'cached.txt', response.content)
+            self.remove_all_files()
+
+    def do_test_static_assets(self) -> None:
+        assert self._base_url is not None
+        self.on_test_start('StaticAssets')
+        root_dir = Path(__file__).parent.parent.absolute()
+        expected = (root_dir / 'static' / 'jquery' / 'js' / 'jquery.min.js').read_bytes()
+        page = requests.get(self._base_url + '/').text
+        url_path = page.split('src="')[1].split('"')[0]
+        self.assertTrue(url_path.startswith('/static/jquery/js/jquery.min.js?v='), url_path)
+
+        url = self._base_url + url_path
+        log('Request: GET ' + url)
+        response = requests.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.check_response(response)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(expected, response.content)  # decompressed by requests
+
+        response = requests.get(url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(304, response.status_code)
+
+        response = requests.get(self._base_url + '/static/jquery/js/jquery.min.js', headers={'Accept-Encoding': ''})
+        self.check_response(response)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual('no-cache', response.headers['Cache-Control'])
+        self.assertEqual(expected, response.content)
+
+        self.assertEqual(404, requests.get(self._base_url + '/static/templates/root.html').status_code)
+
+    def do_test_gzip(self) -> None:
+        assert self._base_url is not None
+        self.on_test_start('Gzip')
+        text = get_random_text(200000, 42)
+        self.upload_file('log.txt', text.encode('utf-8'))
+        url = self._base_url + '/files/log.txt'
+
+        log('Request: GET ' + url + ' (gzip)')
+        response = requests.get(url, headers={'Accept-Encoding': 'gzip'}, stream=True)
+        self.check_response(response)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        compressed = response.raw.read()
+        self.assertLess(len(compressed), len(text))
+        self.assertEqual(text.encode('utf-8'), gzip.decompress(compressed))
+        response = requests.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(304, response.status_code)
+
+        log('Request: GET ' + url + ' (identity)')
+        response = requests.get(url, headers={'Accept-Encoding': 'identity'})
+        self.check_response(response)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(str(len(text)), response.headers['Content-Length'])
+        self.assertEqual(text, response.text)
+
+        response = requests.get(self._base_url + '/cgi/enumerate/?sort=name', headers={'Accept-Encoding': 'gzip'})
+        self.check_response(response)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(['log.txt'], [item['display_filename'] for item in response.json()])
+        self.remove_all_files()
+
+    def get_metrics(self) -> Dict[str, float]:
+        assert self._base_url is not None
+        response = requests.get(self._base_url + '/metrics')
+        self.check_response(response)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        samples: Dict[str, float] = {}
+        for line in response.text.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def do_test_metrics(self) -> None:
+        assert self._base_url is not None
+        self.on_test_start('Metrics')
+        data = get_random_bytes(300000, 42)
+        self.upload_file('metrics.dat', data)
+        self.assertEqual(data, self.download_file('/files/metrics.dat'))
+
+        samples = self.get_metrics()
+        self.assertEqual(1, samples['limbo_storage_files'])
+        self.assertEqual(len(data), samples['limbo_storage_bytes'])
+        self.assertIn('limbo_storage_incomplete_bytes', samples)
+        # Other workers report their values with a delay
+        if self._workers == 1:
+            self.assertGreaterEqual(samples['limbo_uploaded_bytes_total'], len(data))
+            upload_requests = samples['limbo_request_duration_seconds_count{method="POST",route="/cgi/upload/"}']
+            self.assertGreaterEqual(upload_requests, 1)
+            # Download is counted when the server closes the file, a bit after the client got it:
+            deadline = time.monotonic() + 5
+            while samples['limbo_downloaded_bytes_total'] < len(data) and time.monotonic() < deadline:
+                time.sleep(0.1)
+                samples = self.get_metrics()
+            self.assertGreaterEqual(samples['limbo_downloaded_bytes_total'], len(data))
+        self.remove_all_files()
+
+    def do_test_zip(self) -> None:
+        assert self._base_url is not None
+        self.on_test_start('ZIP')
+        files = {'a.txt': b'abc' * 1000, 'b.dat': get_random_bytes(300000, 42), 'c.txt': b''}
+        for name, data in files.items():
+            self.upload_file(name, data)
+
+        url = self._base_url + '/cgi/zip/'
+        log('Request: GET ' + url)
+        response = requests.get(url)
+        self.check_response(response)
+        self.assertEqual('application/zip', response.headers['Content-Type'])
+        with zipfile.ZipFile(BytesIO(response.content)) as archive:
+            self.assertEqual(sorted(files), archive.namelist())
+            for name, data in files.items():
+                self.assertEqual(data, archive.read(name))
+
+        log('Request: POST ' + url)
+        response = requests.post(url, data={'fileName': ['b.dat', 'a.txt'], 'deflate': '1'})
+        self.check_response(response)
+        with zipfile.ZipFile(BytesIO(response.content)) as archive:
+            self.assertEqual(['b.dat', 'a.txt'], archive.namelist())
+            self.assertEqual(zipfile.ZIP_DEFLATED, archive.getinfo('a.txt').compress_type)
+            self.assertEqual(files['a.txt'], archive.read('a.txt'))
+
+        response = requests.get(url, params={'fileName': ['a.txt', 'missing.txt']})
+        self.assertEqual(404, response.status_code)
+        self.remove_all_files()
+
     def do_all_tests(self, server_name: str, base_url: str) -> None:
         self._server_name = server_name
         self._base_url = base_url.rstrip('/')
@@ -261,16 +669,33 @@ def do_all_tests(self, server_name: str, base_url: str) -> None:
             self.do_test_upload_file(filename, b'some text')
 
         self.do_test_few_files()
+        self.do_test_upload_multiple_files()
+        self.do_test_enumerate_pages()
+        self.do_test_cached_pages()
+        self.do_test_static_assets()
+        self.do_test_gzip()
+        self.do_test_metrics()
+        self.do_test_zip()
+        self.do_test_download_ranges()
+        self.do_test_put_file('put.dat', data)
+        self.do_test_put_file('a', b'')
+        self.do_test_upload_session('session.dat', data)
+        if server_name == 'asyncio':
+            self.do_test_slow_connections()
+        # Paste server does not support chunked request body
+        if server_name != 'paste':
+            self.do_test_upload_file_chunked('chunked.dat', data)
 
         self.remove_all_files()
         self.assertEqual(0, len(self.get_stored_files()))
 
-    def run_server_and_do_all_tests(self, server_name: str) -> None:
+    def run_server_and_do_all_tests(self, server_name: str, workers: int = 1) -> None:
         host = DEFAULT_LISTEN_HOST
         port = DEFAULT_LISTEN_PORT
         base_url = f'http://{host}:{port}'
         log(f'RunServerAndDoAllTests("{server_name}") start')
-        server: RunningServer = self.run_child_server(server_name, host, port)
+        server: RunningServer = self.run_child_server(server_name, host, port, workers)
+        self._workers = workers
 
         with server.temp_directory:
             try:
@@ -281,12 +706,47 @@ def run_server_and_do_all_tests(self, server_name: str) -> None:
                 log(f'Wait subprocess with {server_name} server (PID {server.process.pid})...')
                 server.process.wait()
                 log(f'Subprocess with {server_name} server finished')
+            self.assertEqual(0, server.process.returncode)
 
         log(f'RunServerAndDoAllTests("{server_name}") finished')
 
+    def run_server_and_test_limits(self, server_name: str) -> None:
+        host = DEFAULT_LISTEN_HOST
+        port = DEFAULT_LISTEN_PORT
+        self._base_url = f'http://{host}:{port}'
+        server = self.run_child_server(server_name, host, port, extra_env={
+            'LIMBO_MAX_STORAGE_BYTES': '100000',
+            'LIMBO_MAX_STORAGE_FILES': '2',
+        })
+        with server.temp_directory:
+            try:
+                data = get_random_bytes(60000, 42)
+                self.assertEqual(413, self.put_file('big.dat', get_random_bytes(150000, 42)).status_code)
+                self.assertEqual(413, self.post_file('big.dat', get_random_bytes(150000, 42)).status_code)
+                self.assertEqual(201, self.put_file('file1.dat', data).status_code)
+                self.assertEqual(507, self.put_file('file2.dat', data).status_code)
+                self.assertEqual(507, self.post_file('file2.dat', data).status_code)
+                self.upload_file('file2.dat', data[:1000])
+                self.assertEqual(507, self.post_file('file3.dat', b'').status_code)  # number of files
+                self.assertEqual(['file1.dat', 'file2.dat'],
+                                 sorted(file.display_filename for file in self.get_stored_files()))
+            finally:
+                server.process.terminate()
+                server.process.wait()
+
+    def test_asyncio(self) -> None:
+        self.run_server_and_do_all_tests('asyncio')
+
+    # Requests of every test are spread over worker processes:
+    def test_asyncio_workers(self) -> None:
+        self.run_server_and_do_all_tests('asyncio', workers=3)
+
     def test_cheroot(self) -> None:
         self.run_server_and_do_all_tests('cheroot')
 
+    def test_cheroot_workers(self) -> None:
+        self.run_server_and_do_all_tests('cheroot', workers=3)
+
     # def test_flup(self) -> None:
     #     self.RunServerAndDoAllTests('flup')
     #
@@ -309,8 +769,17 @@ def test_twisted(self) -> None:
     def test_waitress(self) -> None:
         self.run_server_and_do_all_tests('waitress')
 
-    # def test_wsgiref(self) -> None:
-    #     self.RunServerAndDoAllTests('wsgiref')
+    def test_asyncio_limits(self) -> None:
+        self.run_server_and_test_limits('asyncio')
+
+    def test_cheroot_limits(self) -> None:
+        self.run_server_and_test_limits('cheroot')
+
+    def test_wsgiref(self) -> None:
+        self.run_server_and_do_all_tests('wsgiref')
+
+    def test_wsgiref_workers(self) -> None:
+        self.run_server_and_do_all_tests('wsgiref', workers=3)
 
 
 def main() -> None:
@@ -0,0 +1,51 @@
+from unittest import TestCase
+
+from utils.speedtest import (
+    CELL_DATA_BUDGET,
+    compare_results,
+    GeneratedBody,
+    get_cell_clients,
+    get_percentile,
+    make_result,
+    parse_size,
+)
+
+
+class SpeedTestHelpersTestCase(TestCase):
+
+    def test_parse_size(self) -> None:
+        self.assertEqual(1000, parse_size('1000'))
+        self.assertEqual(1024, parse_size('1K'))
+        self.assertEqual(64 * 1024 * 1024, parse_size('64MB'))
+        self.assertEqual(3 * 1024 ** 3, parse_size('3G'))
+
+    def test_percentile(self) -> None:
+        values = [float(value) for value in range(1, 101)]
+        self.assertEqual(50.0, get_percentile(values, 0.50))
+        self.assertEqual(95.0, get_percentile(values, 0.95))
+        self.assertEqual(99.0, get_percentile(values, 0.99))
+        self.assertEqual(7.0, get_percentile([7.0], 0.99))
+        self.assertEqual(0.0, get_percentile([], 0.5))
+
+    def test_cell_clients(self) -> None:
+        clients = [1, 4, 16, 64]
+        self.assertEqual(clients, get_cell_clients(1024 * 1024, clients))
+        self.assertEqual([1, 4], get_cell_clients(CELL_DATA_BUDGET // 4, clients))
+        self.assertEqual([1], get_cell_clients(2 * CELL_DATA_BUDGET, clients))
+
+    def test_generated_body(self) -> None:
+        body = GeneratedBody(b'<', 10, b'>', b'abc')
+        self.assertEqual(12, len(body))
+        self.assertEqual(b'<abcab', body.read(6))
+        self.assertEqual(6, len(body))
+        self.assertEqual(b'cabca>', body.read(100))
+        self.assertEqual(b'', body.read())
+
+    def test_compare(self) -> None:
+        baseline = [make_result(('cheroot', 'put', 1024, 4, 0), [0.010] * 10, 10 * 1024 * 1024, 1.0)]
+        same = [make_result(('cheroot', 'put', 1024, 4, 0), [0.0105] * 10, 10 * 1024 * 1024, 1.05)]
+        self.assertEqual([], compare_results(baseline, same, 0.1))
+        slower = [make_result(('cheroot', 'put', 1024, 4, 0), [0.020] * 10, 10 * 1024 * 1024, 2.0)]
+        self.assertEqual(2, len(compare_results(baseline, slower, 0.1)))  # throughput and latency
+        other = [make_result(('asyncio', 'put', 1024, 4, 0), [0.020] * 10, 10 * 1024 * 1024, 2.0)]
+        self.assertEqual([], compare_results(baseline, other, 0.1))
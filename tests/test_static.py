@@ -0,0 +1,39 @@
+import gzip
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from lib_static import StaticAssets
+
+
+class StaticAssetsTestCase(TestCase):
+
+    def test_load(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            root = Path(temp_directory)
+            (root / 'js').mkdir()
+            (root / 'templates').mkdir()
+            script = b'var a = 1;\n' * 1000
+            (root / 'js' / 'app.js').write_bytes(script)
+            (root / 'logo.png').write_bytes(b'\x89PNG' * 100)
+            (root / 'tiny.css').write_bytes(b'a{}')
+            (root / 'templates' / 'root.html').write_bytes(b'<html/>')
+            assets = StaticAssets(root, exclude=('templates',))
+
+        asset = assets.get('js/app.js')
+        assert asset is not None
+        self.assertEqual(script, asset.body)
+        assert asset.gzip_body is not None
+        self.assertEqual(script, gzip.decompress(asset.gzip_body))
+        self.assertNotEqual(asset.etag, asset.gzip_etag)
+        self.assertEqual(f'/static/js/app.js?v={asset.digest}', assets.get_url('js/app.js'))
+
+        logo = assets.get('logo.png')
+        assert logo is not None
+        self.assertEqual('image/png', logo.content_type)
+        self.assertIsNone(logo.gzip_body)  # images are not compressed
+        tiny = assets.get('tiny.css')
+        assert tiny is not None
+        self.assertIsNone(tiny.gzip_body)  # compression doesn't help
+        self.assertIsNone(assets.get('templates/root.html'))
+        self.assertIsNone(assets.get('missing.js'))
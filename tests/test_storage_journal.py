@@ -0,0 +1,48 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from lib_storage_journal import StorageJournal
+
+
+class StorageJournalTestCase(TestCase):
+
+    def test_records(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            path = Path(temp_directory) / 'journal'
+            # Each instance stands for a process:
+            journal1 = StorageJournal(path)
+            journal1.append({'op': 'remove', 'name': 'old.dat'})
+            journal2 = StorageJournal(path)
+            journal1.append({'op': 'remove', 'name': 'a.dat'})
+            journal2.append({'op': 'remove', 'name': 'b.dat'})
+
+            # Own records are skipped; records appended before the journal was opened are not read:
+            self.assertEqual([{'op': 'remove', 'name': 'b.dat'}], journal1.read())
+            self.assertEqual([{'op': 'remove', 'name': 'a.dat'}], journal2.read())
+            self.assertEqual([], journal2.read())
+
+    def test_rotation(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            path = Path(temp_directory) / 'journal'
+            journal1 = StorageJournal(path)
+            journal2 = StorageJournal(path)
+            journal3 = StorageJournal(path)
+
+            journal2.append({'op': 'remove', 'name': 'a.dat'})
+            journal1.rotate(max_size=1)
+            # Record appended to the replaced journal is appended to the new one too:
+            journal2.append({'op': 'remove', 'name': 'b.dat'})
+            self.assertEqual([{'op': 'remove', 'name': name} for name in ('a.dat', 'b.dat', 'b.dat')],
+                             journal1.read())
+
+            journal1.rotate(max_size=1)
+            journal2.append({'op': 'remove', 'name': 'c.dat'})
+            self.assertEqual([{'op': 'remove', 'name': 'c.dat'}] * 2, journal1.read())
+            # Reader which has missed a whole journal must scan the storage again:
+            self.assertIsNone(journal3.read())
+            journal2.append({'op': 'remove', 'name': 'd.dat'})
+            # Records of the new journal are read anyway:
+            self.assertEqual([{'op': 'remove', 'name': name} for name in ('c.dat', 'd.dat')], journal3.read())
+            journal1.rotate()
+            self.assertEqual(1, len(list(Path(temp_directory).iterdir())))
@@ -0,0 +1,176 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Optional, Sequence, Tuple
+from unittest import TestCase
+
+from streaming_form_data import StreamingFormDataParser
+
+from lib_file_storage import AtomicFile, FileStorage
+from lib_quota import StorageLimits, UploadTooLargeError
+from lib_upload_pipeline import RawBodyParser, UploadPipeline
+from utils.testing_helpers import get_random_bytes
+
+
+BOUNDARY = 'Ab522e64be24449aa3131245da23b3yZ'
+
+
+def make_multipart_body(original_filename: str, filedata: bytes) -> bytes:
+    return make_multifile_body([(original_filename, filedata)])
+
+
+def make_multifile_body(files: Sequence[Tuple[str, bytes]]) -> bytes:
+    body = b''
+    for original_filename, filedata in files:
+        payload_prefix = \
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{original_filename}"\r\n\r\n'
+        body += payload_prefix.encode('utf-8') + filedata + b'\r\n'
+    return body + f'--{BOUNDARY}--\r\n'.encode('utf-8')
+
+
+class UploadPipelineTestCase(TestCase):
+
+    def upload(self, queue_depth: int, filedata: bytes) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+            body = make_multipart_body('file.dat', filedata)
+
+            pipeline = UploadPipeline(storage.open_file_writer, queue_depth)
+            parser = StreamingFormDataParser(headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+            parser.register('file', pipeline.target)
+            size = pipeline.run(BytesIO(body).read, parser.data_received)
+
+            self.assertEqual(len(body), size)
+            files = storage.enumerate_files()
+            self.assertEqual(1, len(files))
+            self.assertEqual('file.dat', files[0].display_filename)
+            self.assertEqual(filedata, files[0].full_disk_filename.read_bytes())
+            self.assertIn('write;dur=', pipeline.timings.get_server_timing_header())
+
+    def test_inline(self) -> None:
+        self.upload(0, b'')
+        self.upload(0, get_random_bytes(1234567, 42))
+
+    def test_threads(self) -> None:
+        self.upload(1, b'')
+        self.upload(1, b'abcde')
+        self.upload(4, get_random_bytes(1234567, 42))
+
+    def test_writer_failure(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+
+            def open_failing_writer(original_filename: str, size_hint: Optional[int]) -> AtomicFile:
+                writer = storage.open_file_writer(original_filename, size_hint)
+
+                def fail(_data: object) -> None:
+                    raise OSError('Disk failure')
+
+                writer.write = fail  # type: ignore
+                return writer
+
+            body = make_multipart_body('file.dat', get_random_bytes(1234567, 42))
+            pipeline = UploadPipeline(open_failing_writer, 2)
+            parser = StreamingFormDataParser(headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+            parser.register('file', pipeline.target)
+            with self.assertRaises(OSError):
+                pipeline.run(BytesIO(body).read, parser.data_received)
+
+            self.assertEqual(0, len(storage.enumerate_files()))
+            self.assertEqual([], list((Path(temp_directory) / '.limbo' / 'incomplete').iterdir()))
+
+    def test_multiple_files(self) -> None:
+        for queue_depth in (0, 2):
+            with TemporaryDirectory() as temp_directory:
+                storage = FileStorage(Path(temp_directory), 24 * 3600, limits=StorageLimits(max_bytes=1000))
+                body = make_multifile_body([
+                    ('a.dat', b'a' * 100),
+                    ('big.dat', b'x' * 1001),
+                    ('a.dat', b'b' * 100),  # file exists
+                    ('b.dat', b''),
+                    ('c.dat', b'c' * 200),
+                ])
+
+                pipeline = UploadPipeline(storage.open_file_writer, queue_depth,
+                                          is_file_error=lambda exc: isinstance(exc, (UploadTooLargeError,
+                                                                                     FileExistsError)))
+                parser = StreamingFormDataParser(
+                    headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+                parser.register('file', pipeline.target)
+                pipeline.run(BytesIO(body).read, parser.data_received)
+
+                self.assertEqual(['a.dat', 'big.dat', 'a.dat', 'b.dat', 'c.dat'],
+                                 [file.filename for file in pipeline.files])
+                self.assertEqual([None, UploadTooLargeError, FileExistsError, None, None],
+                                 [file.error and type(file.error) for file in pipeline.files])
+                self.assertEqual(100, pipeline.files[0].size)
+                self.assertEqual(200, pipeline.files[4].size)
+                files = {file.display_filename: file for file in storage.enumerate_files()}
+                self.assertEqual(['a.dat', 'b.dat', 'c.dat'], sorted(files))
+                self.assertEqual(b'a' * 100, files['a.dat'].full_disk_filename.read_bytes())
+                self.assertEqual(b'c' * 200, files['c.dat'].full_disk_filename.read_bytes())
+                self.assertEqual([], list((Path(temp_directory) / '.limbo' / 'incomplete').iterdir()))
+
+    def upload_raw(self, queue_depth: int, filedata: bytes, expected_size: Optional[int]) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+
+            pipeline = UploadPipeline(storage.open_file_writer, queue_depth, size_hint=expected_size)
+            parser = RawBodyParser(pipeline.target, 'file.dat', expected_size)
+            size = pipeline.run(BytesIO(filedata).read, parser.data_received, parser.data_ended)
+
+            self.assertEqual(len(filedata), size)
+            files = storage.enumerate_files()
+            self.assertEqual(1, len(files))
+            self.assertEqual(filedata, files[0].full_disk_filename.read_bytes())
+            self.assertEqual(len(filedata), files[0].size)
+
+    def test_raw_body(self) -> None:
+        self.upload_raw(0, b'', 0)
+        self.upload_raw(0, get_random_bytes(1234567, 42), 1234567)
+        self.upload_raw(2, b'', None)
+        self.upload_raw(2, get_random_bytes(1234567, 42), 1234567)
+        self.upload_raw(2, get_random_bytes(1234567, 42), None)
+
+    def test_raw_body_truncated(self) -> None:
+        for queue_depth in (0, 2):
+            with TemporaryDirectory() as temp_directory:
+                storage = FileStorage(Path(temp_directory), 24 * 3600)
+
+                pipeline = UploadPipeline(storage.open_file_writer, queue_depth, size_hint=1000)
+                parser = RawBodyParser(pipeline.target, 'file.dat', 1000)
+                with self.assertRaises(EOFError):
+                    pipeline.run(BytesIO(b'x' * 999).read, parser.data_received, parser.data_ended)
+
+                self.assertEqual(0, len(storage.enumerate_files()))
+                self.assertEqual([], list((Path(temp_directory) / '.limbo' / 'incomplete').iterdir()))
+
+    def test_async(self) -> None:
+        with TemporaryDirectory() as temp_directory, ThreadPoolExecutor(max_workers=2) as executor:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+            filedata = get_random_bytes(12345678, 42)
+            body = make_multipart_body('file.dat', filedata)
+            stream = BytesIO(body)
+
+            async def read(size: int) -> bytes:
+                await asyncio.sleep(0)
+                return stream.read(size)
+
+            async def upload() -> int:
+                loop = asyncio.get_running_loop()
+
+                def run_blocking(func: Callable[..., Any], *args: Any) -> 'asyncio.Future[Any]':
+                    return loop.run_in_executor(executor, func, *args)
+
+                pipeline = UploadPipeline(storage.open_file_writer, 0)
+                parser = StreamingFormDataParser(
+                    headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+                parser.register('file', pipeline.target)
+                return await pipeline.run_async(read, parser.data_received, None, run_blocking)
+
+            self.assertEqual(len(body), asyncio.run(upload()))
+            files = storage.enumerate_files()
+            self.assertEqual(1, len(files))
+            self.assertEqual(filedata, files[0].full_disk_filename.read_bytes())
@@ -0,0 +1,164 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from lib_file_storage import FileStorage
+from lib_quota import StorageFullError, StorageLimits, UploadTooLargeError
+from lib_upload_sessions import UploadSession, UploadSessions
+from utils.testing_helpers import get_random_bytes
+
+
+class UploadSessionTestCase(TestCase):
+
+    def test_ranges(self) -> None:
+        session = UploadSession('0' * 32, 'file.dat', 100)
+        session.add_range(50, 60)
+        self.assertEqual(0, session.offset)
+        session.add_range(0, 10)
+        session.add_range(10, 20)
+        session.add_range(55, 70)
+        session.add_range(30, 30)
+        self.assertEqual([[0, 20], [50, 70]], session.ranges)
+        self.assertEqual(20, session.offset)
+        session.add_range(15, 100)
+        self.assertEqual([[0, 100]], session.ranges)
+        self.assertTrue(session.is_complete())
+
+
+class UploadSessionsTestCase(TestCase):
+
+    def test_upload_in_chunks(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+            sessions = UploadSessions(storage)
+            data = get_random_bytes(3000000, 42)
+
+            session = sessions.create('file.dat', len(data))
+            for offset in (2000000, 0, 1000000):  # any order
+                chunk = data[offset:offset + 1000000]
+                sessions.write_chunk(session.session_id, offset, len(chunk), BytesIO(chunk).read)
+            self.assertEqual(0, len(storage.enumerate_files()))
+
+            # State is kept on disk:
+            session = UploadSessions(storage).get(session.session_id)
+            self.assertEqual(len(data), session.offset)
+
+            self.assertEqual('file.dat', sessions.finish(session.session_id))
+            files = storage.enumerate_files()
+            self.assertEqual(1, len(files))
+            self.assertEqual(data, files[0].full_disk_filename.read_bytes())
+            self.assertEqual([], list((Path(temp_directory) / '.limbo' / 'incomplete').iterdir()))
+            with self.assertRaises(FileNotFoundError):
+                sessions.get(session.session_id)
+
+    def test_resume_after_failure(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+            sessions = UploadSessions(storage)
+            data = get_random_bytes(3000000, 42)
+
+            session = sessions.create('file.dat', len(data))
+            with self.assertRaises(EOFError):
+                sessions.write_chunk(session.session_id, 0, len(data), BytesIO(data[:1234567]).read)
+            session = sessions.get(session.session_id)
+            self.assertEqual(1234567, session.offset)
+            with self.assertRaises(ValueError):
+                sessions.finish(session.session_id)
+
+            rest = data[session.offset:]
+            sessions.write_chunk(session.session_id, session.offset, len(rest), BytesIO(rest).read)
+            sessions.finish(session.session_id)
+            self.assertEqual(data, storage.enumerate_files()[0].full_disk_filename.read_bytes())
+
+    def test_bad_requests(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+            sessions = UploadSessions(storage)
+
+            session = sessions.create('file.dat', 10)
+            with self.assertRaises(ValueError):
+                sessions.write_chunk(session.session_id, 5, 6, BytesIO(b'abcdef').read)
+            with self.assertRaises(FileNotFoundError):
+                sessions.get('../file.dat')
+            with self.assertRaises(FileNotFoundError):
+                sessions.get('f' * 32)
+
+            sessions.abort(session.session_id)
+            with self.assertRaises(FileNotFoundError):
+                sessions.get(session.session_id)
+            self.assertEqual([], list((Path(temp_directory) / '.limbo' / 'incomplete').iterdir()))
+
+    def test_sessions_are_locked_separately(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+            sessions = UploadSessions(storage)
+            first = sessions.create('first.dat', 3)
+            second = sessions.create('second.dat', 3)
+
+            # Lock of one session (held e.g. while it is committed) doesn't block another one:
+            with sessions._lock_data(first.session_id, exclusive=True):  # pylint: disable=protected-access
+                sessions.write_chunk(second.session_id, 0, 3, BytesIO(b'abc').read)
+                self.assertEqual('second.dat', sessions.finish(second.session_id))
+            sessions.write_chunk(first.session_id, 0, 3, BytesIO(b'def').read)
+            self.assertEqual('first.dat', sessions.finish(first.session_id))
+            self.assertEqual({}, sessions._session_locks)  # pylint: disable=protected-access
+
+    def test_finish_waits_for_chunk_writes(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600)
+            sessions = UploadSessions(storage)
+            session = sessions.create('file.dat', 6)
+            sessions.write_chunk(session.session_id, 0, 6, BytesIO(b'abcdef').read)
+
+            # Chunk is sent again (e.g. its response was lost) and it is still being read:
+            read_started = threading.Event()
+            read_allowed = threading.Event()
+
+            def read(size: int) -> bytes:
+                read_started.set()
+                read_allowed.wait()
+                return b'ABC'[:size]
+
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                chunk = executor.submit(sessions.write_chunk, session.session_id, 0, 3, read)
+                self.assertTrue(read_started.wait(5))
+                finish = executor.submit(sessions.finish, session.session_id)
+                time.sleep(0.2)
+                self.assertFalse(finish.done())
+                read_allowed.set()
+                self.assertEqual(6, chunk.result(5).offset)
+                self.assertEqual('file.dat', finish.result(5))
+
+            self.assertEqual(b'ABCdef', storage.enumerate_files()[0].full_disk_filename.read_bytes())
+            with self.assertRaises(FileNotFoundError):
+                sessions.write_chunk(session.session_id, 0, 3, BytesIO(b'xyz').read)
+            self.assertEqual(b'ABCdef', storage.enumerate_files()[0].full_disk_filename.read_bytes())
+
+    def test_space_reservations(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            storage = FileStorage(Path(temp_directory), 24 * 3600, limits=StorageLimits(max_bytes=1000))
+            sessions = UploadSessions(storage)
+
+            with self.assertRaises(UploadTooLargeError):
+                sessions.create('big.dat', 1001)
+            # Space of a session is held for its whole lifetime:
+            first = sessions.create('first.dat', 600)
+            with self.assertRaises(StorageFullError):
+                sessions.create('second.dat', 600)
+            sessions.abort(first.session_id)
+            second = sessions.create('second.dat', 600)
+
+            # Session expired (its data file is removed by retention):
+            storage.get_temp_file_path(f'{second.session_id}.upload').unlink()
+            third = sessions.create('third.dat', 600)
+
+            sessions.write_chunk(third.session_id, 0, 600, BytesIO(b'x' * 600).read)
+            sessions.finish(third.session_id)
+            with self.assertRaises(StorageFullError):
+                sessions.create('fourth.dat', 600)
+            sessions.create('fourth.dat', 400)
+            self.assertEqual(600, storage.get_usage().size)
@@ -0,0 +1,51 @@
+import zipfile
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List, Optional
+from unittest import TestCase
+
+from lib_zip import iter_zip, ZipEntry
+from utils.testing_helpers import get_random_bytes
+
+
+def make_entries(directory: Path, sizes: List[int]) -> List[ZipEntry]:
+    entries: List[ZipEntry] = []
+    for index, size in enumerate(sizes):
+        path = directory / f'file{index}.dat'
+        path.write_bytes(get_random_bytes(size, index) if index % 2 else b'text ' * (size // 5))
+        entries.append(ZipEntry(name=f'file{index}.dat', path=path, size=path.stat().st_size,
+                                modified_unixtime=path.stat().st_mtime))
+    return entries
+
+
+class ZipTestCase(TestCase):
+
+    def check_archive(self, compress_level: Optional[int]) -> None:
+        with TemporaryDirectory() as temp_directory:
+            entries = make_entries(Path(temp_directory), [0, 1, 100000, 300000])
+            chunks = list(iter_zip(entries, 65536, compress_level))
+            # Data is streamed by blocks, not as a whole archive:
+            self.assertLess(max(len(chunk) for chunk in chunks), 2 * 65536)
+            with zipfile.ZipFile(BytesIO(b''.join(chunks))) as archive:
+                self.assertIsNone(archive.testzip())
+                self.assertEqual([entry.name for entry in entries], archive.namelist())
+                for entry in entries:
+                    self.assertEqual(entry.path.read_bytes(), archive.read(entry.name))
+                    expected_type = zipfile.ZIP_STORED if compress_level is None else zipfile.ZIP_DEFLATED
+                    self.assertEqual(expected_type, archive.getinfo(entry.name).compress_type)
+
+    def test_stored(self) -> None:
+        self.check_archive(None)
+
+    def test_deflated(self) -> None:
+        self.check_archive(6)
+
+    def test_missing_file(self) -> None:
+        with TemporaryDirectory() as temp_directory:
+            entries = make_entries(Path(temp_directory), [10, 20])
+            entries[0].path.unlink()
+            with zipfile.ZipFile(BytesIO(b''.join(iter_zip(entries, 65536)))) as archive:
+                self.assertEqual(['file1.dat'], archive.namelist())
+        with zipfile.ZipFile(BytesIO(b''.join(iter_zip([], 65536)))) as archive:
+            self.assertEqual([], archive.namelist())
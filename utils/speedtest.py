@@ -1,12 +1,19 @@
+import argparse
+import csv
+import json
 import logging
 import os
 import subprocess
 import sys
-from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, fields
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import List, Optional, Sequence
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import quote
 
 import requests
 from dataclasses_json import dataclass_json
@@ -20,6 +27,25 @@
 LISTEN_HOST = '127.0.0.1'
 LISTEN_PORT = 35080
 
+# Backends covered by tests/test_server.py:
+ALL_SERVERS = ('asyncio', 'cheroot', 'paste', 'tornado', 'twisted', 'waitress', 'wsgiref')
+
+DEFAULT_SIZES = '1K,64K,1M,16M,256M,2G'
+DEFAULT_CLIENTS = '1,4,16,64'
+DEFAULT_STORED_FILES = '10,1000,10000,100000'
+
+# Every matrix cell transfers about this amount of data (but at least one request per client);
+# numbers of clients are reduced for big files to fit into it (see get_cell_clients()):
+CELL_DATA_BUDGET = 1024 * 1024 * 1024
+MAX_REQUESTS_PER_CLIENT = 200
+ENUMERATE_REQUESTS = 20
+
+# Request body is generated from a repeated block, so big files don't need memory:
+BODY_BLOCK_SIZE = 4 * 1024 * 1024
+
+MIB = 1024 * 1024
+SIZE_SUFFIXES = {'K': 1024, 'M': MIB, 'G': 1024 * MIB}
+
 
 @dataclass
 class RunningServer:
@@ -37,18 +63,161 @@ class FileOnServer:
     modified: int
 
 
+@dataclass_json
+@dataclass
+class BenchmarkResult:  # pylint: disable=too-many-instance-attributes
+    server: str
+    operation: str
+    size: int  # file size; 0 for listing operations
+    clients: int
+    stored_files: int
+    requests: int
+    seconds: float
+    throughput_mib_s: float
+    requests_per_s: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+    @property
+    def key(self) -> Tuple[str, str, int, int, int]:
+        return self.server, self.operation, self.size, self.clients, self.stored_files
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    for suffix in ('G', 'M', 'K'):
+        if size >= SIZE_SUFFIXES[suffix] and size % SIZE_SUFFIXES[suffix] == 0:
+            return f'{size // SIZE_SUFFIXES[suffix]}{suffix}'
+    return str(size)
+
+
+# Nearest-rank percentile
+def get_percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(fraction * len(sorted_values) + 0.999999) - 1))
+    return sorted_values[index]
+
+
+# Numbers of clients measured for the file size: when every client transfers
+# one file and it still exceeds the budget, the number of clients is reduced
+# (to one client at least); cells reduced to the same number are measured once.
+def get_cell_clients(size: int, clients: Sequence[int]) -> List[int]:
+    max_clients = max(1, CELL_DATA_BUDGET // max(1, size))
+    cell_clients = sorted({min(count, max_clients) for count in clients})
+    if any(count > max_clients for count in clients):
+        LOGGER.info('Size %s is measured with at most %d clients to fit into the cell data budget',
+                    format_size(size), max_clients)
+    return cell_clients
+
+
+def make_result(key: Tuple[str, str, int, int, int], latencies: Sequence[float],
+                transferred: int, seconds: float) -> BenchmarkResult:
+    server, operation, size, clients, stored_files = key
+    ordered = sorted(latencies)
+    return BenchmarkResult(
+        server=server, operation=operation, size=size, clients=clients, stored_files=stored_files,
+        requests=len(ordered),
+        seconds=round(seconds, 6),
+        throughput_mib_s=round(transferred / seconds / MIB, 3),
+        requests_per_s=round(len(ordered) / seconds, 3),
+        p50_ms=round(get_percentile(ordered, 0.50) * 1000, 3),
+        p95_ms=round(get_percentile(ordered, 0.95) * 1000, 3),
+        p99_ms=round(get_percentile(ordered, 0.99) * 1000, 3),
+    )
+
+
+def save_results(results: Sequence[BenchmarkResult], json_path: Optional[Path], csv_path: Optional[Path]) -> None:
+    if json_path is not None:
+        json_path.write_text(json.dumps([result.to_dict() for result in results], indent=2),  # type: ignore
+                             encoding='utf-8')
+        LOGGER.info('Results are saved to %s', json_path)
+    if csv_path is not None:
+        with csv_path.open('w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow([field.name for field in fields(BenchmarkResult)])
+            for result in results:
+                writer.writerow([getattr(result, field.name) for field in fields(BenchmarkResult)])
+        LOGGER.info('Results are saved to %s', csv_path)
+
+
+def load_results(json_path: Path) -> List[BenchmarkResult]:
+    items = json.loads(json_path.read_text(encoding='utf-8'))
+    return [BenchmarkResult.from_dict(item) for item in items]  # type: ignore  # pylint: disable=no-member
+
+
+# Returns descriptions of regressions: throughput drop or p95 latency growth beyond tolerance
+def compare_results(baseline: Sequence[BenchmarkResult], results: Sequence[BenchmarkResult],
+                    tolerance: float) -> List[str]:
+    baseline_by_key = {result.key: result for result in baseline}
+    regressions: List[str] = []
+    for result in results:
+        base = baseline_by_key.get(result.key)
+        if base is None:
+            continue
+        server, operation, size, clients, stored_files = result.key
+        title = f'{server} {operation} size={format_size(size)} clients={clients} files={stored_files}'
+        if result.throughput_mib_s < base.throughput_mib_s * (1 - tolerance):
+            regressions.append(
+                f'{title}: throughput {base.throughput_mib_s:.3f} -> {result.throughput_mib_s:.3f} MiB/s')
+        if result.p95_ms > base.p95_ms * (1 + tolerance):
+            regressions.append(f'{title}: p95 latency {base.p95_ms:.3f} -> {result.p95_ms:.3f} ms')
+    return regressions
+
+
+# File-like request body of known size; requests library sends it without loading into memory
+class GeneratedBody:
+    def __init__(self, prefix: bytes, size: int, postfix: bytes, block: bytes):
+        self._parts = [prefix, postfix]
+        self._size = size
+        self._block = block
+        self._length = len(prefix) + size + len(postfix)
+        self._position = 0
+
+    def __len__(self) -> int:
+        return self._length - self._position
+
+    def read(self, size: int = -1) -> bytes:
+        prefix, postfix = self._parts
+        end = self._length if size < 0 else min(self._length, self._position + size)
+        result = bytearray()
+        while self._position < end:
+            position = self._position
+            if position < len(prefix):
+                data = prefix[position:end]
+            elif position < len(prefix) + self._size:
+                offset = (position - len(prefix)) % len(self._block)
+                data = self._block[offset:offset + min(end, len(prefix) + self._size) - position]
+            else:
+                offset = position - len(prefix) - self._size
+                data = postfix[offset:offset + end - position]
+            result += data
+            self._position += len(data)
+        return bytes(result)
+
+
 class SpeedTest:
 
     def __init__(self) -> None:
         self._base_url: Optional[str] = None
 
     @staticmethod
-    def run_child_server(server_name: str, port: int) -> RunningServer:
+    def run_child_server(server_name: str, port: int,
+                         temp_directory: Optional['TemporaryDirectory[str]'] = None,
+                         quiet: bool = False, extra_env: Optional[Dict[str, str]] = None) -> RunningServer:
         script_dir = Path(__file__).parent.absolute()
         root_dir = script_dir.parent
         server_py = root_dir / 'server.py'
 
-        temp_directory = TemporaryDirectory()  # pylint: disable=consider-using-with
+        if temp_directory is None:
+            temp_directory = TemporaryDirectory()  # pylint: disable=consider-using-with
         LOGGER.info('created temporary directory: %s', temp_directory.name)
 
         subenv = os.environ.copy()
@@ -58,6 +227,7 @@ def run_child_server(server_name: str, port: int) -> RunningServer:
         subenv['LIMBO_STORAGE_DIRECTORY'] = temp_directory.name
         # don't waste time for saving files:
         subenv['LIMBO_DISABLE_STORAGE'] = '0'
+        subenv.update(extra_env or {})
 
         LOGGER.info('Run subprocess: %s %s', sys.executable, server_py)
         LOGGER.info('Subprocess server name: %s', server_name)
@@ -67,6 +237,7 @@ def run_child_server(server_name: str, port: int) -> RunningServer:
             args=[sys.executable, server_py],
             cwd=root_dir,
             env=subenv,
+            stdout=subprocess.DEVNULL if quiet else None,
         )
 
         LOGGER.info('Subprocess PID: %d', process.pid)
@@ -131,6 +302,35 @@ def upload_file(self, original_filename: str, filedata: bytes) -> None:
 
         self.check_response(response)
 
+    # Upload without multipart framing
+    def put_file(self, original_filename: str, filedata: bytes) -> None:
+        assert self._base_url is not None
+        url = self._base_url + '/files/' + quote(original_filename)
+        LOGGER.info('Request: PUT %s', url)
+        response = requests.put(url, data=filedata)
+        if response.status_code != 201:
+            raise Exception(f'Bad server reply code: {response.status_code}')
+
+    def download_file(self, url_path: str) -> int:
+        assert self._base_url is not None
+        url = self._base_url + url_path
+        LOGGER.info('Request: GET %s', url)
+        size = 0
+        with requests.get(url, stream=True) as response:
+            self.check_response(response)
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                size += len(chunk)
+        return size
+
+    @staticmethod
+    def log_bandwidth(title: str, size: int, time1: datetime, time2: datetime) -> None:
+        mib = 1024 * 1024
+        seconds = (time2 - time1).total_seconds()
+        bandwidth_mib = size / seconds / mib
+        LOGGER.info('%s data size: %.3f MiB', title, size / mib)
+        LOGGER.info('%s time taken: %.3f sec', title, seconds)
+        LOGGER.info('%s bandwidth: %.3f MiB/s', title, bandwidth_mib)
+
     def do_all_tests(self, server_name: str) -> None:
         port = LISTEN_PORT
 
@@ -149,12 +349,22 @@ def do_all_tests(self, server_name: str) -> None:
                 self.upload_file('some_file.dat', data)
                 time2 = datetime.now()
                 LOGGER.info('===============================================')
-                mib = 1024 * 1024
-                seconds = (time2 - time1).total_seconds()
-                bandwidth_mib = len(data) / seconds / mib
-                LOGGER.info('Data size: %.3f MiB', len(data) / mib)
-                LOGGER.info('Time taken: %.3f sec', seconds)
-                LOGGER.info('Bandwidth: %.3f MiB/s', bandwidth_mib)
+                self.log_bandwidth('Upload', len(data), time1, time2)
+                LOGGER.info('===============================================')
+
+                time1 = datetime.now()
+                self.put_file('some_file_put.dat', data)
+                time2 = datetime.now()
+                LOGGER.info('===============================================')
+                self.log_bandwidth('Upload (PUT)', len(data), time1, time2)
+                LOGGER.info('===============================================')
+
+                files = self.get_stored_files()
+                time1 = datetime.now()
+                downloaded_size = self.download_file(files[0].url)
+                time2 = datetime.now()
+                LOGGER.info('===============================================')
+                self.log_bandwidth('Download', downloaded_size, time1, time2)
                 LOGGER.info('===============================================')
 
             finally:
@@ -167,6 +377,244 @@ def do_all_tests(self, server_name: str) -> None:
         LOGGER.info('DoAllTests("%s") finished', server_name)
 
 
+# ==========================================
+# Benchmark matrix.
+# Every server is started once for transfer tests and once per stored
+# files count for listing tests. Each client is a thread with its own
+# keep-alive session; clients start requests at the same time.
+# Big files are measured with fewer clients to keep the data of a cell
+# within CELL_DATA_BUDGET.
+# ==========================================
+
+
+class BenchmarkMatrix:
+    def __init__(self, sizes: Sequence[int], clients: Sequence[int], stored_files: Sequence[int]):
+        self._sizes = sizes
+        self._clients = clients
+        self._stored_files = stored_files
+        self._base_url = f'http://{LISTEN_HOST}:{LISTEN_PORT}'
+        self._block = get_random_bytes(BODY_BLOCK_SIZE, 42)
+        self.results: List[BenchmarkResult] = []
+
+    def run(self, server_name: str) -> None:
+        server = SpeedTest.run_child_server(server_name, LISTEN_PORT, quiet=True)
+        with server.temp_directory:
+            try:
+                self._run_transfers(server_name)
+            finally:
+                self._stop_server(server)
+        for count in self._stored_files:
+            temp_directory = TemporaryDirectory()  # pylint: disable=consider-using-with
+            self._create_stored_files(Path(temp_directory.name), count)
+            server = SpeedTest.run_child_server(server_name, LISTEN_PORT, temp_directory, quiet=True)
+            with server.temp_directory:
+                try:
+                    self._run_listings(server_name, count)
+                finally:
+                    self._stop_server(server)
+
+    @staticmethod
+    def _stop_server(server: RunningServer) -> None:
+        server.process.terminate()
+        server.process.wait()
+
+    def _run_transfers(self, server_name: str) -> None:
+        for size in self._sizes:
+            for clients in get_cell_clients(size, self._clients):
+                requests_per_client = max(1, min(MAX_REQUESTS_PER_CLIENT, CELL_DATA_BUDGET // (size * clients)))
+                for operation in ('upload', 'put'):
+                    self._measure((server_name, operation, size, clients, 0), clients, requests_per_client,
+                                  partial(self._upload, operation, size))
+                    requests.post(self._base_url + '/cgi/remove-all/').raise_for_status()
+
+                self._put(requests.Session(), 'download.dat', size)
+                self._measure((server_name, 'download', size, clients, 0), clients, requests_per_client,
+                              partial(self._fetch, '/files/download.dat'))
+                requests.post(self._base_url + '/cgi/remove-all/').raise_for_status()
+
+    def _run_listings(self, server_name: str, stored_files: int) -> None:
+        operations = {
+            'enumerate': '/cgi/enumerate/',
+            'enumerate_page': '/cgi/enumerate/?limit=100&sort=-modified',
+            'root_page': '/',
+        }
+        for operation, url_path in operations.items():
+            self._measure((server_name, operation, 0, 1, stored_files), 1, ENUMERATE_REQUESTS,
+                          partial(self._fetch, url_path))
+
+    @staticmethod
+    def _create_stored_files(directory: Path, count: int) -> None:
+        LOGGER.info('Create %d stored files', count)
+        for index in range(count):
+            (directory / f'stored_file_{index:06}.txt').write_bytes(b'x' * 100)
+
+    # request(session, unique_name) returns number of bytes transferred
+    def _measure(self, key: Tuple[str, str, int, int, int], clients: int, requests_per_client: int,
+                 request: Callable[[requests.Session, str], int]) -> None:
+        def run_client(client: int) -> Tuple[List[float], int]:
+            latencies: List[float] = []
+            transferred = 0
+            with requests.Session() as session:
+                for index in range(requests_per_client):
+                    time1 = perf_counter()
+                    transferred += request(session, f'file_{client}_{index}.dat')
+                    latencies.append(perf_counter() - time1)
+            return latencies, transferred
+
+        LOGGER.info('Measure %s', key)
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            time1 = perf_counter()
+            client_results = list(executor.map(run_client, range(clients)))
+            seconds = perf_counter() - time1
+        latencies = [latency for client_latencies, _ in client_results for latency in client_latencies]
+        self._add_result(make_result(key, latencies, sum(transferred for _, transferred in client_results), seconds))
+
+    def _add_result(self, result: BenchmarkResult) -> None:
+        LOGGER.info('Result: %.3f MiB/s; %.1f req/s; p50 %.3f ms; p95 %.3f ms; p99 %.3f ms',
+                    result.throughput_mib_s, result.requests_per_s, result.p50_ms, result.p95_ms, result.p99_ms)
+        self.results.append(result)
+
+    def _upload(self, operation: str, size: int, session: requests.Session, name: str) -> int:
+        if operation == 'put':
+            return self._put(session, name, size)
+        boundary = 'Ab522e64be24449aa3131245da23b3yZ'
+        prefix = f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n\r\n'
+        postfix = f'\r\n--{boundary}--\r\n'
+        body = GeneratedBody(prefix.encode('utf-8'), size, postfix.encode('utf-8'), self._block)
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        response = session.post(self._base_url + '/cgi/upload/', data=body, headers=headers)
+        SpeedTest.check_response(response)
+        return size
+
+    def _put(self, session: requests.Session, name: str, size: int) -> int:
+        body = GeneratedBody(b'', size, b'', self._block)
+        response = session.put(self._base_url + '/files/' + quote(name), data=body)
+        if response.status_code != 201:
+            raise Exception(f'Bad server reply code: {response.status_code}')
+        return size
+
+    def _fetch(self, url_path: str, session: requests.Session, _name: str) -> int:
+        return self._download(session, url_path)
+
+    def _download(self, session: requests.Session, url_path: str) -> int:
+        size = 0
+        # Measure transfer of data as it is sent (without decompression):
+        headers = {'Accept-Encoding': 'identity'}
+        with session.get(self._base_url + url_path, stream=True, headers=headers) as response:
+            SpeedTest.check_response(response)
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                size += len(chunk)
+        return size
+
+
+# ==========================================
+# Page cache benchmark.
+# Small files are downloaded while big files are uploaded and downloaded
+# by other clients. It is run with the page cache policy for large files
+# (LIMBO_DROP_CACHE_MIN_BYTES) enabled and disabled: small files stay
+# in cache only with the policy. Big file must be bigger than free memory
+# and storage must be on a real disk (not tmpfs) to see the difference.
+# ==========================================
+
+
+class CacheBenchmark(BenchmarkMatrix):
+    def __init__(self, small_size: int, small_files: int, large_size: int, storage_dir: Optional[Path]):
+        super().__init__(sizes=[], clients=[], stored_files=[])
+        self._small_size = small_size
+        self._small_files = small_files
+        self._large_size = large_size
+        self._storage_dir = storage_dir
+
+    def run(self, server_name: str) -> None:
+        for policy, min_bytes in (('keep_cache', '0'), ('drop_cache', str(64 * MIB))):
+            temp_directory = TemporaryDirectory(dir=self._storage_dir)  # pylint: disable=consider-using-with
+            server = SpeedTest.run_child_server(server_name, LISTEN_PORT, temp_directory, quiet=True,
+                                                extra_env={'LIMBO_DROP_CACHE_MIN_BYTES': min_bytes})
+            with server.temp_directory:
+                try:
+                    self._run_policy(server_name, policy)
+                finally:
+                    self._stop_server(server)
+
+    def _run_policy(self, server_name: str, policy: str) -> None:
+        session = requests.Session()
+        names = [f'small_{index:05}.dat' for index in range(self._small_files)]
+        for name in names:
+            self._put(session, name, self._small_size)
+        self._measure_small(server_name, f'small_idle_{policy}', names)  # files get cached here
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            load = executor.submit(self._transfer_large_files)
+            self._measure_small(server_name, f'small_under_load_{policy}', names, load)
+            load.result()
+        requests.post(self._base_url + '/cgi/remove-all/').raise_for_status()
+
+    # All small files are downloaded again and again until the load is over
+    def _measure_small(self, server_name: str, operation: str, names: Sequence[str],
+                       load: 'Optional[Future[None]]' = None) -> None:
+        LOGGER.info('Measure %s', operation)
+        latencies: List[float] = []
+        transferred = 0
+        with requests.Session() as session:
+            time1 = perf_counter()
+            while True:
+                for name in names:
+                    time2 = perf_counter()
+                    transferred += self._download(session, '/files/' + quote(name))
+                    latencies.append(perf_counter() - time2)
+                if load is None or load.done():
+                    break
+            seconds = perf_counter() - time1
+        self._add_result(make_result((server_name, operation, self._small_size, 1, len(names)),
+                                     latencies, transferred, seconds))
+
+    # Uploads two big files and downloads them: every byte passes page cache twice
+    def _transfer_large_files(self) -> None:
+        session = requests.Session()
+        for name in ('large_1.dat', 'large_2.dat'):
+            self._put(session, name, self._large_size)
+        for name in ('large_1.dat', 'large_2.dat'):
+            self._download(session, '/files/' + name)
+
+
+# ==========================================
+# Durability benchmark.
+# Uploads are measured with every durability mode (LIMBO_DURABILITY):
+# small files and many clients show the cost of syncs and the gain of
+# group commit. Storage must be on a real disk (not tmpfs) to see it.
+# ==========================================
+
+
+class DurabilityBenchmark(BenchmarkMatrix):
+    def __init__(self, sizes: Sequence[int], clients: Sequence[int], storage_dir: Optional[Path]):
+        super().__init__(sizes=sizes, clients=clients, stored_files=[])
+        self._storage_dir = storage_dir
+
+    def run(self, server_name: str) -> None:
+        for mode in ('none', 'commit', 'periodic'):
+            temp_directory = TemporaryDirectory(dir=self._storage_dir)  # pylint: disable=consider-using-with
+            server = SpeedTest.run_child_server(server_name, LISTEN_PORT, temp_directory, quiet=True,
+                                                extra_env={'LIMBO_DURABILITY': mode})
+            with server.temp_directory:
+                try:
+                    self._run_uploads(server_name, mode)
+                finally:
+                    self._stop_server(server)
+
+    def _run_uploads(self, server_name: str, mode: str) -> None:
+        for size in self._sizes:
+            for clients in get_cell_clients(size, self._clients):
+                requests_per_client = max(1, min(MAX_REQUESTS_PER_CLIENT, CELL_DATA_BUDGET // (size * clients)))
+                for operation in ('upload', 'put'):
+                    self._measure((server_name, f'{operation}_{mode}', size, clients, 0), clients,
+                                  requests_per_client, partial(self._upload, operation, size))
+                    requests.post(self._base_url + '/cgi/remove-all/').raise_for_status()
+
+
+def parse_list(text: str, parse: Callable[[str], int]) -> List[int]:
+    return [parse(item) for item in text.split(',') if item.strip()]
+
+
 def main() -> None:
     logging.basicConfig(
         stream=sys.stdout,
@@ -174,10 +622,69 @@ def main() -> None:
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     )
 
-    server_name = sys.argv[1] if len(sys.argv) > 1 else 'cheroot'
-    LOGGER.info('Speed testing %s...', server_name)
-    test = SpeedTest()
-    test.do_all_tests(server_name)
+    parser = argparse.ArgumentParser(description='Limbo speed test. Without --matrix runs a quick test of one server.')
+    parser.add_argument('server', nargs='?', default='cheroot', help='server for the quick test')
+    parser.add_argument('--matrix', action='store_true', help='run benchmark matrix')
+    parser.add_argument('--cache', action='store_true',
+                        help='run page cache benchmark: small file latency under big transfers')
+    parser.add_argument('--durability', action='store_true',
+                        help='run durability benchmark: uploads with every LIMBO_DURABILITY mode')
+    parser.add_argument('--servers', default=','.join(ALL_SERVERS), help='comma separated servers of the matrix')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated file sizes (K, M, G suffixes)')
+    parser.add_argument('--clients', default=DEFAULT_CLIENTS, help='comma separated numbers of concurrent clients')
+    parser.add_argument('--stored-files', default=DEFAULT_STORED_FILES,
+                        help='comma separated numbers of stored files for listing latency')
+    parser.add_argument('--json', type=Path, help='save results as JSON')
+    parser.add_argument('--csv', type=Path, help='save results as CSV')
+    parser.add_argument('--results', type=Path, help='load results from JSON instead of running the matrix')
+    parser.add_argument('--compare', type=Path, metavar='BASELINE', help='compare results with baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative throughput drop or p95 latency growth (default: 0.1)')
+    parser.add_argument('--small-size', default='64K', help='size of small files of page cache benchmark')
+    parser.add_argument('--small-files', type=int, default=200, help='number of small files of page cache benchmark')
+    parser.add_argument('--large-size', default='8G',
+                        help='size of big files of page cache benchmark (should exceed free memory)')
+    parser.add_argument('--storage-dir', type=Path,
+                        help='parent directory of storage of page cache and durability benchmarks')
+    args = parser.parse_args()
+
+    if not args.matrix and not args.cache and not args.durability and args.results is None:
+        LOGGER.info('Speed testing %s...', args.server)
+        test = SpeedTest()
+        test.do_all_tests(args.server)
+        return
+
+    if args.results is not None:
+        results = load_results(args.results)
+    else:
+        if args.cache:
+            matrix: BenchmarkMatrix = CacheBenchmark(
+                parse_size(args.small_size), args.small_files, parse_size(args.large_size), args.storage_dir)
+        elif args.durability:
+            matrix = DurabilityBenchmark(
+                sizes=parse_list(args.sizes, parse_size),
+                clients=parse_list(args.clients, int),
+                storage_dir=args.storage_dir,
+            )
+        else:
+            matrix = BenchmarkMatrix(
+                sizes=parse_list(args.sizes, parse_size),
+                clients=parse_list(args.clients, int),
+                stored_files=parse_list(args.stored_files, int),
+            )
+        for server_name in args.servers.split(','):
+            LOGGER.info('Benchmark %s...', server_name)
+            matrix.run(server_name)
+        results = matrix.results
+    save_results(results, args.json, args.csv)
+
+    if args.compare is not None:
+        regressions = compare_results(load_results(args.compare), results, args.tolerance)
+        for regression in regressions:
+            LOGGER.error('Regression: %s', regression)
+        if regressions:
+            sys.exit(1)
+        LOGGER.info('No regressions found')
 
 
 if __name__ == '__main__':